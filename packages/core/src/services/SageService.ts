@@ -48,6 +48,27 @@ type FrameData = {
   faces: FaceData[];
 };
 
+// Boxes of a face as keyframes, interpolated linearly by frame in between.
+type FaceTrack = {
+  id: string;
+  // [sample, x, y, w, h], where sample is the position of the frame in the sampled frames.
+  keys: Array<[number, number, number, number, number]>;
+  // First and last sample of each run of consecutive samples the face is in.
+  runs: Array<[number, number]>;
+};
+
+// Face tracks of a clip, compressed to keyframes within `tolerance` pixels.
+type FaceTracks = {
+  // Sampled frames, as runs of [first frame, step, count].
+  frames: Array<[number, number, number]>;
+  // Times of the sampled frames are frame / fps, unless given in `times`.
+  fps?: number;
+  times?: number[];
+  integral: boolean;
+  tolerance: number;
+  tracks: FaceTrack[];
+};
+
 type AlignedSegment = {
   start: number;
   end: number;
@@ -60,6 +81,8 @@ type Clip = Segment & {
   file: Source;
   preview_file: Source;
   frame_data: FrameData[];
+  // Set in place of `frame_data` when face tracks are compressed.
+  face_tracks?: FaceTracks;
   speech_data: AlignedSegment[];
 };
 
@@ -74,6 +97,46 @@ export type VideoResult = {
   failure_reason?: FailureReason;
 };
 
+// Reconstructs the boxes of every face in every sampled frame from compressed face tracks.
+export function expandFaceTracks(tracks: FaceTracks): FrameData[] {
+  const frames: number[] = [];
+  for (const [first, step, count] of tracks.frames) {
+    for (let k = 0; k < count; k++) frames.push(first + step * k);
+  }
+
+  const result: FrameData[] = frames.map((frame, i) => ({
+    frame,
+    time: tracks.times ? tracks.times[i] : frame / (tracks.fps ?? 1),
+    faces: []
+  }));
+
+  const round = (v: number) => (tracks.integral ? Math.round(v) : v);
+
+  for (const track of tracks.tracks) {
+    for (const [first, last] of track.runs) {
+      const keys = track.keys.filter(([s]) => s >= first && s <= last);
+
+      for (let k = 0; k < keys.length; k++) {
+        const [s0, ...b0] = keys[k];
+        const [s1, ...b1] = keys[Math.min(k + 1, keys.length - 1)];
+        const f0 = frames[s0];
+        const f1 = frames[s1];
+
+        // The sample of the next keyframe is added with it, unless this is the last.
+        const end = k + 1 < keys.length ? s1 - 1 : s1;
+
+        for (let i = s0; i <= end; i++) {
+          const t = f1 !== f0 ? (frames[i] - f0) / (f1 - f0) : 0;
+          const [x, y, w, h] = b0.map((v, c) => round(v + (b1[c] - v) * t));
+          result[i].faces.push({ id: track.id, x, y, w, h });
+        }
+      }
+    }
+  }
+
+  return result;
+}
+
 type Response = {
   success: boolean;
   error?: string;
@@ -165,6 +228,13 @@ export class SageService {
       const { success, error, ...result } = res.data;
       if (!success) throw new Error(error);
 
+      for (const clip of result.clips) {
+        if (clip.face_tracks) {
+          clip.frame_data = expandFaceTracks(clip.face_tracks);
+          delete clip.face_tracks;
+        }
+      }
+
       return Result.ok(result);
     } catch (err) {
       return Result.fail(err);
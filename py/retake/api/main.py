@@ -1,12 +1,12 @@
 import os
 
 from datetime import datetime, timezone
-from modal import asgi_app, container_app, Dict, Image, NetworkFileSystem, Secret, Stub
+from modal import asgi_app, container_app, Dict, Image, method, NetworkFileSystem, Secret, Stub
 from modal.call_graph import InputInfo, InputStatus
 from typing import cast, Optional
 
 from retake.api.types import Clip, Job, Source, SourceType, VideoResult
-from retake.sage.types import FrameData, Segment, Video
+from retake.sage.types import Segment, Video
 
 BASE_DIR = "/runtime"
 CACHE_DIR = BASE_DIR + "/cache"
@@ -20,7 +20,8 @@ env_vars = dict({
     "XDG_CACHE_HOME": CACHE_DIR,
     "DEEPFACE_HOME": CACHE_DIR,
     "S3_VIDEOS_NAME": "recircle-media-test",
-    "WHISPERX_MODEL": "large-v2"
+    "WHISPERX_MODEL": "large-v2",
+    "TIKTOKEN_CACHE_DIR": CACHE_DIR + "/tiktoken"
 })
 
 requirements_txt = os.path.dirname(__file__) + "/../sage/requirements.txt"
@@ -30,6 +31,11 @@ def setup():
     from whisperx import load_model
     load_model(os.getenv("WHISPERX_MODEL"), device="cpu", compute_type="int8")
 
+    # Fetched once into the cache, rather than on every cold start of get_highlights.
+    from retake.sage.highlights import MODEL
+    from tiktoken import encoding_for_model
+    encoding_for_model(MODEL)
+
 image = (
     Image.micromamba()
         .apt_install("git", "ffmpeg")
@@ -109,7 +115,7 @@ def get_video_file(id: str, src: Source) -> str:
     return file_path
 
 
-@stub.function(
+@stub.cls(
     cpu=2,
     gpu="T4",
     network_file_systems={BASE_DIR: volume},
@@ -119,9 +125,16 @@ def get_video_file(id: str, src: Source) -> str:
         Secret.from_name("hf-token")
     ])
 )
-async def transcribe_video(id: str, src: str):
-    from retake.sage.core import transcribe_video
-    return transcribe_video(id, src)
+class Transcriber:
+    # Speech models are loaded as the container starts, rather than by its first call.
+    def __enter__(self):
+        from retake.sage.speech import preload
+        preload()
+
+    @method()
+    async def transcribe_video(self, id: str, src: str):
+        from retake.sage.core import transcribe_video
+        return transcribe_video(id, src)
 
 
 @stub.function(
@@ -133,7 +146,7 @@ async def transcribe_video(id: str, src: str):
         Secret.from_name("openai-secret")
     ])
 )
-async def get_highlights(id: str, title: str):
+def get_highlights(id: str, title: str):
     from retake.sage.core import get_highlights
     return get_highlights(id, title)
 
@@ -188,7 +201,7 @@ async def process_video(id: str, src: Source, title: str, job_id: str, webhook_e
 
     file_path = get_video_file(id, src)
 
-    transcribe_video.call(id, file_path)
+    Transcriber().transcribe_video.call(id, file_path)
     highlights = get_highlights.call(id, title)
 
     processing = []
@@ -218,8 +231,9 @@ def compile_result(id: str) -> VideoResult:
     import json
     from .types import SingleAlignedSegment
 
+    from retake.sage import tracks, transcript
     from retake.sage.video import from_source
-    from retake.sage.config import VIDEO_DIR
+    from retake.sage.config import FACE_TRACK_COMPRESSION, VIDEO_DIR
 
     video_dir = VIDEO_DIR + f"/{id}"
 
@@ -245,12 +259,7 @@ def compile_result(id: str) -> VideoResult:
         failure_reason=None
     )
 
-    speech_segments: list[SingleAlignedSegment] = []
-
-    with open(video_dir + f"/speech_data.json", "r") as f:
-        j = json.loads(f.read())
-        for s in j["segments"]:
-            speech_segments.append(SingleAlignedSegment(s))
+    speech = transcript.load(video_dir + f"/speech_data.json")
 
     f = open(video_dir + f"/highlights.json", "r")
 
@@ -276,45 +285,20 @@ def compile_result(id: str) -> VideoResult:
                 uri=f"videos/{clip_name}_preview.mp4"
             ),
             frame_data=[],
-            speech_data=[]
+            face_tracks=None,
+            speech_data=cast(list[SingleAlignedSegment], speech.clip(s.timeranges))
         )
 
-        clip_length = 0
-
-        for ts in s.timeranges:
-            for ss in speech_segments:
-                ss_start, ss_end = ss["start"], ss["end"]
-                if ss_start >= ts[0] and ss_end <= ts[1]: 
-                    ss["start"] = round(clip_length + (ss_start - ts[0]), 3)
-                    ss["end"] = round(clip_length + (ss_end - ts[0]), 3)
-
-                    # Some words don't have a start/end time.
-                    # If such cases, use the same timestamps as the last word.
-                    last_start, last_end = ss_start, ss_start
-
-                    for word in ss["words"]:
-                        start = word.get("start", last_start)
-                        end = word.get("end", last_end)
-
-                        last_start = start
-                        last_end = end
-
-                        word["start"] = round((start - ss_start) + ss["start"], 3)
-                        word["end"] = round((end - ss_start) + ss["start"], 3)
-
-                    clip.speech_data.append(ss)
-                elif ss["start"] > ts[1]:
-                    break
-
-            clip_length += ts[1] - ts[0]
-
-        frame_data_file = open(video_dir + f"/clip_{clip_id}.json", "r")
-
-        for v in json.loads(frame_data_file.read()):
-            frame = FrameData.from_dict(v)
-            clip.frame_data.append(frame)
+        # Clips tracked before the binary format was added only have JSON.
+        t = tracks.load_or_convert(
+            video_dir + f"/clip_{clip_id}.tracks",
+            video_dir + f"/clip_{clip_id}.json"
+        )
 
-        frame_data_file.close()
+        if FACE_TRACK_COMPRESSION:
+            clip.face_tracks = tracks.compress(t)
+        else:
+            clip.frame_data = t.to_frame_data()
 
         result.clips.append(clip)
 
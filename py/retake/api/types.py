@@ -3,7 +3,7 @@ from datetime import datetime
 from enum import Enum
 from typing import Generic, Optional, TypeVar, TypedDict
 
-from retake.sage.types import Segment, FrameData
+from retake.sage.types import FaceTracks, FrameData, Segment
 
 T = TypeVar('T')
 
@@ -41,6 +41,8 @@ class Clip(Segment):
     file: Source
     preview_file: Source
     frame_data: list[FrameData]
+    # Set in place of `frame_data` when face tracks are compressed.
+    face_tracks: Optional[FaceTracks]
     speech_data: list[SingleAlignedSegment]
 
 
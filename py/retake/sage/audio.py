@@ -1,3 +1,8 @@
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+
 def extract_from_video(src: str, dst: str):
   import ffmpeg
 
@@ -5,4 +10,41 @@ def extract_from_video(src: str, dst: str):
       .input(src) \
       .output(dst, format='wav', acodec='pcm_s16le', ac=1, ar='16k') \
       .overwrite_output() \
-      .run(capture_stdout=True)
\ No newline at end of file
+      .run(capture_stdout=True)
+
+
+# Decodes the audio of `src` into mono float32 samples through a pipe, without
+# writing to disk. Samples are the same as those of `whisperx.load_audio`.
+def load_from_video(src: str, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+  import ffmpeg
+
+  process = ffmpeg \
+      .input(src, threads=0) \
+      .output('pipe:', format='s16le', acodec='pcm_s16le', ac=1, ar=sample_rate) \
+      .global_args('-loglevel', 'error') \
+      .run_async(cmd=["ffmpeg", "-nostdin"], pipe_stdout=True, pipe_stderr=True)
+
+  # Both pipes are drained together, as ffmpeg blocks once either fills up,
+  # e.g. when logging a stream of decoding errors.
+  out, err = process.communicate()
+
+  if process.returncode != 0:
+    raise ffmpeg.Error("ffmpeg", out, err)
+
+  # Converted in place, so that the decoded audio is only copied once.
+  samples = np.frombuffer(out, np.int16).astype(np.float32)
+  samples /= 32768.0
+
+  return samples
+
+
+def save_wav(audio: np.ndarray, dst: str, sample_rate: int = SAMPLE_RATE):
+  import wave
+
+  samples = np.clip(np.round(audio * 32768.0), -32768, 32767).astype("<i2")
+
+  with wave.open(dst, "wb") as f:
+    f.setnchannels(1)
+    f.setsampwidth(2)
+    f.setframerate(sample_rate)
+    f.writeframes(samples.tobytes())
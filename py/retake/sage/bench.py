@@ -0,0 +1,1064 @@
+import time
+
+from argparse import ArgumentParser
+from typing import Callable, Optional
+
+
+def timed(fn: Callable, repeat: int = 1) -> float:
+  start = time.perf_counter()
+  for _ in range(repeat):
+    fn()
+  return (time.perf_counter() - start) / repeat
+
+
+def embeddings(n: int, dim: int, queries: int, seed: int):
+  import numpy as np
+  import pandas as pd
+
+  from .embeddings import EmbeddingIndex, l2_normalize, similarity_confidence
+
+  # Facenet threshold for `euclidean_l2`.
+  threshold = 0.80
+
+  rng = np.random.default_rng(seed)
+
+  # Clustered embeddings, so that queries have several matches within the threshold.
+  centres = rng.normal(size=(max(1, n // 50), dim))
+  ids = rng.integers(0, centres.shape[0], size=n)
+  data = centres[ids] + rng.normal(scale=0.35, size=(n, dim))
+  probes = centres[rng.integers(0, centres.shape[0], size=queries)] \
+    + rng.normal(scale=0.35, size=(queries, dim))
+
+  df = pd.DataFrame.from_records({
+    "id": [f"face_{i}" for i in ids],
+    "embedding": [list(e) for e in data]
+  })
+
+  index = EmbeddingIndex(dim)
+  for i, e in zip(ids, data):
+    index.add(f"face_{i}", e)
+
+  def query_df(embedding):
+    distances = []
+    for _, row in df.iterrows():
+      diff = l2_normalize(row["embedding"]) - l2_normalize(embedding)
+      distances.append(np.sqrt(np.sum(np.multiply(diff, diff))))
+
+    result_df = df.copy()
+    result_df["distance"] = distances
+    result_df = result_df[result_df["distance"] <= threshold]
+    result_df = result_df.sort_values(by=["distance"], ascending=True).reset_index(drop=True)
+
+    sim_sd = result_df.head(5)["distance"].std()
+    sim_confidence = 0.0 if pd.isna(sim_sd) else 1 - sim_sd
+    match = result_df.iloc[0]["id"] if result_df.size > 0 else None
+
+    return match, sim_confidence
+
+  def query_index(embedding):
+    match_ids, match_dsts = index.query(embedding, threshold)
+    match = match_ids[0] if match_ids.size > 0 else None
+    return match, similarity_confidence(match_dsts, 5)
+
+  matched = 0
+  mismatches = 0
+  for p in probes:
+    df_match, df_conf = query_df(p)
+    idx_match, idx_conf = query_index(p)
+    matched += df_match is not None
+    if df_match != idx_match or abs(df_conf - idx_conf) > 1e-9:
+      mismatches += 1
+
+  df_time = timed(lambda: [query_df(p) for p in probes])
+  idx_time = timed(lambda: [query_index(p) for p in probes], 10)
+
+  print(f"embeddings: {n} stored, {dim} dims, {queries} queries.")
+  print(f"embeddings: DataFrame: {df_time*1000/queries:.3f} ms/query.")
+  print(f"embeddings: Index: {idx_time*1000/queries:.3f} ms/query ({df_time/idx_time:.1f}x).")
+  print(f"embeddings: Queries with a match: {matched}. Mismatched results: {mismatches}.")
+
+
+def sample_frames(src: str, frames: int, interval: float) -> list:
+  from .sampling import FrameSampler
+
+  samples = []
+  for _, frame in FrameSampler(src, interval):
+    samples.append(frame)
+    if len(samples) >= frames:
+      break
+
+  if not samples:
+    raise Exception("No frames sampled.")
+
+  return samples
+
+
+def confident_faces(detector, detections: list) -> list[list[tuple]]:
+  return [
+    [
+      (f["facial_area"]["x"], f["facial_area"]["y"], f["facial_area"]["w"], f["facial_area"]["h"])
+      for f in d or [] if f["confidence"] >= detector.min_confidence
+    ]
+    for d in detections
+  ]
+
+
+def detection(src: str, sizes: list[int], frames: int, interval: float):
+  from . import config
+  from .detectors import get_detector
+
+  samples = sample_frames(src, frames, interval)
+  detector = get_detector(config.FACE_DETECTOR)
+
+  h, w = samples[0].shape[:2]
+  print(f"detection: {len(samples)} frames of {w}x{h} using {detector.name}.")
+
+  # Load the model before timing.
+  detector.detect_batch(samples[:1])
+
+  for size in sizes:
+    detections = []
+    t = timed(lambda: detections.extend(detector.detect_batch(samples, size)))
+
+    faces = sum(len(f) for f in confident_faces(detector, detections))
+    label = "full" if size <= 0 or size >= max(w, h) else f"{size}px"
+
+    print(f"detection: {label}: {t*1000/len(samples):.1f} ms/frame, {faces} faces.")
+
+
+# Compares the throughput of detector backends and their accuracy against a reference backend,
+# and how many of the faces each finds can be embedded, as track_faces drops the others.
+def detectors(src: str, backends: list[str], reference: str, size: int, frames: int, interval: float):
+  from . import config
+  from .detectors import get_detector
+  from .inference import crop, FaceEmbedder
+  from .tracking import iou
+
+  samples = sample_frames(src, frames, interval)
+
+  h, w = samples[0].shape[:2]
+  print(f"detectors: {len(samples)} frames of {w}x{h}. Reference: {reference}.")
+
+  results = {}
+
+  for backend in [reference] + [b for b in backends if b != reference]:
+    detector = get_detector(backend)
+    detector.detect_batch(samples[:1])
+
+    detections = []
+    t = timed(lambda: detections.extend(detector.detect_batch(samples, size)))
+
+    found = confident_faces(detector, detections)
+
+    embedder = FaceEmbedder(config.FACE_DETECTION_MODEL, detector.align_backend)
+    crops = [
+      crop(frame, {"x": x, "y": y, "w": w, "h": h}, (224, 224))
+      for frame, boxes in zip(samples, found) for x, y, w, h in boxes
+    ]
+    embedded = sum(e is not None for e in embedder.embed_batch(crops))
+
+    results[backend] = (t, found, embedded)
+
+  _, expected, _ = results[reference]
+
+  for backend, (t, found, embedded) in results.items():
+    matched = 0
+
+    for e, f in zip(expected, found):
+      remaining = list(f)
+      for box in e:
+        best = max(remaining, key=lambda b: iou(box, b), default=None)
+        if best is not None and iou(box, best) >= 0.5:
+          remaining.remove(best)
+          matched += 1
+
+    n_expected = sum(len(e) for e in expected)
+    n_found = sum(len(f) for f in found)
+
+    precision = matched / n_found if n_found else 1.0
+    recall = matched / n_expected if n_expected else 1.0
+
+    print(f"detectors: {backend}: {t*1000/len(samples):.1f} ms/frame, {len(samples)/t:.1f} fps, "
+          f"{n_found} faces, precision {precision:.2f}, recall {recall:.2f}, {embedded} embedded.")
+
+
+# Per-frame PSNR of `b` against the part of `a` from `start` to `end`, compared in presentation order.
+# Frames are paired by their position rather than their timestamp, so shifted frames don't line up.
+def psnr(a: str, b: str, start: float, end: float) -> list[float]:
+  import re
+  import subprocess
+  import tempfile
+
+  renumber = "settb=1/1000,setpts=N"
+
+  with tempfile.NamedTemporaryFile("r", suffix=".log") as f:
+    subprocess.run(["ffmpeg", "-ss", str(start), "-t", str(end - start), "-i", a, "-i", b, "-lavfi",
+                    f"[0:v]{renumber}[a];[1:v]{renumber}[b];[a][b]psnr=stats_file={f.name}", "-f", "null", "-"],
+                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    return [float(m) for m in re.findall(r"psnr_avg:([\d.]+|inf)", f.read())]
+
+
+# Hashes of the decoded frames of `src`, from `start` to `end` if given, in presentation order.
+def frame_hashes(src: str, start: Optional[float] = None, end: Optional[float] = None) -> list[str]:
+  import subprocess
+
+  seek = ["-ss", str(start), "-t", str(end - start)] if start is not None and end is not None else []
+
+  result = subprocess.run(["ffmpeg", *seek, "-i", src, "-map", "0:v", "-pix_fmt", "yuv420p", "-f", "framemd5", "-"],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+  return [line.split(",")[-1].strip() for line in result.stdout.splitlines() if line and not line.startswith("#")]
+
+
+def codec_tag(src: str) -> str:
+  import subprocess
+
+  result = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries",
+                           "stream=codec_tag_string", "-of", "csv=p=0", src],
+                          stdout=subprocess.PIPE, universal_newlines=True, check=True)
+
+  return result.stdout.strip()
+
+
+# Number of keyframes of the H.264 video of `src` that aren't preceded by in-band parameter sets.
+def keyframes_without_parameter_sets(src: str) -> int:
+  import re
+  import subprocess
+
+  result = subprocess.run(["ffmpeg", "-i", src, "-map", "0:v", "-c", "copy", "-bsf:v", "trace_headers", "-f", "null", "-"],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+  missing = 0
+  sps = False
+  prev = None
+
+  for t in (int(t) for t in re.findall(r"nal_unit_type\s+\d+\s+=\s+(\d+)", result.stderr)):
+    if t == 7:
+      sps = True
+    elif t in [1, 5]:
+      # Only the first slice of a frame.
+      if t == 5 and prev != 5:
+        missing += not sps
+      sps = False
+    prev = t
+
+  return missing
+
+
+# Seconds of decoded audio of `src`.
+def audio_duration(src: str, sample_rate: int = 48000) -> float:
+  import subprocess
+
+  result = subprocess.run(["ffmpeg", "-i", src, "-map", "0:a", "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "-"],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+  return len(result.stdout) / 2 / sample_rate
+
+
+# Checks that smart cuts give the frames of the source, and compares their speed with re-encoding.
+# Copied GOPs must decode to exactly the frames of the source at the same positions, which catches
+# frames that are shifted, dropped or repeated even in static footage. Re-encoded edges must be
+# close to the source on every frame, not just on average.
+def trim(src: str, ranges: list[tuple[float, float]], min_psnr: float):
+  import os
+  import tempfile
+
+  from . import video
+
+  index = video.keyframe_index(src)
+  print(f"trim: {len(index.keyframes)} keyframes in {src} ({index.codec}).")
+
+  failures = 0
+
+  with tempfile.TemporaryDirectory() as tmp:
+    for start, end in ranges:
+      slow_out = tmp + "/slow.mp4"
+      fast_out = tmp + "/fast.mp4"
+
+      slow_time = timed(lambda: video.trim(src, slow_out, start, end))
+      fast_time = timed(lambda: video.trim_fast(src, fast_out, start, end, index))
+
+      expected = frame_hashes(src, start, end)
+      slow_frames = len(frame_hashes(slow_out))
+      found = frame_hashes(fast_out)
+
+      parts = video.smart_cut(index, start, end)
+      copied = sum(frames for _, _, frames in parts if frames is not None)
+      identical = sum(e == f for e, f in zip(expected, found))
+
+      values = psnr(src, fast_out, start, end)
+      lowest = min(values) if values else 0.0
+
+      tag = codec_tag(fast_out)
+      expected_tag = video.SMART_CUT_TAGS.get(index.codec, tag)
+      missing = keyframes_without_parameter_sets(fast_out)
+
+      errors = []
+      if len(found) != len(expected):
+        errors.append(f"expected {len(expected)} frames")
+      if identical < copied:
+        errors.append(f"{copied - identical} copied frames differ from the source")
+      if lowest < min_psnr:
+        errors.append(f"min PSNR below {min_psnr}dB")
+      if tag != expected_tag:
+        errors.append(f"tagged '{tag}' rather than '{expected_tag}'")
+      if missing:
+        errors.append(f"{missing} keyframes without in-band parameter sets")
+
+      failures += bool(errors)
+
+      print(f"trim: {start}-{end}: {'OK' if not errors else 'MISMATCH: ' + ', '.join(errors)}. "
+            f"Re-encode: {slow_time:.2f}s, {slow_frames} frames. "
+            f"Smart cut: {fast_time:.2f}s, {len(found)} frames, {copied} copied, {identical} identical. "
+            f"Min PSNR: {lowest:.1f}dB.")
+
+      os.remove(slow_out)
+      os.remove(fast_out)
+
+    # Joining ranges must keep audio in step with the video.
+    clip_out = tmp + "/clip.mp4"
+    video.render_fast(src, clip_out, ranges, index)
+
+    frames = len(frame_hashes(clip_out))
+    expected_frames = sum(len(frame_hashes(src, start, end)) for start, end in ranges)
+    length = sum(end - start for start, end in ranges)
+    drift = audio_duration(clip_out) - length
+
+    # Within an AAC frame.
+    joined = frames == expected_frames and abs(drift) < 0.025
+
+    print(f"trim: All {len(ranges)} ranges: {'OK' if joined else 'MISMATCH'}. "
+          f"{frames} of {expected_frames} frames, audio {drift * 1000:+.1f}ms off {length:.2f}s.")
+
+  if failures or not joined:
+    raise Exception(f"Smart cuts of {failures} of {len(ranges)} ranges don't match the source"
+                    f"{'' if joined else ', and joined ranges are out of step'}.")
+
+
+def audio(src: str):
+  import numpy as np
+  import os
+  import tempfile
+
+  from . import audio
+
+  with tempfile.TemporaryDirectory() as tmp:
+    wav = tmp + "/audio.wav"
+
+    def from_wav():
+      audio.extract_from_video(src, wav)
+      samples = audio.load_from_video(wav)
+      # Diarization reads the file once more.
+      with open(wav, "rb") as f:
+        f.read()
+      return samples
+
+    def from_pipe():
+      return audio.load_from_video(src)
+
+    wav_samples = from_wav()
+    pipe_samples = from_pipe()
+
+    wav_time = timed(from_wav)
+    pipe_time = timed(from_pipe)
+
+    wav_size = os.path.getsize(wav)
+
+  duration = len(pipe_samples) / audio.SAMPLE_RATE
+  same = np.array_equal(wav_samples, pipe_samples)
+
+  print(f"audio: {duration:.1f}s of audio from {src}.")
+  print(f"audio: WAV: {wav_time:.2f}s, {wav_size / 1e6:.1f} MB written, {2 * wav_size / 1e6:.1f} MB read back.")
+  print(f"audio: Pipe: {pipe_time:.2f}s ({wav_time/pipe_time:.1f}x), nothing written.")
+  print(f"audio: Samples {'match' if same else 'DIFFER'}.")
+
+  if not same:
+    raise Exception("Decoded samples don't match.")
+
+
+# Compares the share of audio skipped before transcription when cutting out stretches without
+# speech found by WhisperX's VAD model, against cutting out silences alone.
+def speech_regions(src: str, min_silence: float):
+  from . import audio, vad
+  from .speech import models
+
+  samples = audio.load_from_video(src)
+  duration = len(samples) / audio.SAMPLE_RATE
+
+  silent = sum(e - s for s, e in vad.silences(samples, audio.SAMPLE_RATE, min_silence))
+
+  model, onset, offset = models.vad_model()
+  speech = []
+  t = timed(lambda: speech.extend(vad.detect_speech(model, samples, audio.SAMPLE_RATE, onset, offset)))
+
+  regions = vad.speech_regions(speech, duration, audio.SAMPLE_RATE, min_silence)
+  skipped = duration - sum(e - s for s, e in regions)
+
+  print(f"speech_regions: {duration:.1f}s of audio from {src}.")
+  print(f"speech_regions: Silences: {silent:.1f}s ({silent / duration:.1%}) skippable.")
+  print(f"speech_regions: VAD: {skipped:.1f}s ({skipped / duration:.1%}) skipped in {len(regions)} regions, "
+        f"found in {t:.2f}s.")
+
+
+# Extracts highlights from a synthetic transcript against a local mock of the OpenAI API,
+# one section at a time and then concurrently, checking that the results are the same.
+def highlights(sections: int, lines: int, latency: float, concurrency: int,
+               tokens_per_minute: int, failure_rate: float, seed: int):
+  import asyncio
+  import random
+
+  import tempfile
+
+  from . import config
+  from .completion_cache import CompletionCache
+  from .highlights import HighlightExtractor
+  from .mock_completions import MockCompletionServer
+
+  # Requests are never sent without a key, and the mock server doesn't check it.
+  config.OPENAI_API_KEY = "mock"
+
+  rng = random.Random(seed)
+
+  contents = []
+  t = 0.0
+  for _ in range(sections):
+    content = ""
+    for _ in range(lines):
+      length = round(rng.uniform(2, 12), 3)
+      content += f"{t:.3f} --> {t + length:.3f}: Some words that were said.\n"
+      t = round(t + length + rng.uniform(0, 1), 3)
+    contents.append(content)
+
+  results = {}
+
+  for n in [1, concurrency]:
+    with MockCompletionServer(latency=latency, tokens_per_minute=tokens_per_minute,
+                              failure_rate=failure_rate, seed=seed) as server:
+      extractor = HighlightExtractor("Benchmark", concurrency=n, api_base=server.url,
+                                     tokens_per_minute=tokens_per_minute or None,
+                                     cache=CompletionCache(enabled=False))
+
+      found = []
+      elapsed = timed(lambda: found.extend(asyncio.run(extractor.run(contents))))
+
+      results[n] = (elapsed, found, server.requests, server.rate_limited, server.failed, server.max_concurrent)
+
+  for n, (elapsed, found, requests, rate_limited, failed, max_concurrent) in results.items():
+    print(f"highlights: Concurrency {n}: {elapsed:.2f}s, {len(found)} highlights, {requests} requests "
+          f"({rate_limited} rate limited, {failed} failed), max {max_concurrent} in flight.")
+
+  if any(not found for _, found, *_ in results.values()):
+    raise Exception("No highlights were extracted.")
+
+  sequential, concurrent = results[1], results[concurrency]
+
+  same = [h.to_dict() for h in sequential[1]] == [h.to_dict() for h in concurrent[1]]
+  print(f"highlights: {sequential[0] / concurrent[0]:.1f}x faster. Results {'match' if same else 'DIFFER'}.")
+
+  if not same:
+    raise Exception("Highlights don't match.")
+
+  # A rerun should be served from the completion cache.
+  with tempfile.TemporaryDirectory() as tmp, \
+       MockCompletionServer(latency=latency, seed=seed) as server:
+    for run in ["Cold", "Warm"]:
+      cache = CompletionCache(tmp)
+      extractor = HighlightExtractor("Benchmark", concurrency=concurrency, api_base=server.url, cache=cache)
+
+      requests = server.requests
+      found = []
+      elapsed = timed(lambda: found.extend(asyncio.run(extractor.run(contents))))
+
+      same = [h.to_dict() for h in found] == [h.to_dict() for h in concurrent[1]]
+
+      print(f"highlights: {run} cache: {elapsed:.2f}s, {cache.stats()}, {server.requests - requests} requests. "
+            f"Results {'match' if same else 'DIFFER'}.")
+
+      if not same:
+        raise Exception(f"Highlights with a {run.lower()} cache don't match.")
+
+
+# Splits a large synthetic transcript into sections, checking that sections fit the token budget,
+# that they cover every line in order and that overlaps fit their budget. Compares the number of
+# sections over budget with splitting on characters, as was done before.
+def sections(lines: int, max_tokens: int, overlap_tokens: int, model: str, seed: int):
+  import random
+
+  from .sectioner import render, render_line, split, TokenCounter
+
+  rng = random.Random(seed)
+  words = ["so", "the", "podcast", "I", "think", "that's", "really", "interesting", "because",
+           "machine", "learning", "you", "know", "we", "were", "talking", "about", "GPU", "latency",
+           "2023", "e.g.", "don't", "it's", "Kubernetes", "okay", "right", "😀", "café"]
+
+  transcript = []
+  t = 0.0
+  for _ in range(lines):
+    length = round(rng.uniform(1, 12), 3)
+    text = " ".join(rng.choice(words) for _ in range(rng.randint(3, 60)))
+    transcript.append((f"{t:.3f} --> {t + length:.3f}", text))
+    t = round(t + length + rng.uniform(0, 1), 3)
+
+  counter = TokenCounter(model)
+
+  found = []
+  cold = timed(lambda: found.extend(split(transcript, max_tokens, overlap_tokens, counter)))
+  warm = timed(lambda: split(transcript, max_tokens, overlap_tokens, counter), repeat=3)
+
+  # Every line should appear once outside of overlaps, in order.
+  covered = []
+  over = 0
+  max_overlap = 0
+  for section in found:
+    new = [l for l in section if not covered or l not in covered[-len(section):]]
+    overlap = section[:len(section) - len(new)]
+
+    max_overlap = max(max_overlap, sum(counter.count_all([render_line(l) for l in overlap])))
+    covered.extend(new)
+
+    if counter.count(render(section)) > max_tokens and len(section) > 1:
+      over += 1
+
+  # Previous heuristic, of 4 characters per token.
+  char_sections = []
+  content = ""
+  for l in transcript:
+    line = render_line(l)
+    if len(content) + len(line) > max_tokens * 4:
+      char_sections.append(content)
+      content = ""
+    content += line
+  char_sections.append(content)
+  char_over = sum(1 for c in char_sections if counter.count(c) > max_tokens)
+
+  tokens = sum(counter.count_all([render_line(l) for l in transcript]))
+  kind = "exact" if counter.exact else "estimated"
+
+  print(f"sections: {lines} lines, {tokens} tokens ({kind}). Budget {max_tokens}, overlap {overlap_tokens}.")
+  print(f"sections: Cold: {cold*1000:.0f}ms, warm: {warm*1000:.0f}ms ({cold/warm:.1f}x).")
+  print(f"sections: {len(found)} sections, {over} over budget, max overlap {max_overlap} tokens.")
+  print(f"sections: Splitting on characters: {len(char_sections)} sections, {char_over} over budget.")
+
+  if covered != transcript:
+    raise Exception("Sections don't cover the transcript in order.")
+
+  if over or max_overlap > overlap_tokens:
+    raise Exception("Sections are over budget.")
+
+
+# Maps the speech of a long synthetic transcript onto clips, with the interval index of
+# transcript.Transcript and with the linear scan compile_result did before, checking that
+# the results match those of the scan run on a fresh copy of the segments for each clip.
+def intervals(segments: int, clips: int, seed: int):
+  import copy
+  import json
+  import os
+  import random
+  import tempfile
+
+  from .transcript import columns_dir, Transcript
+
+  rng = random.Random(seed)
+
+  data = []
+  t = 0.0
+  for i in range(segments):
+    words = []
+    w = t
+    for _ in range(rng.randint(3, 15)):
+      length = round(rng.uniform(0.1, 0.6), 3)
+      word = {"word": "word", "start": round(w, 3), "end": round(w + length, 3), "score": 0.9}
+      # Some words aren't aligned, and have no times.
+      if rng.random() < 0.05:
+        del word["start"], word["end"]
+      words.append(word)
+      w += length + 0.05
+
+    data.append({"start": round(t, 3), "end": round(w, 3), "text": " Some words.", "words": words,
+                 "speaker": f"SPEAKER_0{i % 3}"})
+    t = round(w + rng.uniform(0.1, 1.0), 3)
+
+  timeranges = []
+  for i in range(clips):
+    ranges = []
+    start = rng.uniform(0, t - 300)
+    for _ in range(rng.randint(1, 3)):
+      length = rng.uniform(10, 40)
+      ranges.append((round(start, 3), round(start + length, 3)))
+      start += length + rng.uniform(5, 60)
+    timeranges.append(ranges)
+    # Every few clips share a range with the one before.
+    if i % 5 == 4:
+      timeranges[-1] = timeranges[-2][-1:] + ranges[1:]
+
+  def scan(segments: list[dict], ranges: list[tuple[float, float]]) -> list[dict]:
+    speech_data = []
+    clip_length = 0
+
+    for ts in ranges:
+      for ss in segments:
+        ss_start, ss_end = ss["start"], ss["end"]
+        if ss_start >= ts[0] and ss_end <= ts[1]:
+          ss["start"] = round(clip_length + (ss_start - ts[0]), 3)
+          ss["end"] = round(clip_length + (ss_end - ts[0]), 3)
+
+          last_start, last_end = ss_start, ss_start
+
+          for word in ss["words"]:
+            start = word.get("start", last_start)
+            end = word.get("end", last_end)
+
+            last_start = start
+            last_end = end
+
+            word["start"] = round((start - ss_start) + ss["start"], 3)
+            word["end"] = round((end - ss_start) + ss["start"], 3)
+
+          speech_data.append(ss)
+        elif ss["start"] > ts[1]:
+          break
+
+      clip_length += ts[1] - ts[0]
+
+    return speech_data
+
+  # Only the segments within the ranges are changed by the scan, so only those need copying.
+  def fresh(ranges: list[tuple[float, float]]) -> list[dict]:
+    lo, hi = min(s for s, _ in ranges), max(e for _, e in ranges)
+    return [copy.deepcopy(s) if lo <= s["start"] <= hi else s for s in data]
+
+  expected = [scan(fresh(r), r) for r in timeranges]
+
+  shared = copy.deepcopy(data)
+  scanned = []
+  scan_time = timed(lambda: scanned.extend(copy.deepcopy(scan(shared, r)) for r in timeranges))
+
+  with tempfile.TemporaryDirectory() as tmp:
+    path = tmp + "/speech_data.json"
+    with open(path, "w") as f:
+      f.write(json.dumps({"segments": data}))
+
+    # Parses the JSON and saves the columns, which are then memory mapped.
+    transcript = Transcript(path)
+    json_time = timed(lambda: len(transcript))
+
+    transcript = Transcript(path)
+    load_time = timed(lambda: len(transcript))
+    build_time = timed(lambda: transcript.index)
+
+    found = []
+    index_time = timed(lambda: found.extend(transcript.clip(r) for r in timeranges))
+
+    # Segments should come out of the columns as they went in.
+    same = all(transcript.segment(i) == s for i, s in enumerate(data))
+
+    size = os.path.getsize(path)
+    columns_size = sum(e.stat().st_size for e in os.scandir(columns_dir(path)))
+
+  wrong = sum(1 for e, s in zip(expected, scanned) if e != s)
+  matched = sum(1 for e, f in zip(expected, found) if e == f)
+  n = sum(len(e) for e in expected)
+
+  print(f"intervals: {segments} segments ({size / 1e6:.1f} MB), {clips} clips of {n} segments.")
+  print(f"intervals: Scan: {scan_time*1000:.0f}ms. {wrong} clips wrong from segments shared between clips.")
+  print(f"intervals: Index: {index_time*1000:.1f}ms ({scan_time/index_time:.0f}x), "
+        f"{build_time*1000:.1f}ms to build.")
+  print(f"intervals: Load: {json_time*1000:.0f}ms from JSON, {load_time*1000:.1f}ms from columns "
+        f"({columns_size / 1e6:.1f} MB).")
+  print(f"intervals: {matched}/{clips} clips match. Segments {'match' if same else 'DIFFER'} the JSON.")
+
+  if matched != clips or not same:
+    raise Exception("Clip speech data doesn't match.")
+
+
+# Converts the frame data of a synthetic clip to the binary track format and back, comparing
+# sizes and load times with the JSON, and checking that nothing is lost in the conversion.
+def tracks(frames: int, faces: int, fps: int, seed: int):
+  import json
+  import os
+  import random
+  import tempfile
+
+  from .tracks import load, Tracks
+  from .types import FrameData
+
+  rng = random.Random(seed)
+
+  frame_data = []
+  for frame in range(frames):
+    # Faces aren't found in every frame.
+    if rng.random() < 0.1:
+      continue
+
+    frame_data.append({"frame": frame, "time": frame / fps, "faces": [
+      {"id": str(i), "x": rng.randint(0, 1600), "y": rng.randint(0, 800), "w": rng.randint(80, 320),
+       "h": rng.randint(80, 320)}
+      for i in rng.sample(range(faces * 2), rng.randint(1, faces))
+    ]})
+
+  with tempfile.TemporaryDirectory() as tmp:
+    json_path, tracks_path = tmp + "/clip.json", tmp + "/clip.tracks"
+
+    with open(json_path, "w") as f:
+      f.write(json.dumps(frame_data))
+
+    def from_json():
+      with open(json_path, "r") as f:
+        return [FrameData.from_dict(d) for d in json.loads(f.read())]
+
+    t = Tracks.from_dicts(frame_data)
+    t.save(tracks_path)
+
+    json_time = timed(from_json, repeat=3)
+    load_time = timed(lambda: load(tracks_path), repeat=20)
+    mmap_time = timed(lambda: load(tracks_path, mmap=True), repeat=20)
+    frame_data_time = timed(lambda: load(tracks_path).to_frame_data(), repeat=3)
+
+    loaded = load(tracks_path)
+    json_size, tracks_size = os.path.getsize(json_path), os.path.getsize(tracks_path)
+
+  same_json = loaded.to_json() == json.dumps(frame_data)
+  same_objects = loaded.to_frame_data() == [FrameData.from_dict(d) for d in frame_data]
+  same_views = all(
+    v.frame == d["frame"] and v.time == d["time"] and
+    [(f.id, f.x, f.y, f.w, f.h) for f in v.faces] == [(f["id"], f["x"], f["y"], f["w"], f["h"]) for f in d["faces"]]
+    for v, d in zip(loaded, frame_data)
+  )
+
+  print(f"tracks: {len(t)} frames, {t.face_count} faces, {len(t.ids)} ids.")
+  print(f"tracks: JSON: {json_size / 1e3:.0f} KB, {json_time*1000:.1f}ms to load as FrameData.")
+  print(f"tracks: Binary: {tracks_size / 1e3:.0f} KB ({json_size/tracks_size:.1f}x smaller), "
+        f"{load_time*1000:.2f}ms to load, {mmap_time*1000:.2f}ms to map, "
+        f"{frame_data_time*1000:.1f}ms to load as FrameData.")
+  print(f"tracks: JSON {'matches' if same_json else 'DIFFERS'}, FrameData {'matches' if same_objects else 'DIFFERS'}, "
+        f"views {'match' if same_views else 'DIFFER'}.")
+
+  if not (same_json and same_objects and same_views):
+    raise Exception("Tracks don't match the frame data.")
+
+
+# Compresses the face tracks of a synthetic clip to keyframes at several tolerances, reporting
+# the size of the payload against the frame data it replaces and the largest error of the
+# boxes expanded back from it.
+def compression(samples: int, faces: int, fps: int, interval: float, tolerances: list[float], seed: int):
+  import json
+  import math
+  import random
+
+  from .tracks import compress, expand, max_error, Tracks
+
+  rng = random.Random(seed)
+
+  # Faces drift slowly with some detector jitter, jump on cuts and are sometimes missed.
+  positions = [[rng.uniform(200, 1400), rng.uniform(100, 600)] for _ in range(faces)]
+  frame_data = []
+
+  for k in range(samples):
+    frame = 1 + round(k * interval * fps)
+    cut = rng.random() < 0.02
+
+    found = []
+    for i, p in enumerate(positions):
+      if cut:
+        p[0], p[1] = rng.uniform(200, 1400), rng.uniform(100, 600)
+
+      if rng.random() < 0.05:
+        continue
+
+      x = p[0] + 20 * math.sin(k / 15 + i) + rng.choice([-1, 0, 0, 1])
+      y = p[1] + 5 * math.sin(k / 25 + i) + rng.choice([-1, 0, 1])
+      size = 220 + rng.choice([-2, 0, 0, 2])
+
+      found.append({"id": str(i), "x": round(x), "y": round(y), "w": size, "h": size})
+
+    frame_data.append({"frame": frame, "time": frame / fps, "faces": found})
+
+  t = Tracks.from_dicts(frame_data)
+  size = len(json.dumps(frame_data))
+
+  print(f"compression: {len(t)} samples, {t.face_count} faces. Frame data: {size / 1e3:.0f} KB of JSON, "
+        f"{len(t.to_bytes()) / 1e3:.0f} KB binary.")
+
+  for tolerance in tolerances:
+    compressed = []
+    elapsed = timed(lambda: compressed.append(compress(t, tolerance)))
+
+    c = compressed[0]
+    error = max_error(t, expand(c))
+    compressed_size = len(json.dumps(c.to_dict()))
+    keys = sum(len(track.keys) for track in c.tracks)
+
+    print(f"compression: Tolerance {tolerance}px: {compressed_size / 1e3:.1f} KB ({size / compressed_size:.1f}x), "
+          f"{keys} keyframes, max error {error}px, {elapsed*1000:.0f}ms.")
+
+    if error > tolerance:
+      raise Exception(f"Error over the {tolerance}px tolerance.")
+
+
+# Writes the frame data of a long synthetic clip as generate_clips did, collecting every FrameData
+# and dumping them at once, and streamed through TrackWriter, comparing peak memory and checking
+# that the files are the same. A copy of the streamed file cut short mid-frame, as if tracking
+# was killed, should read back up to the frame before the cut.
+def stream(frames: int, faces: int, fps: int, seed: int):
+  import json
+  import os
+  import random
+  import tempfile
+  import tracemalloc
+
+  from dataclasses import asdict
+
+  from .tracks import load_jsonl, TrackWriter
+  from .types import FaceData, FrameData
+
+  def generate():
+    rng = random.Random(seed)
+    for frame in range(1, frames + 1):
+      yield FrameData(frame, frame / fps, [
+        FaceData(str(i), rng.randint(0, 1600), rng.randint(0, 800), 220, 220) for i in range(faces)
+      ])
+
+  def collected(path: str):
+    face_data = list(generate())
+    with open(path, "w") as f:
+      f.write(json.dumps([asdict(fd) for fd in face_data]))
+
+  def streamed(path: str):
+    with TrackWriter(path + "l") as writer:
+      for fd in generate():
+        writer.write(fd)
+
+    t = writer.tracks()
+    t.save(path + ".tracks")
+
+    with open(path, "w") as f:
+      t.write_json(f)
+
+  results = {}
+
+  with tempfile.TemporaryDirectory() as tmp:
+    for name, fn in [("Collected", collected), ("Streamed", streamed)]:
+      path = tmp + f"/{name}.json"
+
+      tracemalloc.start()
+      elapsed = timed(lambda: fn(path))
+      _, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+
+      with open(path, "r") as f:
+        results[name] = (elapsed, peak, f.read())
+
+    with open(tmp + "/Streamed.jsonl", "rb") as f:
+      data = f.read()
+
+    cut = data[:len(data) * 2 // 3]
+    with open(tmp + "/partial.jsonl", "wb") as f:
+      f.write(cut)
+
+    partial = load_jsonl(tmp + "/partial.jsonl")
+    expected_frames = cut.count(b"\n")
+
+    size = os.path.getsize(tmp + "/Collected.json")
+
+  for name, (elapsed, peak, _) in results.items():
+    print(f"stream: {name}: {elapsed:.2f}s, peak {peak / 1e6:.1f} MB.")
+
+  same = results["Collected"][2] == results["Streamed"][2]
+  print(f"stream: {frames} frames, {size / 1e6:.1f} MB of JSON. Files {'match' if same else 'DIFFER'}.")
+  print(f"stream: Partial file: {len(partial)} of {expected_frames} complete frames read back.")
+
+  if not same or len(partial) != expected_frames:
+    raise Exception("Streamed frame data doesn't match.")
+
+
+# Stores and restores stages of one video from several processes at once, as concurrent
+# generate_clip containers do on the shared volume, with a store small enough that artifacts
+# are evicted while others read them. Every call should succeed, the manifest should
+# record every stage, and evicting artifacts should remove the stages that stored them.
+def stage_cache(processes: int, puts: int, max_bytes: int):
+  import json
+  import multiprocessing
+  import os
+  import tempfile
+
+  with tempfile.TemporaryDirectory() as tmp:
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes) as pool:
+      results = pool.starmap(stage_cache_worker, [(tmp, p, puts, max_bytes) for p in range(processes)])
+
+    with open(tmp + "/video/manifest.json", "r") as f:
+      stages = json.loads(f.read())["stages"]
+
+    # Stages stored by puts that raced with an eviction can outlive their artifacts,
+    # until the next eviction.
+    entries = 0
+    dangling = 0
+    for name in os.listdir(tmp + "/store/stages"):
+      if name.endswith(".json"):
+        with open(tmp + f"/store/stages/{name}", "r") as f:
+          artifacts = json.loads(f.read())["artifacts"].values()
+        entries += 1
+        dangling += any(not os.path.exists(tmp + f"/store/objects/{h[:2]}/{h}") for h in artifacts)
+
+  errors = sum(e for e, _ in results)
+  hits = sum(h for _, h in results)
+  expected = processes * puts
+
+  print(f"stage_cache: {processes} processes x {puts} puts: {errors} errors, {hits} hits.")
+  print(f"stage_cache: {len(stages)} of {expected} stages in the manifest.")
+  print(f"stage_cache: {entries} stages in the store, {dangling} without their artifacts.")
+
+  if errors or len(stages) != expected or dangling > processes:
+    raise Exception("Concurrent stage cache updates failed.")
+
+
+def stage_cache_worker(dir: str, process: int, puts: int, max_bytes: int) -> tuple[int, int]:
+  import os
+
+  from .cache import StageCache
+
+  video_dir = dir + "/video"
+  restored_dir = dir + f"/restored_{process}"
+  os.makedirs(video_dir, exist_ok=True)
+  os.makedirs(restored_dir, exist_ok=True)
+
+  cache = StageCache(video_dir, store_dir=dir + "/store", max_bytes=max_bytes, enabled=True)
+  errors = 0
+  hits = 0
+
+  for i in range(puts):
+    stage = f"stage_{process}_{i}"
+    out = video_dir + f"/{stage}.bin"
+
+    try:
+      with open(out, "wb") as f:
+        f.write(os.urandom(4096))
+
+      key = cache.key(stage, [out], {})
+      cache.put(stage, key, [out])
+
+      # Restore a stage of another process, whose artifacts may be evicted meanwhile.
+      other = f"stage_{(process + 1) % 2}_{i}"
+      src = video_dir + f"/{other}.bin"
+      if os.path.exists(src):
+        hits += cache.get(other, cache.key(other, [src], {}), [restored_dir + f"/{other}.bin"])
+    except Exception as e:
+      print(f"stage_cache: Process {process}: {type(e).__name__}: {e}")
+      errors += 1
+
+  return errors, hits
+
+
+if __name__ == "__main__":
+  parser = ArgumentParser()
+  subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+  p = subparsers.add_parser("embeddings")
+  p.add_argument("-n", type=int, default=2000)
+  p.add_argument("--dim", type=int, default=128)
+  p.add_argument("--queries", type=int, default=20)
+  p.add_argument("--seed", type=int, default=0)
+
+  p = subparsers.add_parser("detection")
+  p.add_argument("src")
+  p.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")], default=[0, 1080, 720, 480, 360])
+  p.add_argument("--frames", type=int, default=20)
+  p.add_argument("--interval", type=float, default=1.0)
+
+  p = subparsers.add_parser("detectors")
+  p.add_argument("src")
+  p.add_argument("--backends", type=lambda s: s.split(","), default=["deepface:mtcnn", "yunet", "haar"])
+  p.add_argument("--reference", default="deepface:mtcnn")
+  p.add_argument("--size", type=int, default=0)
+  p.add_argument("--frames", type=int, default=20)
+  p.add_argument("--interval", type=float, default=1.0)
+
+  p = subparsers.add_parser("trim")
+  p.add_argument("src")
+  p.add_argument("--ranges", type=lambda s: [tuple(float(t) for t in r.split("-")) for r in s.split(",")],
+                 default=[(3.1, 17.45), (0.5, 1.5), (21.3, 40.0)])
+  p.add_argument("--min-psnr", type=float, default=30.0)
+
+  p = subparsers.add_parser("audio")
+  p.add_argument("src")
+
+  p = subparsers.add_parser("speech_regions")
+  p.add_argument("src")
+  p.add_argument("--min-silence", type=float, default=2.0)
+
+  p = subparsers.add_parser("highlights")
+  p.add_argument("--sections", type=int, default=20)
+  p.add_argument("--lines", type=int, default=40)
+  p.add_argument("--latency", type=float, default=0.5)
+  p.add_argument("--concurrency", type=int, default=8)
+  p.add_argument("--tokens-per-minute", type=int, default=0)
+  p.add_argument("--failure-rate", type=float, default=0.0)
+  p.add_argument("--seed", type=int, default=0)
+
+  p = subparsers.add_parser("sections")
+  p.add_argument("--lines", type=int, default=20000)
+  p.add_argument("--max-tokens", type=int, default=2500)
+  p.add_argument("--overlap-tokens", type=int, default=100)
+  p.add_argument("--model", default="gpt-3.5-turbo")
+  p.add_argument("--seed", type=int, default=0)
+
+  p = subparsers.add_parser("intervals")
+  p.add_argument("--segments", type=int, default=50000)
+  p.add_argument("--clips", type=int, default=50)
+  p.add_argument("--seed", type=int, default=0)
+
+  p = subparsers.add_parser("tracks")
+  p.add_argument("--frames", type=int, default=18000)
+  p.add_argument("--faces", type=int, default=3)
+  p.add_argument("--fps", type=int, default=30)
+  p.add_argument("--seed", type=int, default=0)
+
+  p = subparsers.add_parser("compression")
+  p.add_argument("--samples", type=int, default=3600)
+  p.add_argument("--faces", type=int, default=2)
+  p.add_argument("--fps", type=int, default=30)
+  p.add_argument("--interval", type=float, default=1.0)
+  p.add_argument("--tolerances", type=lambda s: [float(x) for x in s.split(",")], default=[0, 1, 2, 4])
+  p.add_argument("--seed", type=int, default=0)
+
+  p = subparsers.add_parser("stream")
+  p.add_argument("--frames", type=int, default=100000)
+  p.add_argument("--faces", type=int, default=3)
+  p.add_argument("--fps", type=int, default=30)
+  p.add_argument("--seed", type=int, default=0)
+
+  p = subparsers.add_parser("stage_cache")
+  p.add_argument("--processes", type=int, default=4)
+  p.add_argument("--puts", type=int, default=200)
+  p.add_argument("--max-bytes", type=int, default=256 * 1024)
+
+  args = vars(parser.parse_args())
+
+  match args.pop("benchmark"):
+    case "embeddings":
+      embeddings(**args)
+    case "detection":
+      detection(**args)
+    case "detectors":
+      detectors(**args)
+    case "trim":
+      trim(**args)
+    case "audio":
+      audio(**args)
+    case "speech_regions":
+      speech_regions(**args)
+    case "highlights":
+      highlights(**args)
+    case "sections":
+      sections(**args)
+    case "intervals":
+      intervals(**args)
+    case "tracks":
+      tracks(**args)
+    case "compression":
+      compression(**args)
+    case "stream":
+      stream(**args)
+    case "stage_cache":
+      stage_cache(**args)
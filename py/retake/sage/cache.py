@@ -0,0 +1,325 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from retake.sage import config
+from retake.sage.utils import ensure_dir_exists, SizeEstimates
+
+CHUNK_SIZE = 1024 * 1024
+
+# Number of artifacts stored between walks of the store, which count those stored by other processes.
+EVICT_INTERVAL = 100
+
+# Shared by the caches of all videos, which share a store.
+_store_sizes = SizeEstimates(EVICT_INTERVAL)
+
+
+# Content-addressed cache of stage artifacts.
+#
+# A stage's key is derived from the hashes of its input files and its parameters.
+# Artifacts are stored once by their hash in a global store shared by all videos,
+# and a manifest in the video directory records which stages its files came from,
+# along with the hashes of files so that they aren't read again until they change.
+# The store is bounded in size by evicting the least recently used artifacts.
+class StageCache:
+  def __init__(self, dir: str, store_dir: Optional[str] = None, max_bytes: Optional[int] = None,
+               enabled: Optional[bool] = None):
+    self.dir = dir
+    self.store_dir = store_dir or config.STAGE_CACHE_DIR
+    self.max_bytes = max_bytes if max_bytes is not None else config.STAGE_CACHE_MAX_BYTES
+    self.enabled = enabled if enabled is not None else config.STAGE_CACHE
+
+    self.manifest_path = dir + "/manifest.json"
+    self._lock = threading.Lock()
+
+  # Returns the key of a stage, or None if caching is disabled.
+  # `inputs` are the paths of the files the stage reads.
+  def key(self, stage: str, inputs: list[str], params: dict) -> Optional[str]:
+    if not self.enabled:
+      return None
+
+    d = {
+      "stage": stage,
+      "inputs": [self.hash(p) for p in inputs],
+      "params": params
+    }
+
+    return hashlib.sha256(json.dumps(d, sort_keys=True).encode()).hexdigest()
+
+  # Restores the artifacts of a stage to `outputs`, if they are all in the store.
+  def get(self, stage: str, key: Optional[str], outputs: list[str]) -> bool:
+    if key is None:
+      return False
+
+    entry_path = self.store_dir + f"/stages/{key}.json"
+
+    try:
+      with open(entry_path, "r") as f:
+        artifacts = json.loads(f.read())["artifacts"]
+    except (OSError, ValueError, KeyError):
+      return False
+
+    names = [os.path.basename(p) for p in outputs]
+    if any(n not in artifacts for n in names):
+      return False
+
+    blobs = [self.blob_path(artifacts[n]) for n in names]
+    if not all(os.path.exists(b) for b in blobs):
+      return False
+
+    try:
+      for blob, dst in zip(blobs, outputs):
+        shutil.copyfile(blob, dst)
+        # Mark as recently used.
+        os.utime(blob)
+    except FileNotFoundError:
+      # Evicted by another process since it was checked.
+      print(f"StageCache: Artifact of '{stage}' was evicted. Treating as a miss.")
+      return False
+
+    def update(manifest: dict):
+      for dst, n in zip(outputs, names):
+        self._remember(manifest, dst, artifacts[n])
+      manifest["stages"][stage] = {"key": key, "artifacts": {n: artifacts[n] for n in names}, "hit": True}
+
+    self._update_manifest(update)
+
+    print(f"StageCache: Hit for '{stage}'.")
+
+    return True
+
+  # Stores `outputs` as the artifacts of a stage.
+  # The stage has already produced its outputs, so failing to cache them is logged rather than raised.
+  def put(self, stage: str, key: Optional[str], outputs: list[str]):
+    if key is None:
+      return
+
+    try:
+      artifacts = {}
+      added = 0
+
+      for src in outputs:
+        h, size = self._store(src)
+        artifacts[os.path.basename(src)] = h
+        added += size
+
+      ensure_dir_exists(self.store_dir + "/stages")
+
+      entry_path = self.store_dir + f"/stages/{key}.json"
+      tmp_path = entry_path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+
+      with open(tmp_path, "w") as f:
+        f.write(json.dumps({"stage": stage, "artifacts": artifacts, "created": time.time()}))
+
+      os.replace(tmp_path, entry_path)
+    except OSError as e:
+      print(f"StageCache: Unable to store artifacts of '{stage}'. {e}")
+      return
+
+    def update(manifest: dict):
+      for src in outputs:
+        self._remember(manifest, src, artifacts[os.path.basename(src)])
+      manifest["stages"][stage] = {"key": key, "artifacts": artifacts, "hit": False}
+
+    self._update_manifest(update)
+
+    # The store is only walked once it may have outgrown its limit.
+    if not _store_sizes.add(self.store_dir, added, self.max_bytes):
+      return
+
+    try:
+      self.evict()
+    except OSError as e:
+      print(f"StageCache: Unable to evict artifacts. {e}")
+
+  # Hash of the file's contents. Hashes are kept in the manifest
+  # and only computed again when the file's size or mtime change.
+  def hash(self, path: str) -> str:
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+
+    with self._lock:
+      f = self._read_manifest()["files"].get(path)
+
+    if f and f["size"] == stat.st_size and f["mtime"] == stat.st_mtime:
+      return f["hash"]
+
+    h = file_hash(path)
+
+    self._update_manifest(lambda manifest: self._remember(manifest, path, h))
+
+    return h
+
+  # Removes the least recently used artifacts until the store fits `max_bytes`.
+  def evict(self):
+    objects_dir = self.store_dir + "/objects"
+    if not os.path.exists(objects_dir):
+      _store_sizes.set(self.store_dir, 0)
+      return
+
+    blobs = []
+    total = 0
+
+    for root, _, files in os.walk(objects_dir):
+      for name in files:
+        path = os.path.join(root, name)
+        try:
+          stat = os.stat(path)
+        except FileNotFoundError:
+          continue
+
+        blobs.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+
+    if total <= self.max_bytes:
+      _store_sizes.set(self.store_dir, total)
+      return
+
+    blobs.sort()
+
+    evicted = set()
+    for _, size, path in blobs:
+      if total <= self.max_bytes:
+        break
+
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+
+      total -= size
+      evicted.add(os.path.basename(path))
+
+    _store_sizes.set(self.store_dir, total)
+
+    removed = self._remove_entries(evicted)
+
+    print(f"StageCache: Evicted {len(evicted)} artifacts and {removed} stages. Store size: {total} bytes.")
+
+  # Removes the entries of stages with any of the artifacts `evicted`, returning how many were removed.
+  def _remove_entries(self, evicted: set[str]) -> int:
+    stages_dir = self.store_dir + "/stages"
+    if not evicted or not os.path.exists(stages_dir):
+      return 0
+
+    removed = 0
+
+    for name in os.listdir(stages_dir):
+      if not name.endswith(".json"):
+        continue
+
+      path = os.path.join(stages_dir, name)
+
+      try:
+        with open(path, "r") as f:
+          artifacts = json.loads(f.read())["artifacts"]
+      except FileNotFoundError:
+        continue
+      except (OSError, ValueError, KeyError):
+        # Unreadable entries are never hits either.
+        artifacts = None
+
+      if artifacts is not None and not evicted.intersection(artifacts.values()):
+        continue
+
+      try:
+        os.remove(path)
+        removed += 1
+      except FileNotFoundError:
+        pass
+
+    return removed
+
+  def blob_path(self, h: str) -> str:
+    return self.store_dir + f"/objects/{h[:2]}/{h}"
+
+  # Copies the file into the store, returning its hash and the number of bytes added to the store.
+  def _store(self, src: str) -> tuple[str, int]:
+    ensure_dir_exists(self.store_dir + "/objects")
+
+    tmp_path = self.store_dir + f"/objects/.{os.getpid()}.{threading.get_ident()}.tmp"
+    sha = hashlib.sha256()
+
+    with open(src, "rb") as fi, open(tmp_path, "wb") as fo:
+      while chunk := fi.read(CHUNK_SIZE):
+        sha.update(chunk)
+        fo.write(chunk)
+
+    h = sha.hexdigest()
+    blob = self.blob_path(h)
+
+    if os.path.exists(blob):
+      os.remove(tmp_path)
+      os.utime(blob)
+      return h, 0
+
+    size = os.path.getsize(tmp_path)
+
+    ensure_dir_exists(os.path.dirname(blob))
+    os.replace(tmp_path, blob)
+
+    return h, size
+
+  def _remember(self, manifest: dict, path: str, h: str):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    manifest["files"][path] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": h}
+
+  # Holds the manifest for a read-modify-write. Clips of a video are generated by several
+  # processes at once, so the manifest is locked across them as well as across threads.
+  @contextmanager
+  def _manifest_lock(self):
+    with self._lock, open(self.manifest_path + ".lock", "a") as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+  # Applies `update` to the manifest. The manifest only saves hashing files again and records
+  # where they came from, so failing to update it is logged rather than failing the stage.
+  def _update_manifest(self, update: Callable[[dict], None]):
+    try:
+      with self._manifest_lock():
+        manifest = self._read_manifest()
+        update(manifest)
+        self._write_manifest(manifest)
+    except OSError as e:
+      print(f"StageCache: Unable to update manifest. {e}")
+
+  def _read_manifest(self) -> dict:
+    try:
+      with open(self.manifest_path, "r") as f:
+        manifest = json.loads(f.read())
+    except (OSError, ValueError):
+      manifest = {}
+
+    manifest.setdefault("stages", {})
+    manifest.setdefault("files", {})
+
+    return manifest
+
+  def _write_manifest(self, manifest: dict):
+    tmp_path = self.manifest_path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+
+    with open(tmp_path, "w") as f:
+      f.write(json.dumps(manifest))
+
+    os.replace(tmp_path, self.manifest_path)
+
+
+def file_hash(path: str) -> str:
+  sha = hashlib.sha256()
+
+  with open(path, "rb") as f:
+    while chunk := f.read(CHUNK_SIZE):
+      sha.update(chunk)
+
+  return sha.hexdigest()
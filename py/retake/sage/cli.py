@@ -11,6 +11,8 @@ parser.add_argument("-id", required=True)
 parser.add_argument("-vf", "--video-file")
 parser.add_argument("-vt", "--video-title")
 parser.add_argument("-a", "--action")
+parser.add_argument("-w", "--workers", type=int)
+parser.add_argument("--fresh", action="store_true")
 
 args = vars(parser.parse_args())
 
@@ -32,7 +34,7 @@ if args["id"]:
             transcribe_video(args["id"], args["video_file"])
         case "highlight":
             from .core import get_highlights
-            get_highlights(args["id"], args["video_title"])
+            get_highlights(args["id"], args["video_title"], fresh=args["fresh"])
         case "clip":
             from retake.sage.core import generate_clips
-            generate_clips(args["id"])
+            generate_clips(args["id"], workers=args["workers"])
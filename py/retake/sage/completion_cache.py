@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import time
+
+from typing import Optional
+
+from retake.sage import config
+from retake.sage.utils import ensure_dir_exists, SizeEstimates
+
+# Number of entries written between walks of the cache, which count those written by other
+# processes and remove expired entries.
+EVICT_INTERVAL = 1000
+
+_sizes = SizeEstimates(EVICT_INTERVAL)
+
+
+# Disk cache of LLM completions, keyed by the model, the messages sent and the prompt version.
+# Entries expire after `ttl` seconds, and the least recently used entries are evicted
+# once the cache exceeds `max_bytes`. With `bypass` set, lookups always miss
+# so that completions are requested again, and their results replace cached ones.
+class CompletionCache:
+  def __init__(self, dir: Optional[str] = None, ttl: Optional[float] = None,
+               max_bytes: Optional[int] = None, bypass: Optional[bool] = None,
+               enabled: Optional[bool] = None):
+    self.dir = dir or config.COMPLETION_CACHE_DIR
+    self.ttl = ttl if ttl is not None else config.COMPLETION_CACHE_TTL
+    self.max_bytes = max_bytes if max_bytes is not None else config.COMPLETION_CACHE_MAX_BYTES
+    self.bypass = bypass if bypass is not None else config.COMPLETION_CACHE_BYPASS
+    self.enabled = enabled if enabled is not None else config.COMPLETION_CACHE
+
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, model: str, messages: list[dict], prompt_version: int) -> str:
+    d = {"model": model, "messages": messages, "prompt_version": prompt_version}
+    return hashlib.sha256(json.dumps(d, sort_keys=True).encode()).hexdigest()
+
+  def get(self, key: str) -> Optional[str]:
+    if not self.enabled or self.bypass:
+      self.misses += 1
+      return None
+
+    path = self.path(key)
+
+    # Entries can be unreadable, or removed by another process at any point. Either way they're a miss.
+    try:
+      with open(path, "r") as f:
+        entry = json.loads(f.read())
+
+      if time.time() - entry["created"] > self.ttl:
+        remove(path)
+        self.misses += 1
+        return None
+
+      # Mark as recently used.
+      os.utime(path)
+      content = entry["content"]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+      if not isinstance(e, FileNotFoundError):
+        print(f"CompletionCache: Unable to read entry. {e}")
+      self.misses += 1
+      return None
+
+    self.hits += 1
+
+    return content
+
+  # The completion has already been paid for, so failing to cache it is logged rather than raised.
+  def put(self, key: str, content: str):
+    if not self.enabled:
+      return
+
+    path = self.path(key)
+
+    try:
+      ensure_dir_exists(os.path.dirname(path))
+
+      tmp_path = path + f".{os.getpid()}.tmp"
+
+      with open(tmp_path, "w") as f:
+        f.write(json.dumps({"created": time.time(), "content": content}))
+        size = f.tell()
+
+      os.replace(tmp_path, path)
+
+      # The cache is only walked once it may have outgrown its limit.
+      if _sizes.add(self.dir, size, self.max_bytes):
+        self.evict()
+    except OSError as e:
+      print(f"CompletionCache: Unable to store entry. {e}")
+
+  # Removes expired entries, then the least recently used ones until the cache fits `max_bytes`.
+  def evict(self):
+    entries = []
+    total = 0
+    now = time.time()
+
+    for root, _, files in os.walk(self.dir):
+      for name in files:
+        path = os.path.join(root, name)
+        try:
+          stat = os.stat(path)
+        except FileNotFoundError:
+          continue
+
+        # Entries are written before they are last used, so those unused for `ttl` have expired.
+        if now - stat.st_mtime > self.ttl:
+          remove(path)
+          continue
+
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+
+    if total > self.max_bytes:
+      entries.sort()
+
+      for _, size, path in entries:
+        if total <= self.max_bytes:
+          break
+
+        remove(path)
+        total -= size
+
+    _sizes.set(self.dir, total)
+
+  def path(self, key: str) -> str:
+    return self.dir + f"/{key[:2]}/{key}.json"
+
+  def stats(self) -> str:
+    lookups = self.hits + self.misses
+    rate = self.hits / lookups if lookups else 0.0
+    return f"{self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)"
+
+
+def remove(path: str):
+  try:
+    os.remove(path)
+  except FileNotFoundError:
+    pass
@@ -11,20 +11,96 @@ DEBUG = os.getenv("DEBUG", False)
 
 FACE_DETECTION_MODEL = "Facenet"
 FACE_DETECTION_METHOD = "mtcnn"
+# Backend used to find faces in sampled frames: "deepface", "yunet" or "haar".
+# The "deepface" backend detects with FACE_DETECTION_METHOD.
+FACE_DETECTOR = os.getenv("FACE_DETECTOR", "deepface")
+# Max size in pixels of the longer side of frames that faces are detected on.
+# Larger frames are downscaled for detection. Set to 0 to detect at full resolution.
+FACE_DETECTION_SIZE = int(os.getenv("FACE_DETECTION_SIZE", 720))
+# Seconds between frames sampled for face tracking.
+FACE_SAMPLE_INTERVAL = float(os.getenv("FACE_SAMPLE_INTERVAL", 1.0))
+# Max number of decoded frames waiting to be processed.
+FACE_SAMPLE_QUEUE_SIZE = int(os.getenv("FACE_SAMPLE_QUEUE_SIZE", 8))
+# Number of sampled frames to run face detection and embedding on at once.
+FACE_BATCH_SIZE = int(os.getenv("FACE_BATCH_SIZE", 8))
+# Min overlap for a face to be matched to its box in the previous sample.
+FACE_TRACK_IOU_THRESHOLD = float(os.getenv("FACE_TRACK_IOU_THRESHOLD", 0.5))
+# Number of samples after which a tracked face is embedded again to verify its identity.
+# A value of 1 embeds every face on every sample.
+FACE_TRACK_REVERIFY_INTERVAL = int(os.getenv("FACE_TRACK_REVERIFY_INTERVAL", 10))
+# Whether clip results carry face tracks compressed to keyframes, rather than every box of every sample.
+FACE_TRACK_COMPRESSION = os.getenv("FACE_TRACK_COMPRESSION", "true").lower() == "true"
+# Max error in pixels of boxes interpolated between keyframes. 0 is lossless.
+FACE_TRACK_COMPRESSION_TOLERANCE = float(os.getenv("FACE_TRACK_COMPRESSION_TOLERANCE", 2.0))
+
+# How clips are rendered from their timeranges.
+# "fast" stream copies whole GOPs and only re-encodes the edges of each timerange,
+# falling back to "single" on failure.
+# "single" encodes the clip in one ffmpeg process, falling back to "multi" on failure.
+# "multi" trims each timerange to its own file before merging them.
+CLIP_RENDERER = os.getenv("CLIP_RENDERER", "single")
+# Number of segments processed at once by `generate_clips`.
+CLIP_WORKERS = int(os.getenv("CLIP_WORKERS", 1))
 
 USE_S3_STORE = not IS_DEV
 S3_VIDEOS = os.getenv("S3_VIDEOS_NAME", "")
 
 BASE_DIR = os.getenv("BASE_DIR", os.path.dirname(__file__) + "/runtime")
 VIDEO_DIR = BASE_DIR + "/videos"
+MODEL_DIR = BASE_DIR + "/models"
+
+# Artifacts of pipeline stages are cached by the hashes of their inputs and parameters,
+# so that processing the same video again doesn't recompute them.
+STAGE_CACHE = os.getenv("STAGE_CACHE", "true").lower() == "true"
+STAGE_CACHE_DIR = os.getenv("STAGE_CACHE_DIR", BASE_DIR + "/stages")
+# The least recently used artifacts are evicted once the cache exceeds this size.
+STAGE_CACHE_MAX_BYTES = int(os.getenv("STAGE_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+
+FACE_DETECTOR_YUNET_MODEL = os.getenv("FACE_DETECTOR_YUNET_MODEL", MODEL_DIR + "/face_detection_yunet_2023mar.onnx")
 
 WHISPERX_MODEL = os.getenv("WHISPERX_MODEL", "large-v2")
 WHISPERX_BATCH_SIZE = int(os.getenv("WHISPERX_BATCH_SIZE", 16))
 WHISPERX_COMPUTE_TYPE = os.getenv("WHISPERX_COMPUTE_TYPE", "float16")
+# Align models of recently seen languages are kept loaded up to this combined size.
+SPEECH_ALIGN_CACHE_BYTES = int(os.getenv("SPEECH_ALIGN_CACHE_BYTES", 3 * 1024 ** 3))
+# Run speaker diarization alongside transcription and alignment rather than after them.
+SPEECH_CONCURRENT_DIARIZATION = os.getenv("SPEECH_CONCURRENT_DIARIZATION", "true").lower() == "true"
+# Audio longer than this many seconds is transcribed in chunks of at most this length,
+# split at silences. Finished chunks are saved, so that restarted jobs resume from them.
+# Set to 0 to always transcribe in one go.
+SPEECH_CHUNK_LENGTH = float(os.getenv("SPEECH_CHUNK_LENGTH", 1800))
+# Stretches without speech, such as silences, music or intros, of at least this many seconds are cut
+# from the audio before transcription, alignment and diarization. 0 processes all of the audio.
+# Off by default until checked against real recordings with `bench speech_regions`.
+SPEECH_VAD_MIN_SILENCE = float(os.getenv("SPEECH_VAD_MIN_SILENCE", 0))
+# Audio is decoded into memory for transcription. Set to also save it as audio.wav.
+SAVE_AUDIO = os.getenv("SAVE_AUDIO", "false").lower() == "true"
 
 HUGGINGFACE_TOKEN = os.getenv("HUGGINGFACE_TOKEN")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Alternative endpoint for the OpenAI API, e.g. a local mock server.
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE")
+
+# Completions of highlight prompts are cached on disk, so that reruns don't request them again.
+COMPLETION_CACHE = os.getenv("COMPLETION_CACHE", "true").lower() == "true"
+COMPLETION_CACHE_DIR = os.getenv("COMPLETION_CACHE_DIR", BASE_DIR + "/completions")
+# Seconds after which cached completions expire.
+COMPLETION_CACHE_TTL = float(os.getenv("COMPLETION_CACHE_TTL", 30 * 24 * 60 * 60))
+COMPLETION_CACHE_MAX_BYTES = int(os.getenv("COMPLETION_CACHE_MAX_BYTES", 100 * 1024 ** 2))
+# Set to always request fresh completions, replacing cached ones.
+COMPLETION_CACHE_BYPASS = os.getenv("COMPLETION_CACHE_BYPASS", "false").lower() == "true"
+
+# Max tokens of transcript in each section that highlights are extracted from.
+HIGHLIGHTS_SECTION_TOKENS = int(os.getenv("HIGHLIGHTS_SECTION_TOKENS", 2500))
+# Max tokens of the end of a section that are repeated at the start of the next, for context.
+HIGHLIGHTS_SECTION_OVERLAP_TOKENS = int(os.getenv("HIGHLIGHTS_SECTION_OVERLAP_TOKENS", 100))
+# Number of transcript sections that highlights are extracted from at once.
+HIGHLIGHTS_CONCURRENCY = int(os.getenv("HIGHLIGHTS_CONCURRENCY", 4))
+# Max tokens sent to and expected from the OpenAI API per minute, across all requests.
+HIGHLIGHTS_TOKENS_PER_MINUTE = int(os.getenv("HIGHLIGHTS_TOKENS_PER_MINUTE", 90000))
+# Number of times a failed completion request is retried, with exponential backoff.
+HIGHLIGHTS_MAX_RETRIES = int(os.getenv("HIGHLIGHTS_MAX_RETRIES", 5))
 
 
 def CUDA_AVAILABLE():
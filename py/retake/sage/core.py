@@ -1,6 +1,5 @@
 import os
 import tensorflow as tf
-import time
 
 from typing import cast, Optional
 
@@ -14,210 +13,111 @@ ensure_dir_exists(config.BASE_DIR)
 ensure_dir_exists(config.VIDEO_DIR)
 
 
-def transcribe_video(id: str, src: str):
-    from . import audio, speech
+def transcribe_video(id: str, src: str, save_audio: Optional[bool] = None):
+    from . import speech
+    from .cache import StageCache
 
     print(f"transcribe_video: Starting for video '{id}'.")
 
     dir = config.VIDEO_DIR + f"/{id}"
     audio_path = dir + "/audio.wav"
 
-    audio.extract_from_video(src, audio_path)
-    print(f"transcribe_video: Extracted audio to {audio_path}.")
+    speech_data_out = dir + "/speech_data.json"
+    transcript_out = dir + "/transcript.srt"
 
-    result = speech.transcribe(id, audio_path)
+    cache = StageCache(dir)
+    key = cache.key("transcribe", [src], {
+        "model": config.WHISPERX_MODEL,
+        "batch_size": config.WHISPERX_BATCH_SIZE,
+        "compute_type": config.WHISPERX_COMPUTE_TYPE,
+        "diarize": not config.IS_DEV,
+        "chunk_length": config.SPEECH_CHUNK_LENGTH,
+        "vad_min_silence": config.SPEECH_VAD_MIN_SILENCE,
+        "vad": "whisperx"
+    })
 
-    print(f"transcribe_video: Done.")
+    if cache.get("transcribe", key, [speech_data_out, transcript_out]):
+        from json import loads
+        from .s3 import upload_file
 
-    return result
+        upload_file(speech_data_out, config.S3_VIDEOS, speech_data_out.lstrip(config.BASE_DIR), "application/json")
+        upload_file(transcript_out, config.S3_VIDEOS, transcript_out.lstrip(config.BASE_DIR), "text/plain")
 
+        print(f"transcribe_video: Done. Restored from cache.")
 
-def get_highlights(video_id: str, video_title: str, transcript_path: Optional[str] = None):
-  import openai
-  from .s3 import upload_file
-
-  print(f"get_highlights: Starting for video '{video_id}'.")
-
-  transcript = ""
-
-  if not video_title:
-    video_title = video_id
+        with open(speech_data_out, "r") as f:
+            return loads(f.read())
 
-  if not transcript_path:
-    transcript_path = config.VIDEO_DIR + f"/{video_id}/transcript.srt"
+    if save_audio is None:
+        save_audio = config.SAVE_AUDIO
 
-  with open(transcript_path, "r") as f:
-    transcript = f.read()
+    # Decoded by `transcribe`, so that the full audio is let go of once cut down to its speech.
+    result = speech.transcribe(id, src, audio_path if save_audio else None)
 
-  MAX_SECTION_CHAR_COUNT = 2500 * 4
-  MAX_PREPEND_CHAR_COUNT = 100 * 4
+    cache.put("transcribe", key, [speech_data_out, transcript_out])
 
-  sections = []
-
-  lines = transcript.splitlines()
-  sentences = lines[2::4]
-
-  print(f"Found {len(sentences)} sentences.")
-
-  section: list[tuple[str, str]] = []
-  section_char_count = 0
+    print(f"transcribe_video: Done.")
 
-  for i, l in enumerate(sentences):
-    section.append((lines[(i*4)+1], l))
-    section_char_count += len(l)
+    return result
 
-    if i == len(sentences) - 1: # Last line
-      sections.append(section)
-      print(f"get_highlights: Created section. Lines: {len(section)}, Chars: {section_char_count}.")
 
-      section = []
-      section_char_count = 0
-      break
+# With `fresh` set, highlights are extracted again rather than reused from the caches.
+def get_highlights(video_id: str, video_title: str, speech_data_path: Optional[str] = None, fresh: bool = False):
+  from .cache import StageCache
+  from . import sectioner, transcript
+  from .highlights import extract_highlights, MODEL, PROMPT_VERSION
+  from .s3 import upload_file
 
-    next_len = len(sentences[i+1])
+  print(f"get_highlights: Starting for video '{video_id}'.")
 
-    # Adding the next line would exceed max char count for section.
-    if section_char_count + next_len > MAX_SECTION_CHAR_COUNT:
-        prepend_lines = []
-        prepend_lines_char_count = 0
+  # Bypassing the completion cache would be moot if highlights were restored from the stage cache.
+  fresh = fresh or config.COMPLETION_CACHE_BYPASS
 
-        # Prepend up to x lines from current section to next,
-        # starting from the last.
-        for ll in section[-3:][::-1]:
-           ll_char_count = len(ll)
+  if not video_title:
+    video_title = video_id
 
-           if prepend_lines_char_count + ll_char_count > MAX_PREPEND_CHAR_COUNT:
-              break
-           
-           prepend_lines.append(ll)
-           prepend_lines_char_count += ll_char_count
+  if not speech_data_path:
+    speech_data_path = config.VIDEO_DIR + f"/{video_id}/speech_data.json"
 
-        # Undo reversing to correct the sentence order.
-        prepend_lines = prepend_lines[::-1]
+  highlights_out = config.VIDEO_DIR + f"/{video_id}/highlights.json"
 
-        # Finalise current section.
-        sections.append(section)
+  cache = StageCache(config.VIDEO_DIR + f"/{video_id}")
+  key = cache.key("highlights", [speech_data_path], {
+    "model": MODEL,
+    "prompt_version": PROMPT_VERSION,
+    "section_tokens": config.HIGHLIGHTS_SECTION_TOKENS,
+    "section_overlap_tokens": config.HIGHLIGHTS_SECTION_OVERLAP_TOKENS,
+    # Sections split on estimated token counts may not fit the budget, so they aren't reused once
+    # the tokenizer is available.
+    "exact_tokens": sectioner.token_counter(MODEL).exact,
+    "title": video_title
+  })
 
-        print(f"get_highlights: Created segment. Lines: {len(section)}, Chars: {section_char_count}.")
+  if not fresh and cache.get("highlights", key, [highlights_out]):
+    from json import loads
 
-        section = prepend_lines
-        section_char_count = prepend_lines_char_count
+    upload_file(highlights_out, config.S3_VIDEOS, highlights_out.lstrip(config.BASE_DIR), "application/json")
 
-  openai.api_key = config.OPENAI_API_KEY
+    print(f"get_highlights: Done. Restored from cache.")
 
-  highlights: list[Segment] = []
+    with open(highlights_out, "r") as f:
+      return [Segment.from_dict(h) for h in loads(f.read())]
 
-  for i, s in enumerate(sections):
-    content = ""
-    
-    for line in s:
-      content += f"{line[0]}: {line[1]}\n"
+  t = transcript.load(speech_data_path)
 
-    total_tries = 3
-    tries_left = total_tries
+  print(f"Found {len(t)} sentences.")
 
-    while True:
-      if tries_left == 0: break
-      tries_left -= 1
+  sections = sectioner.split(t.lines(), config.HIGHLIGHTS_SECTION_TOKENS,
+                             config.HIGHLIGHTS_SECTION_OVERLAP_TOKENS, model=MODEL)
 
-      print(f"get_highlights: Extracting highlights ({i+1}/{len(sections)}). Attempt: {total_tries-tries_left}.")
+  contents = [sectioner.render(s) for s in sections]
 
-      try:
-        completion = openai.ChatCompletion.create(model="gpt-3.5-turbo", messages=[
-          {
-              "role": "system",
-              # "content": "Given the transcript of a podcast/interview, identify the most interesting segment, summarise it, and return the time range(s) at which it is being discussed (in the format \"from --> to\"). The segment should be fully coherent on its own, without requiring the full context of the discussion."
-              "content": "Given the transcript of a podcast/interview, identify the most interesting segments, briefly summarise them, and return the timestamps at which they're being discussed (in the format \"from --> to\"). Joining the segments should form a concise clip."
-          },
-          {
-              "role": "user",
-              "content": content
-          }
-        ])
-
-        result = cast(dict, completion)["choices"][0]["message"]["content"]
-
-        import re
-        matches = re.findall(r"(\d+\.\d+)\s*-->\s*(\d+\.\d+)", result)
-
-        if len(matches) <= 0:
-          matches = re.findall(r"(\d+\.\d+)\s*to\s*(\d+\.\d+)", result)
-
-        print(f"Timerange matches: {matches}")
-
-        if len(matches) <= 0:
-          print(f"No matches. Retrying.")
-          continue
-
-        timeranges: list[tuple[float, float]] = []
-        last_end = None
-        total_length = 0
-
-        for m in matches:
-          start = float(m[0])
-          end = float(m[1])
-
-          invalid_timerange = False
-          if end <= start:
-            print("get_highlights: End timestamp is lower than start.")
-            invalid_timerange = True
-
-          if last_end and last_end > start:
-            print("get_highlights: Timerange preceeds last.")
-            invalid_timerange = True
-
-          if invalid_timerange:
-            print("Find completion result below:")
-            print(result)
-            break
-
-          print(f"get_highlights: Found highlight. Start: {start}, End: {end}.")
-
-          total_length += (end - start)
-
-          if last_end == start:
-            # Extend end time of last segment.
-            timeranges[-1] = (timeranges[-1][0], end)
-          else:
-            timeranges.append((start, end))
-
-          last_end = end
-
-        if total_length < 15:
-          print(f"get_highlights: Highlight too short ({int(total_length)} seconds). Trying again.")
-          continue
-
-        if total_length > 120:
-          print(f"get_highlights: Highlight too long ({int(total_length)} seconds). Trying again.")
-          continue
-
-        completion = openai.ChatCompletion.create(model="gpt-3.5-turbo", messages=[
-          {
-              "role": "assistant",
-              "content": result
-          },
-          {
-              "role": "user",
-              "content": f"Write an informal and catchy intro (under 80 characters) summarising the above segment.\nFull video: {video_title}"
-          }
-        ])
-
-        title = cast(dict, completion)["choices"][0]["message"]["content"]
-        title = title.replace('"', '')
-        # Hashtags are sometimes returned in the response. Remove them.
-        title = re.sub(r"#[\S]+", '', title).strip()
-
-        h = Segment(title, round(total_length, 2), timeranges)
-        highlights.append(h)
-
-        print(f"get_highlights: Built highlight '{title}'.")
-
-        break
-      except Exception as e:
-        print(f"Error getting completion. {e}")
-        time.sleep(3)
+  counter = sectioner.token_counter(MODEL)
+  for s in sections:
+    tokens = sum(counter.count_all([sectioner.render_line(l) for l in s]))
+    print(f"get_highlights: Created section. Lines: {len(s)}, Tokens: {tokens}.")
 
-  highlights_out = config.VIDEO_DIR + f"/{video_id}/highlights.json"
+  highlights = extract_highlights(contents, video_title, fresh=fresh)
 
   with open(highlights_out, "w") as f:
     from dataclasses import asdict
@@ -232,15 +132,19 @@ def get_highlights(video_id: str, video_title: str, transcript_path: Optional[st
 
   upload_file(highlights_out, config.S3_VIDEOS, highlights_out.lstrip(config.BASE_DIR), "application/json")
   print(f"get_highlights: Uploaded highlights to S3.")
+
+  # Nothing worth reusing if every extraction failed.
+  if highlights:
+    cache.put("highlights", key, [highlights_out])
   
   print(f"get_highlights: Done.")
 
   return highlights
 
 
-def generate_clips(id: str, segments: Optional[list[Segment]] = None):
+def generate_clips(id: str, segments: Optional[list[Segment]] = None, workers: Optional[int] = None):
   from . import video
-  from .s3 import upload_file
+  from .cache import StageCache
 
   print(f"generate_clips: Starting for video '{id}'.")
 
@@ -271,52 +175,228 @@ def generate_clips(id: str, segments: Optional[list[Segment]] = None):
   if len(segments) > 1:
     print(f"generate_clips: Found {len(segments)} segments.")
 
-  for s in segments:
-    clips = []
-    clip_id = 0
+  source = video.from_source(video_path)
 
-    for ts in s.timeranges:
-      start, end = ts[0], ts[1]
-      out_path = video_dir + f"/trimmed_{round(start*1000)}-{round(end*1000)}{video_ext}"
-      video.trim(video_path, out_path, start, end)
-      clips.append(out_path)
-      clip_id += int(start + end)
+  cache = StageCache(video_dir)
+  # Hashed upfront, as segments would otherwise all hash the source at once.
+  if cache.enabled:
+    cache.hash(video_path)
 
-    clip_out = video_dir + f"/clip_{clip_id}{video_ext}"
-    video.merge_all(clips, clip_out)
+  # Indexed once upfront, as workers would otherwise all probe the source.
+  index = None
+  if config.CLIP_RENDERER == "fast":
+    try:
+      index = video.keyframe_index(video_path)
+    except Exception as e:
+      print(f"generate_clips: Unable to index keyframes. {e}")
 
-    print(f"generate_clips: Merged {len(clips)} clips. ID: {clip_id}.")
+  workers = max(1, min(workers or config.CLIP_WORKERS, len(segments)))
+  failed = []
 
-    upload_file(clip_out, config.S3_VIDEOS, clip_out.lstrip(config.BASE_DIR), "video/mp4")
-    print(f"generate_clips: Uploaded clip to S3.")
+  if workers == 1:
+    for s in segments:
+      try:
+        process_clip(s, video_path, video_dir, cast(str, video_ext), source, index, cache)
+      except Exception as e:
+        print(f"generate_clips: Failed to generate clip '{clip_id(s)}'. {e}")
+        failed.append(clip_id(s))
+  else:
+    import multiprocessing
+
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    print(f"generate_clips: Processing segments with {workers} workers.")
+
+    # Rendering and face tracking run in worker processes, while uploads run on threads.
+    # Each segment is driven by its own thread, which hands its work to the pools.
+    # Workers are spawned rather than forked, as TensorFlow is already initialised in this process.
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as procs, \
+         ThreadPoolExecutor(workers) as uploads, \
+         ThreadPoolExecutor(workers) as jobs:
+      futures = [
+        (s, jobs.submit(process_clip, s, video_path, video_dir, cast(str, video_ext), source, index, cache, procs, uploads))
+        for s in segments
+      ]
+
+      for s, f in futures:
+        try:
+          f.result()
+        except Exception as e:
+          print(f"generate_clips: Failed to generate clip '{clip_id(s)}'. {e}")
+          failed.append(clip_id(s))
+
+  if failed:
+    raise Exception(f"Failed to generate {len(failed)} of {len(segments)} clips: {', '.join(str(c) for c in failed)}.")
+
+  print(f"generate_clips: Done.")
+
+
+def clip_id(segment: Segment) -> int:
+  id = 0
+  for ts in segment.timeranges:
+    id += int(ts[0] + ts[1])
+  return id
+
+
+# Parameters that a clip's artifacts depend on, besides the source video.
+def clip_params(s: Segment) -> dict:
+  return {
+    "timeranges": [list(ts) for ts in s.timeranges],
+    "renderer": config.CLIP_RENDERER,
+    "preview_size": 480,
+    "model": config.FACE_DETECTION_MODEL,
+    "detector": config.FACE_DETECTOR,
+    "detection_method": config.FACE_DETECTION_METHOD,
+    "detection_size": config.FACE_DETECTION_SIZE,
+    "sample_interval": config.FACE_SAMPLE_INTERVAL,
+    "track_iou_threshold": config.FACE_TRACK_IOU_THRESHOLD,
+    "track_reverify_interval": config.FACE_TRACK_REVERIFY_INTERVAL
+  }
+
+
+# Paths of the clip, its preview and its frame data.
+def clip_paths(video_dir: str, id: int, video_ext: str) -> tuple[str, str, str]:
+  return (
+    video_dir + f"/clip_{id}{video_ext}",
+    video_dir + f"/clip_{id}_preview{video_ext}",
+    video_dir + f"/clip_{id}.json"
+  )
+
+
+# Path of the frame data of the clip in the binary track format.
+def clip_tracks_path(video_dir: str, id: int) -> str:
+  return video_dir + f"/clip_{id}.tracks"
+
+
+# Renders, tracks and uploads the clip of a segment.
+# Without pools, all of the work is done in the calling thread.
+def process_clip(s: Segment, video_path: str, video_dir: str, video_ext: str, source, index=None,
+                 cache=None, procs=None, uploads=None):
+  from .s3 import upload_file
 
-    # [os.remove(c) for c in clips]
+  def run(fn, *args):
+    return procs.submit(fn, *args).result() if procs else fn(*args)
 
-    v = video.from_source(clip_out)
-    face_data = video.track_faces(v)
+  pending = []
 
-    print(f"generate_clips: Done tracking faces for clip '{clip_id}'.")
+  def upload(path: str, content_type: str):
+    if uploads:
+      pending.append(uploads.submit(upload_file, path, config.S3_VIDEOS, path.lstrip(config.BASE_DIR), content_type))
+    else:
+      upload_file(path, config.S3_VIDEOS, path.lstrip(config.BASE_DIR), content_type)
 
-    preview_out = video_dir + f"/clip_{clip_id}_preview{video_ext}"
-    video.downscale(v, preview_out, 480)
+  id = clip_id(s)
+  clip_out, preview_out, frame_data_out = clip_paths(video_dir, id, video_ext)
+  outputs = [clip_out, preview_out, frame_data_out, clip_tracks_path(video_dir, id)]
+
+  stage = f"clip_{id}"
+  key = cache.key(stage, [video_path], clip_params(s)) if cache else None
+
+  if cache and cache.get(stage, key, outputs):
+    print(f"generate_clips: Restored clip '{id}' from cache.")
+
+    upload(clip_out, "video/mp4")
+    upload(preview_out, "video/mp4")
+    upload(frame_data_out, "application/json")
 
-    print(f"generate_clips: Saved clip preview to {preview_out}.")
+    for f in pending:
+      f.result()
 
-    upload_file(preview_out, config.S3_VIDEOS, preview_out.lstrip(config.BASE_DIR), "video/mp4")
-    print(f"generate_clips: Uploaded clip preview to S3.")
+    return
 
-    frame_data_out = video_dir + f"/clip_{clip_id}.json"
+  v = run(render_clip, s, video_path, video_dir, video_ext, source, index)
 
-    with open(frame_data_out, "w") as f:
-      from dataclasses import asdict
-      from json import dumps
+  upload(clip_out, "video/mp4")
+  print(f"generate_clips: Uploaded clip to S3.")
 
-      d = []
-      for fd in face_data:
-        d.append(asdict(fd))
+  run(track_clip, id, video_dir, video_ext, v)
 
-      f.write(dumps(d))
-      f.flush()
+  upload(preview_out, "video/mp4")
+  print(f"generate_clips: Uploaded clip preview to S3.")
+
+  upload(frame_data_out, "application/json")
+  print(f"generate_clips: Uploaded frame data to S3.")
+
+  for f in pending:
+    f.result()
+
+  if cache:
+    cache.put(stage, key, outputs)
+
+
+# Returns the metadata of the clip if its preview was rendered along with it.
+def render_clip(s: Segment, video_path: str, video_dir: str, video_ext: str, source, index=None):
+  from . import video
+
+  id = clip_id(s)
+  clip_out, preview_out, _ = clip_paths(video_dir, id, video_ext)
+
+  if config.CLIP_RENDERER == "fast" and index is not None:
+    try:
+      video.render_fast(video_path, clip_out, s.timeranges, index)
+
+      print(f"generate_clips: Rendered {len(s.timeranges)} timeranges using smart cuts. ID: {id}.")
+      return None
+    except Exception as e:
+      print(f"generate_clips: Fast render failed. Falling back to single pass render. {e}")
+
+  if config.CLIP_RENDERER in ["fast", "single"]:
+    try:
+      v = video.render(video_path, clip_out, s.timeranges, preview_out, 480, source)
+
+      print(f"generate_clips: Rendered {len(s.timeranges)} timeranges and preview. ID: {id}.")
+      return v
+    except Exception as e:
+      print(f"generate_clips: Single pass render failed. Falling back to trimming and merging. {e}")
+
+  clips = []
+
+  for ts in s.timeranges:
+    start, end = ts[0], ts[1]
+    out_path = video_dir + f"/trimmed_{round(start*1000)}-{round(end*1000)}{video_ext}"
+    video.trim(video_path, out_path, start, end)
+    clips.append(out_path)
+
+  video.merge_all(clips, clip_out)
+
+  print(f"generate_clips: Merged {len(clips)} clips. ID: {id}.")
+
+  # [os.remove(c) for c in clips]
+
+  return None
+
+
+# Tracks the faces in the clip and saves them as its frame data.
+# The preview is downscaled from the clip, unless `v` says it was rendered already.
+def track_clip(id: int, video_dir: str, video_ext: str, v=None):
+  from . import tracks, video
+
+  clip_out, preview_out, frame_data_out = clip_paths(video_dir, id, video_ext)
+
+  preview_rendered = v is not None
+
+  if v is None:
+    v = video.from_source(clip_out)
+
+  # Frames are written out as they're tracked, so a partial file is left if tracking is interrupted.
+  frames_out = video_dir + f"/clip_{id}.jsonl"
+
+  with tracks.TrackWriter(frames_out) as writer:
+    for fd in video.iter_faces(v):
+      writer.write(fd)
+
+  print(f"generate_clips: Done tracking faces for clip '{id}'.")
+
+  if not preview_rendered:
+    video.downscale(v, preview_out, 480)
+
+  print(f"generate_clips: Saved clip preview to {preview_out}.")
+
+  t = writer.tracks()
+  t.save(clip_tracks_path(video_dir, id))
+
+  with open(frame_data_out, "w") as f:
+    t.write_json(f)
+    f.flush()
 
-    upload_file(frame_data_out, config.S3_VIDEOS, frame_data_out.lstrip(config.BASE_DIR), "application/json")
-    print(f"generate_clips: Uploaded frame data to S3.")
+  os.remove(frames_out)
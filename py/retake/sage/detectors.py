@@ -0,0 +1,180 @@
+import cv2
+import numpy as np
+import os
+
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from retake.sage import config
+
+
+# Detects faces in frames. Faces are returned in the shape of DeepFace's
+# `extract_faces` results, i.e. dicts with a `facial_area` and a `confidence`.
+class FaceDetector(ABC):
+  name = ""
+  # Faces detected with a lower confidence are ignored.
+  min_confidence = 0.0
+  # DeepFace backend that faces are detected with again within their crops, to align them before
+  # they are embedded. "skip" embeds the crops as they are, for detectors that aren't DeepFace's.
+  align_backend = "skip"
+
+  # Returns the faces in the frame, or None where no face was found.
+  @abstractmethod
+  def detect(self, frame: np.ndarray) -> Optional[list[dict]]:
+    pass
+
+  # Frames larger than `max_size` on their longer side are downscaled for detection,
+  # with the facial areas mapped back to the original resolution.
+  def detect_batch(self, frames: list[np.ndarray], max_size: int = 0) -> list[Optional[list[dict]]]:
+    detections = []
+
+    for frame in frames:
+      img, scale = downscale(frame, max_size)
+      faces = self.detect(img)
+
+      if faces and scale != 1.0:
+        for f in faces:
+          f["facial_area"] = rescale(f["facial_area"], scale)
+
+      detections.append(faces)
+
+    return detections
+
+
+class DeepFaceDetector(FaceDetector):
+  min_confidence = 0.98
+
+  def __init__(self, detector_backend: str, face_size: tuple[int, int] = (224, 224)):
+    self.name = f"deepface:{detector_backend}"
+    self.detector_backend = detector_backend
+    self.align_backend = detector_backend
+    self.face_size = face_size
+
+  def detect(self, frame: np.ndarray) -> Optional[list[dict]]:
+    from deepface import DeepFace
+
+    try:
+      return DeepFace.extract_faces(frame, self.face_size, self.detector_backend)
+    except ValueError:
+      return None
+
+
+# OpenCV's DNN based YuNet detector. Runs on CPU without TensorFlow.
+class YuNetDetector(FaceDetector):
+  name = "yunet"
+  min_confidence = 0.9
+
+  MODEL_URL = "https://github.com/opencv/opencv_zoo/raw/main/models/face_detection_yunet/face_detection_yunet_2023mar.onnx"
+
+  def __init__(self, model_path: str):
+    if not os.path.exists(model_path):
+      from urllib.request import urlretrieve
+      from .utils import ensure_dir_exists
+
+      ensure_dir_exists(os.path.dirname(model_path))
+      urlretrieve(self.MODEL_URL, model_path)
+
+    self.model = cv2.FaceDetectorYN.create(model_path, "", (320, 320), self.min_confidence)
+
+  def detect(self, frame: np.ndarray) -> Optional[list[dict]]:
+    h, w = frame.shape[:2]
+    self.model.setInputSize((w, h))
+
+    _, faces = self.model.detect(frame)
+    if faces is None or len(faces) == 0:
+      return None
+
+    boxes = [(clamp(f[0], f[1], f[2], f[3], w, h), float(f[-1])) for f in faces]
+
+    return [face(*box, confidence) for box, confidence in boxes if box[2] > 0 and box[3] > 0] or None
+
+
+# OpenCV's Haar cascade detector. The fastest option, but also the least accurate.
+class HaarDetector(FaceDetector):
+  name = "haar"
+
+  def __init__(self, min_size: int = 40):
+    self.min_size = min_size
+    self.model = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+
+  def detect(self, frame: np.ndarray) -> Optional[list[dict]]:
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    boxes = self.model.detectMultiScale(
+      gray,
+      scaleFactor=1.1,
+      minNeighbors=5,
+      minSize=(self.min_size, self.min_size)
+    )
+
+    if len(boxes) == 0:
+      return None
+
+    # Haar cascades don't score detections.
+    return [face(x, y, w, h, 1.0) for x, y, w, h in boxes]
+
+
+# Builds the detector named by `backend`, e.g. "yunet", "haar" or "deepface".
+# DeepFace detectors can be given as "deepface:<method>", otherwise
+# `config.FACE_DETECTION_METHOD` is used.
+def get_detector(backend: Optional[str] = None) -> FaceDetector:
+  if not backend:
+    backend = config.FACE_DETECTOR
+
+  name, _, option = backend.partition(":")
+
+  match name:
+    case "deepface":
+      return DeepFaceDetector(option or config.FACE_DETECTION_METHOD)
+    case "yunet":
+      return YuNetDetector(option or config.FACE_DETECTOR_YUNET_MODEL)
+    case "haar":
+      return HaarDetector()
+
+  raise Exception(f"Unknown face detector '{backend}'.")
+
+
+def face(x, y, w, h, confidence: float) -> dict:
+  return {
+    "facial_area": {
+      "x": int(x),
+      "y": int(y),
+      "w": int(w),
+      "h": int(h)
+    },
+    "confidence": confidence
+  }
+
+
+# Clips the box to the frame. YuNet reports faces partly outside of the frame with boxes
+# that extend past its edges, which would otherwise crop to nothing.
+def clamp(x, y, w, h, frame_w: int, frame_h: int) -> tuple[int, int, int, int]:
+  x0 = min(max(int(x), 0), frame_w)
+  y0 = min(max(int(y), 0), frame_h)
+  x1 = min(max(int(x + w), 0), frame_w)
+  y1 = min(max(int(y + h), 0), frame_h)
+
+  return x0, y0, x1 - x0, y1 - y0
+
+
+# Shrinks the frame so that its longer side is at most `max_size` pixels.
+# Returns the frame and the factor it was scaled by.
+def downscale(frame: np.ndarray, max_size: int) -> tuple[np.ndarray, float]:
+  h, w = frame.shape[:2]
+
+  if max_size <= 0 or max(w, h) <= max_size:
+    return frame, 1.0
+
+  scale = max_size / max(w, h)
+  size = (max(1, round(w * scale)), max(1, round(h * scale)))
+
+  return cv2.resize(frame, size, interpolation=cv2.INTER_AREA), scale
+
+
+def rescale(area: dict, scale: float) -> dict:
+  return {
+    "x": int(round(area["x"] / scale)),
+    "y": int(round(area["y"] / scale)),
+    "w": int(round(area["w"] / scale)),
+    "h": int(round(area["h"] / scale))
+  }
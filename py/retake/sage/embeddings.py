@@ -0,0 +1,97 @@
+import numpy as np
+
+from typing import Optional, Sequence
+
+
+# Growable matrix of L2-normalised face embeddings with a parallel array of ids.
+# Distances are Euclidean over the normalised vectors (DeepFace's `euclidean_l2`)
+# and are computed against all stored rows in a single batched operation.
+class EmbeddingIndex:
+  def __init__(self, dim: Optional[int] = None, capacity: int = 256):
+    self.dim = dim
+    self.size = 0
+    self._capacity = max(1, capacity)
+    self._embeddings: Optional[np.ndarray] = None
+    self._ids = np.empty(self._capacity, dtype=object)
+
+    if dim is not None:
+      self._embeddings = np.empty((self._capacity, dim), dtype=np.float64)
+
+  def __len__(self):
+    return self.size
+
+  @property
+  def ids(self) -> np.ndarray:
+    return self._ids[:self.size]
+
+  @property
+  def embeddings(self) -> np.ndarray:
+    if self._embeddings is None:
+      return np.empty((0, 0), dtype=np.float64)
+    return self._embeddings[:self.size]
+
+  def add(self, id: str, embedding: Sequence[float]):
+    v = l2_normalize(embedding)
+
+    if self._embeddings is None:
+      self.dim = v.shape[0]
+      self._embeddings = np.empty((self._capacity, self.dim), dtype=np.float64)
+    elif v.shape[0] != self.dim:
+      raise ValueError(f"Expected embedding of size {self.dim}, got {v.shape[0]}.")
+
+    if self.size == self._capacity:
+      self._grow()
+
+    self._embeddings[self.size] = v
+    self._ids[self.size] = id
+    self.size += 1
+
+  def distances(self, embedding: Sequence[float]) -> np.ndarray:
+    if self.size == 0:
+      return np.empty(0, dtype=np.float64)
+
+    diff = self.embeddings - l2_normalize(embedding)
+    return np.sqrt(np.sum(np.multiply(diff, diff), axis=1))
+
+  def query(self, embedding: Sequence[float], threshold: Optional[float] = None,
+            k: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+    # Returns ids and distances of the stored embeddings, closest first,
+    # keeping only those within `threshold` and at most `k` of them.
+    dst = self.distances(embedding)
+    rows = np.arange(dst.shape[0])
+
+    if threshold is not None:
+      rows = rows[dst <= threshold]
+
+    # Stable sort so rows at equal distance keep their insertion order.
+    rows = rows[np.argsort(dst[rows], kind="stable")]
+
+    if k is not None:
+      rows = rows[:k]
+
+    return self.ids[rows], dst[rows]
+
+  def _grow(self):
+    self._capacity *= 2
+
+    embeddings = np.empty((self._capacity, self.dim), dtype=np.float64)
+    embeddings[:self.size] = self.embeddings
+    self._embeddings = embeddings
+
+    ids = np.empty(self._capacity, dtype=object)
+    ids[:self.size] = self.ids
+    self._ids = ids
+
+
+def l2_normalize(x: Sequence[float]) -> np.ndarray:
+  v = np.asarray(x, dtype=np.float64)
+  return v / np.sqrt(np.sum(np.multiply(v, v)))
+
+
+def similarity_confidence(distances: np.ndarray, n: int = 5) -> float:
+  # Confidence is given by how similar the closest `n` matches are.
+  # Fewer than two matches have no deviation, resulting in a confidence of 0.
+  top = distances[:n]
+  if top.shape[0] < 2:
+    return 0.0
+  return float(1 - np.std(top, ddof=1))
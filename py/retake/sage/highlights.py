@@ -0,0 +1,275 @@
+import asyncio
+import openai
+import random
+import re
+import time
+
+from typing import cast, Optional
+
+from retake.sage import config
+from retake.sage.completion_cache import CompletionCache
+from retake.sage.types import Segment
+
+MODEL = "gpt-3.5-turbo"
+# Bump when the prompts change, so that cached highlights are not reused.
+PROMPT_VERSION = 1
+
+# EXTRACT_PROMPT = "Given the transcript of a podcast/interview, identify the most interesting segment, summarise it, and return the time range(s) at which it is being discussed (in the format \"from --> to\"). The segment should be fully coherent on its own, without requiring the full context of the discussion."
+EXTRACT_PROMPT = "Given the transcript of a podcast/interview, identify the most interesting segments, briefly summarise them, and return the timestamps at which they're being discussed (in the format \"from --> to\"). Joining the segments should form a concise clip."
+
+# Tokens reserved for each completion when rate limiting, on top of the prompt.
+COMPLETION_TOKENS = 256
+
+# Errors worth retrying, as they are likely to pass.
+RETRYABLE_ERRORS = (
+  openai.error.APIConnectionError,
+  openai.error.APIError,
+  openai.error.RateLimitError,
+  openai.error.ServiceUnavailableError,
+  openai.error.Timeout,
+  openai.error.TryAgain
+)
+
+
+# Rough token count of text, at about 4 characters per token.
+def estimate_tokens(text: str) -> int:
+  return len(text) // 4 + 1
+
+
+# Token bucket that refills continuously, allowing up to `tokens_per_minute` to be spent per minute.
+class RateLimiter:
+  def __init__(self, tokens_per_minute: int):
+    self.capacity = float(tokens_per_minute)
+    self.rate = tokens_per_minute / 60
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+
+    self._lock = asyncio.Lock()
+
+  async def acquire(self, tokens: int):
+    tokens = min(tokens, int(self.capacity))
+
+    # Held while waiting, so that requests are let through in order.
+    async with self._lock:
+      while True:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= tokens:
+          self.tokens -= tokens
+          return
+
+        await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+# Exponential backoff with full jitter.
+def backoff_delay(attempt: int, base: float = 1.0, max_delay: float = 30.0) -> float:
+  return random.uniform(0, min(max_delay, base * 2 ** attempt))
+
+
+# Extracts a highlight from each section of a transcript, working on several sections at once.
+# Requests are limited to `concurrency` at a time and to `tokens_per_minute`, and failed requests
+# are retried with exponential backoff.
+# Completions are cached, unless `fresh` is set. Retries of a section always request a fresh
+# completion, as the cached one wasn't usable.
+class HighlightExtractor:
+  def __init__(self, video_title: str, concurrency: Optional[int] = None,
+               tokens_per_minute: Optional[int] = None, max_retries: Optional[int] = None,
+               tries: int = 3, api_base: Optional[str] = None, fresh: bool = False,
+               cache: Optional[CompletionCache] = None):
+    self.video_title = video_title
+    self.concurrency = max(1, concurrency or config.HIGHLIGHTS_CONCURRENCY)
+    self.tokens_per_minute = tokens_per_minute or config.HIGHLIGHTS_TOKENS_PER_MINUTE
+    self.max_retries = max_retries if max_retries is not None else config.HIGHLIGHTS_MAX_RETRIES
+    self.tries = tries
+    self.cache = cache or CompletionCache(bypass=True if fresh else None)
+
+    self.options = {}
+    if api_base or config.OPENAI_API_BASE:
+      self.options["api_base"] = api_base or config.OPENAI_API_BASE
+
+    openai.api_key = config.OPENAI_API_KEY
+
+  # Returns the highlights of the sections that produced one, in section order.
+  async def run(self, sections: list[str]) -> list[Segment]:
+    self.limiter = RateLimiter(self.tokens_per_minute)
+    self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    results = await asyncio.gather(*[
+      self.extract(i, len(sections), content) for i, content in enumerate(sections)
+    ])
+
+    print(f"HighlightExtractor: Completion cache: {self.cache.stats()}.")
+
+    return [h for h in results if h is not None]
+
+  # Unless `fresh` is set, a cached completion is returned if there is one.
+  # Requested completions are cached if `store` is set.
+  # Returns the completion and whether it came from the cache.
+  async def complete(self, messages: list[dict], fresh: bool = False, store: bool = True) -> tuple[str, bool]:
+    key = self.cache.key(MODEL, messages, PROMPT_VERSION)
+
+    if not fresh:
+      content = self.cache.get(key)
+      if content is not None:
+        return content, True
+
+    tokens = sum(estimate_tokens(m["content"]) for m in messages) + COMPLETION_TOKENS
+
+    attempt = 0
+    while True:
+      await self.limiter.acquire(tokens)
+
+      try:
+        completion = await openai.ChatCompletion.acreate(model=MODEL, messages=messages, **self.options)
+        content = cast(dict, completion)["choices"][0]["message"]["content"]
+
+        if store:
+          self.cache.put(key, content)
+
+        return content, False
+      except RETRYABLE_ERRORS as e:
+        if attempt >= self.max_retries:
+          raise
+
+        delay = backoff_delay(attempt)
+        attempt += 1
+
+        print(f"HighlightExtractor: {type(e).__name__}. Retrying in {delay:.1f}s. {e}")
+        await asyncio.sleep(delay)
+
+  async def extract(self, i: int, total: int, content: str) -> Optional[Segment]:
+    async with self.semaphore:
+      for attempt in range(1, self.tries + 1):
+        print(f"get_highlights: Extracting highlights ({i+1}/{total}). Attempt: {attempt}.")
+
+        try:
+          h = await self.extract_once(content, fresh=attempt > 1)
+          if h is not None:
+            return h
+        except Exception as e:
+          print(f"Error getting completion. {e}")
+
+    return None
+
+  # Returns None if the completion doesn't describe a usable highlight.
+  async def extract_once(self, content: str, fresh: bool = False) -> Optional[Segment]:
+    messages = [
+      {
+          "role": "system",
+          "content": EXTRACT_PROMPT
+      },
+      {
+          "role": "user",
+          "content": content
+      }
+    ]
+
+    # Only cached once known to be usable, so that later runs don't start from a bad completion.
+    result, cached = await self.complete(messages, fresh, store=False)
+
+    parsed = parse_timeranges(result)
+    if parsed is None:
+      return None
+
+    if not cached:
+      self.cache.put(self.cache.key(MODEL, messages, PROMPT_VERSION), result)
+
+    timeranges, total_length = parsed
+
+    title, _ = await self.complete([
+      {
+          "role": "assistant",
+          "content": result
+      },
+      {
+          "role": "user",
+          "content": f"Write an informal and catchy intro (under 80 characters) summarising the above segment.\nFull video: {self.video_title}"
+      }
+    ], fresh)
+
+    title = title.replace('"', '')
+    # Hashtags are sometimes returned in the response. Remove them.
+    title = re.sub(r"#[\S]+", '', title).strip()
+
+    h = Segment(title, round(total_length, 2), timeranges)
+
+    print(f"get_highlights: Built highlight '{title}'.")
+
+    return h
+
+
+# Returns the timeranges found in a completion and their total length, or None
+# if there are none or they are too short or long for a highlight.
+def parse_timeranges(result: str) -> Optional[tuple[list[tuple[float, float]], float]]:
+  matches = re.findall(r"(\d+\.\d+)\s*-->\s*(\d+\.\d+)", result)
+
+  if len(matches) <= 0:
+    matches = re.findall(r"(\d+\.\d+)\s*to\s*(\d+\.\d+)", result)
+
+  print(f"Timerange matches: {matches}")
+
+  if len(matches) <= 0:
+    print(f"No matches. Retrying.")
+    return None
+
+  timeranges: list[tuple[float, float]] = []
+  last_end = None
+  total_length = 0
+
+  for m in matches:
+    start = float(m[0])
+    end = float(m[1])
+
+    invalid_timerange = False
+    if end <= start:
+      print("get_highlights: End timestamp is lower than start.")
+      invalid_timerange = True
+
+    if last_end and last_end > start:
+      print("get_highlights: Timerange preceeds last.")
+      invalid_timerange = True
+
+    if invalid_timerange:
+      print("Find completion result below:")
+      print(result)
+      break
+
+    print(f"get_highlights: Found highlight. Start: {start}, End: {end}.")
+
+    total_length += (end - start)
+
+    if last_end == start:
+      # Extend end time of last segment.
+      timeranges[-1] = (timeranges[-1][0], end)
+    else:
+      timeranges.append((start, end))
+
+    last_end = end
+
+  if total_length < 15:
+    print(f"get_highlights: Highlight too short ({int(total_length)} seconds). Trying again.")
+    return None
+
+  if total_length > 120:
+    print(f"get_highlights: Highlight too long ({int(total_length)} seconds). Trying again.")
+    return None
+
+  return timeranges, total_length
+
+
+# Blocking entry point. Async callers should await `HighlightExtractor.run` instead,
+# but when called from a running event loop, extraction runs on a loop of its own in another thread.
+def extract_highlights(sections: list[str], video_title: str, **kwargs) -> list[Segment]:
+  extractor = HighlightExtractor(video_title, **kwargs)
+
+  try:
+    asyncio.get_running_loop()
+  except RuntimeError:
+    return asyncio.run(extractor.run(sections))
+
+  from concurrent.futures import ThreadPoolExecutor
+
+  with ThreadPoolExecutor(1) as executor:
+    return executor.submit(asyncio.run, extractor.run(sections)).result()
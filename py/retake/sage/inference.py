@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+
+from typing import Optional
+
+
+def crop(frame: np.ndarray, area: dict, size: tuple[int, int]) -> Optional[np.ndarray]:
+  x, y, w, h = area["x"], area["y"], area["w"], area["h"]
+
+  face = frame[y:y+h, x:x+w]
+  if face.size == 0:
+    return None
+
+  return cv2.resize(face, size)
+
+
+# Computes face embeddings for a batch of face crops with a single model call.
+# Mirrors `DeepFace.represent`, which only takes one image at a time.
+class FaceEmbedder:
+  def __init__(self, model_name: str, detector_backend: str):
+    from deepface import DeepFace
+    from deepface.commons import functions
+
+    self.model_name = model_name
+    self.detector_backend = detector_backend
+
+    self.model = DeepFace.build_model(model_name)
+    self.target_size = functions.find_target_size(model_name)
+
+  # Returns the embedding of each face, or None where the face is
+  # missing or could not be detected again within its crop.
+  def embed_batch(self, faces: list[Optional[np.ndarray]]) -> list[Optional[list[float]]]:
+    from deepface.commons import functions
+
+    imgs = []
+    rows = []
+
+    for i, face in enumerate(faces):
+      if face is None:
+        continue
+
+      try:
+        img_objs = functions.extract_faces(
+          img=face,
+          target_size=self.target_size,
+          detector_backend=self.detector_backend,
+          grayscale=False,
+          enforce_detection=True,
+          align=True
+        )
+      except ValueError:
+        continue
+
+      img, _, _ = img_objs[0]
+      imgs.append(functions.normalize_input(img=img, normalization="base"))
+      rows.append(i)
+
+    embeddings: list[Optional[list[float]]] = [None] * len(faces)
+
+    if not imgs:
+      return embeddings
+
+    if "keras" in str(type(self.model)):
+      batch = np.concatenate(imgs)
+      output = self.model.predict(batch, batch_size=len(imgs), verbose=0)
+    else:
+      # SFace and Dlib are not keras models and take one image at a time.
+      output = [self.model.predict(img)[0] for img in imgs]
+
+    for i, e in zip(rows, output):
+      embeddings[i] = np.asarray(e).tolist()
+
+    return embeddings
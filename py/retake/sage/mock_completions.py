@@ -0,0 +1,187 @@
+import json
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+# Local stand-in for the OpenAI chat completions API, to run highlight extraction offline.
+# Extraction prompts are answered with the timestamps of transcript lines adding up to
+# a highlight, and title prompts with a fixed intro. Responses are deterministic.
+#
+# Latency, rate limits and failures can be simulated. Requests over `tokens_per_minute`
+# are rejected with a 429, and `failure_rate` of requests fail with a 503.
+class MockCompletionServer:
+  def __init__(self, port: int = 0, latency: float = 0.5, tokens_per_minute: int = 0,
+               failure_rate: float = 0.0, seed: int = 0):
+    self.latency = latency
+    self.tokens_per_minute = tokens_per_minute
+    self.failure_rate = failure_rate
+
+    self.requests = 0
+    self.rate_limited = 0
+    self.failed = 0
+    self.concurrent = 0
+    self.max_concurrent = 0
+
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    self._tokens = float(tokens_per_minute)
+    self._updated = time.monotonic()
+
+    self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+    self._server.daemon_threads = True
+    self._thread: Optional[threading.Thread] = None
+
+  @property
+  def url(self) -> str:
+    host, port = self._server.server_address[:2]
+    return f"http://{host}:{port}/v1"
+
+  def start(self) -> str:
+    self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    self._thread.start()
+    return self.url
+
+  # Serves on the calling thread until interrupted.
+  def serve(self):
+    self._server.serve_forever()
+
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *_):
+    self.stop()
+
+  # Returns the HTTP status to respond with before the completion is worked out.
+  def _admit(self, tokens: int) -> int:
+    with self._lock:
+      self.requests += 1
+
+      if self.tokens_per_minute > 0:
+        now = time.monotonic()
+        rate = self.tokens_per_minute / 60
+        self._tokens = min(float(self.tokens_per_minute), self._tokens + (now - self._updated) * rate)
+        self._updated = now
+
+        if self._tokens < tokens:
+          self.rate_limited += 1
+          return 429
+
+        self._tokens -= tokens
+
+      if self._random.random() < self.failure_rate:
+        self.failed += 1
+        return 503
+
+      self.concurrent += 1
+      self.max_concurrent = max(self.max_concurrent, self.concurrent)
+
+      return 200
+
+  def _done(self):
+    with self._lock:
+      self.concurrent -= 1
+
+  def _handler(self):
+    mock = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        messages = body.get("messages", [])
+        tokens = sum(len(m.get("content", "")) // 4 + 1 for m in messages)
+
+        status = mock._admit(tokens)
+
+        if status != 200:
+          message = "Rate limit reached." if status == 429 else "The server is overloaded."
+          return self._respond(status, {"error": {"message": message, "type": "mock", "code": None}})
+
+        try:
+          time.sleep(mock.latency)
+          content = respond(messages)
+        finally:
+          mock._done()
+
+        self._respond(200, {
+          "id": "chatcmpl-mock",
+          "object": "chat.completion",
+          "created": int(time.time()),
+          "model": body.get("model"),
+          "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop"
+          }],
+          "usage": {"prompt_tokens": tokens, "completion_tokens": len(content) // 4 + 1,
+                    "total_tokens": tokens + len(content) // 4 + 1}
+        })
+
+      def _respond(self, status: int, d: dict):
+        data = json.dumps(d).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      def log_message(self, *_):
+        pass
+
+    return Handler
+
+
+# Works out the reply to a conversation.
+def respond(messages: list[dict]) -> str:
+  if messages and messages[0]["role"] == "system":
+    return highlight(messages[-1]["content"])
+
+  # Follow up asking for the title of the highlight.
+  return "\"A catchy intro to this highlight\" #podcast"
+
+
+# Picks consecutive transcript lines from the middle of the section,
+# until they make up a highlight of 20 to 60 seconds.
+def highlight(transcript: str) -> str:
+  lines = re.findall(r"(\d+\.\d+)\s*-->\s*(\d+\.\d+)", transcript)
+  if not lines:
+    return "Nothing interesting here."
+
+  timeranges = []
+  total = 0.0
+
+  for start, end in lines[len(lines) // 3:]:
+    if total >= 20 or total + float(end) - float(start) > 60:
+      break
+
+    timeranges.append((start, end))
+    total += float(end) - float(start)
+
+  return "The hosts discuss the most interesting topic.\n" + "\n".join(f"{s} --> {e}" for s, e in timeranges)
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+
+  parser = ArgumentParser()
+  parser.add_argument("--port", type=int, default=8001)
+  parser.add_argument("--latency", type=float, default=0.5)
+  parser.add_argument("--tokens-per-minute", type=int, default=0)
+  parser.add_argument("--failure-rate", type=float, default=0.0)
+
+  args = parser.parse_args()
+
+  server = MockCompletionServer(args.port, args.latency, args.tokens_per_minute, args.failure_rate)
+  print(f"mock_completions: Serving on {server.url}. Set OPENAI_API_BASE to use it.")
+
+  server.serve()
@@ -0,0 +1,110 @@
+import cv2
+import numpy as np
+import queue
+import threading
+
+from typing import Iterator, Optional
+
+_END = object()
+
+
+# Decodes only the frames sampled at a fixed time interval on a background thread.
+# Skipped frames are grabbed (or seeked past) without being retrieved, and sampled
+# frames are handed over through a bounded queue so decoding overlaps processing.
+class FrameSampler:
+  def __init__(self, src: str, interval: float, fps: Optional[float] = None,
+               queue_size: int = 8, seek: bool = False):
+    self.src = src
+    self.interval = interval
+    self.fps = fps
+    self.seek = seek
+    self.step = 1
+
+    self._queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+    self._stopped = threading.Event()
+    self._thread: Optional[threading.Thread] = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  # Yields `(frame_count, frame)`, where `frame_count` is the 1-based
+  # position of the frame in the video.
+  def __iter__(self) -> Iterator[tuple[int, np.ndarray]]:
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._decode, daemon=True)
+      self._thread.start()
+
+    try:
+      while True:
+        item = self._queue.get()
+
+        if item is _END:
+          break
+        if isinstance(item, Exception):
+          raise item
+
+        yield item
+    finally:
+      self.close()
+
+  def close(self):
+    self._stopped.set()
+
+    # Unblock the decoder if it is waiting on a full queue.
+    while True:
+      try:
+        self._queue.get_nowait()
+      except queue.Empty:
+        break
+
+    if self._thread is not None and self._thread is not threading.current_thread():
+      self._thread.join()
+
+  def _decode(self):
+    cap = cv2.VideoCapture(self.src)
+
+    try:
+      fps = cap.get(cv2.CAP_PROP_FPS) or self.fps
+      if not fps:
+        raise Exception(f"Unable to determine frame rate of {self.src}.")
+
+      self.step = max(1, round(self.interval * fps))
+
+      frame_count = 0
+      while cap.isOpened() and not self._stopped.is_set():
+        # Skip to the frame before the next sample.
+        if self.seek and self.step > 1:
+          frame_count += self.step - 1
+          cap.set(cv2.CAP_PROP_POS_FRAMES, frame_count)
+        else:
+          skipped = 0
+          while skipped < self.step - 1 and cap.grab():
+            skipped += 1
+          frame_count += skipped
+
+          if skipped < self.step - 1:
+            break
+
+        ret, frame = cap.read()
+        if not ret:
+          break
+
+        frame_count += 1
+        self._put((frame_count, frame))
+
+      self._put(_END)
+    except Exception as e:
+      self._put(e)
+    finally:
+      cap.release()
+
+  def _put(self, item):
+    while not self._stopped.is_set():
+      try:
+        self._queue.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        continue
@@ -0,0 +1,124 @@
+from typing import Optional
+
+# Transcript line, as its timerange ("from --> to") and its text.
+Line = tuple[str, str]
+
+# Max number of texts whose token counts are kept per tokenizer.
+CACHE_SIZE = 200000
+
+
+# Counts tokens with the model's tokenizer. Falls back to estimating them at about 4 characters
+# per token if tiktoken isn't installed or the tokenizer can't be loaded.
+# Counts are cached, as the same lines are counted again when sections overlap or are rebuilt.
+class TokenCounter:
+  def __init__(self, model: str):
+    self.model = model
+
+    self._encoding = None
+    self._loaded = False
+    self._counts: dict[str, int] = {}
+
+  # Whether counts come from the tokenizer rather than estimates.
+  @property
+  def exact(self) -> bool:
+    if not self._loaded:
+      self._load()
+    return self._encoding is not None
+
+  def _load(self):
+    self._loaded = True
+
+    try:
+      import tiktoken
+      self._encoding = tiktoken.encoding_for_model(self.model)
+    except Exception as e:
+      print(f"TokenCounter: Unable to load tokenizer for '{self.model}'. Estimating token counts. {e}")
+
+  def count(self, text: str) -> int:
+    return self.count_all([text])[0]
+
+  def count_all(self, texts: list[str]) -> list[int]:
+    if not self._loaded:
+      self._load()
+
+    missing = list({t for t in texts if t not in self._counts})
+
+    if missing:
+      if len(self._counts) + len(missing) > CACHE_SIZE:
+        self._counts.clear()
+
+      if self._encoding is not None:
+        counts = [len(tokens) for tokens in self._encoding.encode_ordinary_batch(missing)]
+      else:
+        counts = [estimate(t) for t in missing]
+
+      self._counts.update(zip(missing, counts))
+
+    return [self._counts[t] for t in texts]
+
+
+def estimate(text: str) -> int:
+  return (len(text) + 3) // 4
+
+
+_counters: dict[str, TokenCounter] = {}
+
+
+def token_counter(model: str) -> TokenCounter:
+  if model not in _counters:
+    _counters[model] = TokenCounter(model)
+  return _counters[model]
+
+
+# Line as it appears in the prompt.
+def render_line(line: Line) -> str:
+  return f"{line[0]}: {line[1]}\n"
+
+
+def render(section: list[Line]) -> str:
+  return "".join(render_line(l) for l in section)
+
+
+# Packs consecutive lines into sections of at most `max_tokens` each. Each section after the
+# first starts with the last lines of the one before, of up to `overlap_tokens`, for context.
+# A line longer than `max_tokens` on its own is given a section of its own.
+def split(lines: list[Line], max_tokens: int, overlap_tokens: int = 0,
+          counter: Optional[TokenCounter] = None, model: str = "gpt-3.5-turbo") -> list[list[Line]]:
+  counter = counter or token_counter(model)
+  counts = counter.count_all([render_line(l) for l in lines])
+
+  # Overlap has to leave room for at least one new line.
+  overlap_tokens = min(overlap_tokens, max_tokens // 2)
+
+  sections = []
+  # Index of the first line of the current section, and of the first line not in the overlap.
+  start = 0
+  fresh = 0
+  used = 0
+
+  for i, count in enumerate(counts):
+    if used + count > max_tokens and i > fresh:
+      sections.append(lines[start:i])
+
+      # Carry over as many of the last lines as fit in the overlap.
+      start = i
+      used = 0
+      while start > fresh and used + counts[start - 1] <= overlap_tokens:
+        start -= 1
+        used += counts[start]
+
+      fresh = i
+
+      if used + count > max_tokens:
+        start = i
+        used = 0
+
+    if count > max_tokens:
+      print(f"sectioner: Line {i} is {count} tokens, over the {max_tokens} token limit.")
+
+    used += count
+
+  if fresh < len(lines):
+    sections.append(lines[start:])
+
+  return sections
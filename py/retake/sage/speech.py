@@ -1,40 +1,237 @@
+import hashlib
 import json
+import numpy as np
+import os
+import shutil
+import threading
+import time
 import whisperx
 
-from typing import cast, Iterator
+from collections import OrderedDict
+from typing import Callable, cast, Iterator, Optional, Sequence, Union
 
-from retake.sage import config
+from retake.sage import config, transcript, vad
+from retake.sage.audio import SAMPLE_RATE
 
-device = "cuda" if config.CUDA_AVAILABLE() else "cpu"
 
-model = whisperx.load_model(config.WHISPERX_MODEL, device,
-                            compute_type=config.WHISPERX_COMPUTE_TYPE)
+# Loads speech models on first use and keeps them around for later calls.
+# Align models are cached per language, evicting the least recently used ones
+# once their combined size exceeds `align_cache_bytes`.
+class ModelRegistry:
+  def __init__(self, align_cache_bytes: int):
+    self.align_cache_bytes = align_cache_bytes
 
+    # Models are guarded separately, so that they can load concurrently.
+    self._device_lock = threading.Lock()
+    self._model_lock = threading.Lock()
+    self._align_lock = threading.Lock()
+    self._diarize_lock = threading.Lock()
+    self._device: Optional[str] = None
+    self._model = None
+    self._diarize_model = None
+    self._align_models: OrderedDict[str, tuple] = OrderedDict()
+    self._align_sizes: dict[str, int] = {}
 
-def transcribe(video_id: str, src: str):
+  @property
+  def device(self) -> str:
+    with self._device_lock:
+      if self._device is None:
+        self._device = "cuda" if config.CUDA_AVAILABLE() else "cpu"
+      return self._device
+
+  def model(self):
+    with self._model_lock:
+      if self._model is None:
+        print(f"ModelRegistry: Loading WhisperX model '{config.WHISPERX_MODEL}'.")
+        self._model = whisperx.load_model(config.WHISPERX_MODEL, self.device,
+                                          compute_type=config.WHISPERX_COMPUTE_TYPE)
+      return self._model
+
+  # Voice activity detection model that the WhisperX model gates transcription with,
+  # along with its onset and offset thresholds.
+  def vad_model(self) -> tuple:
+    model = self.model()
+    params = getattr(model, "_vad_params", {})
+    return model.vad_model, params.get("vad_onset", 0.5), params.get("vad_offset", 0.363)
+
+  def align_model(self, language: str) -> tuple:
+    with self._align_lock:
+      if language in self._align_models:
+        self._align_models.move_to_end(language)
+        return self._align_models[language]
+
+      print(f"ModelRegistry: Loading align model for '{language}'.")
+
+      align_model, metadata = whisperx.load_align_model(language, self.device)
+
+      self._align_models[language] = (align_model, metadata)
+      self._align_sizes[language] = model_size(align_model)
+      self._evict_align_models()
+
+      return align_model, metadata
+
+  def diarize_model(self):
+    with self._diarize_lock:
+      if self._diarize_model is None:
+        print(f"ModelRegistry: Loading diarization pipeline.")
+        self._diarize_model = whisperx.DiarizationPipeline(use_auth_token=config.HUGGINGFACE_TOKEN,
+                                                           device=self.device)
+      return self._diarize_model
+
+  # Loads models upfront, e.g. when a container starts, so that the first call doesn't wait on them.
+  def preload(self, languages: Sequence[str] = (), diarize: Optional[bool] = None):
+    if diarize is None:
+      diarize = not config.IS_DEV
+
+    self.model()
+
+    for language in languages:
+      self.align_model(language)
+
+    if diarize:
+      self.diarize_model()
+
+  def _evict_align_models(self):
+    # The most recently used model is always kept.
+    while len(self._align_models) > 1 and sum(self._align_sizes.values()) > self.align_cache_bytes:
+      language, _ = self._align_models.popitem(last=False)
+      del self._align_sizes[language]
+
+      print(f"ModelRegistry: Evicted align model for '{language}'.")
+
+      if self.device == "cuda":
+        import gc
+        import torch
+
+        gc.collect()
+        torch.cuda.empty_cache()
+
+
+# Size in bytes of a torch model's parameters and buffers.
+def model_size(model) -> int:
+  try:
+    tensors = list(model.parameters()) + list(model.buffers())
+  except AttributeError:
+    return 0
+
+  return sum(t.numel() * t.element_size() for t in tensors)
+
+
+models = ModelRegistry(config.SPEECH_ALIGN_CACHE_BYTES)
+
+
+def preload(languages: Sequence[str] = (), diarize: Optional[bool] = None):
+  models.preload(languages, diarize)
+
+
+# `audio` is either the path of a video or audio file or its 16kHz mono samples,
+# which are then shared by transcription, alignment and diarization.
+# Audio decoded from a path is only held in full until it is cut down to its speech regions,
+# and is saved to `save_audio` if given.
+def transcribe(video_id: str, audio: Union[str, np.ndarray], save_audio: Optional[str] = None):
+  from concurrent.futures import Future, ThreadPoolExecutor
+  from .audio import load_from_video, save_wav
   from .s3 import upload_file
 
+  device = models.device
+
   print(f"transcribe: Transcribing audio using {device}.")
 
-  audio = whisperx.load_audio(src)
-  result = model.transcribe(audio, batch_size=config.WHISPERX_BATCH_SIZE)
+  if isinstance(audio, str):
+    audio = load_from_video(audio)
+    print(f"transcribe: Decoded {len(audio) / SAMPLE_RATE:.1f}s of audio.")
 
-  align_model, metadata = whisperx.load_align_model(result["language"], device)
+  if save_audio:
+    save_wav(audio, save_audio)
+    print(f"transcribe: Saved audio to {save_audio}.")
 
-  result = whisperx.align(cast(Iterator, result["segments"]), align_model,
-                          metadata, audio, device, return_char_alignments=False)
-  
-  print(f"transcribe: Aligned segments.")
+  start = time.perf_counter()
+  timings: dict[str, float] = {}
+
+  timeline = None
+
+  # Long stretches without speech are cut out before the expensive stages, and their results
+  # are mapped back to the original timeline afterwards.
+  if config.SPEECH_VAD_MIN_SILENCE > 0:
+    timeline = skip_non_speech(video_id, audio, timings)
+    if timeline is not None:
+      # Replaces the only reference to the full audio, unless the caller holds one.
+      audio = vad.compact(audio, SAMPLE_RATE, timeline.regions)
+
+  chunked = 0 < config.SPEECH_CHUNK_LENGTH < len(audio) / SAMPLE_RATE
+  audio_hash = hashlib.sha1(memoryview(np.ascontiguousarray(audio))).hexdigest() if chunked else None
+
+  def diarize():
+    import pandas as pd
+    from .utils import ensure_dir_exists
 
-  if not config.IS_DEV:
+    # Saved next to the chunks, so that a restarted job doesn't diarize again.
+    diarization_path = chunks_dir(video_id) + "/diarization.json"
+
+    if chunked:
+      saved = read_json(diarization_path)
+      if saved is not None and saved["audio"] == audio_hash:
+        print(f"transcribe: Resumed diarization.")
+        return pd.DataFrame(saved["segments"], columns=["start", "end", "speaker"])
+
+    t = time.perf_counter()
     print(f"transcribe: Starting diarization pipeline.")
 
-    diarize_model = whisperx.DiarizationPipeline(use_auth_token=config.HUGGINGFACE_TOKEN, device=device)
-    diarized_segments = diarize_model(src)
+    diarized_segments = models.diarize_model()(audio)
+    timings["diarize"] = time.perf_counter() - t
 
     print(f"transcribe: Done diarizing segments.")
 
-    result = whisperx.assign_word_speakers(diarized_segments, result)
+    if chunked:
+      ensure_dir_exists(chunks_dir(video_id))
+      write_json(diarization_path, {
+        "audio": audio_hash,
+        "segments": diarized_segments[["start", "end", "speaker"]].to_dict("records")
+      })
+
+    return diarized_segments
+
+  diarize_enabled = not config.IS_DEV
+  concurrent = diarize_enabled and config.SPEECH_CONCURRENT_DIARIZATION
+
+  executor = None
+  diarization: Optional[Future] = None
+
+  # Diarization only needs the audio, so it can run alongside transcription and alignment.
+  if concurrent:
+    executor = ThreadPoolExecutor(1)
+    diarization = executor.submit(diarize)
+
+  try:
+    if chunked:
+      result = transcribe_chunks(video_id, audio, audio_hash, timings)
+    else:
+      result, _ = transcribe_aligned(audio, timings)
+
+    print(f"transcribe: Aligned segments.")
+
+    if diarization is not None:
+      diarized_segments = diarization.result()
+      result = whisperx.assign_word_speakers(diarized_segments, result)
+    elif diarize_enabled:
+      diarized_segments = diarize()
+      result = whisperx.assign_word_speakers(diarized_segments, result)
+  finally:
+    if executor is not None:
+      executor.shutdown(wait=True)
+
+  if timeline is not None:
+    result = dict(result)
+
+    for k in ["segments", "word_segments"]:
+      if k in result:
+        result[k] = [retime(s, timeline.to_original) for s in result[k]]
+
+  total = time.perf_counter() - start
+  stages = ", ".join(f"{k}: {v:.1f}s" for k, v in timings.items())
+
+  print(f"transcribe: Stage timings ({'concurrent' if concurrent else 'sequential'}). "
+        f"{stages}. Total: {total:.1f}s, saved by overlap: {max(0.0, sum(timings.values()) - total):.1f}s.")
 
   out_path_base = config.VIDEO_DIR + f"/{video_id}"
 
@@ -50,6 +247,13 @@ def transcribe(video_id: str, src: str):
       print(f"{i}\n{s['start']} --> {s['end']}\n{s['text'].strip()}\n", file=f)
     f.flush()
 
+  # Columns of the segments and words next to the JSON, for stages that read them.
+  transcript.save(result, speech_data_out)
+
+  # Chunks are no longer needed to resume once the results are saved.
+  if chunked:
+    shutil.rmtree(chunks_dir(video_id), ignore_errors=True)
+
   upload_file(speech_data_out, config.S3_VIDEOS, speech_data_out.lstrip(config.BASE_DIR), "application/json")
   print(f"transcribe: Uploaded speech data to S3.")
 
@@ -57,3 +261,173 @@ def transcribe(video_id: str, src: str):
   print(f"transcribe: Uploaded transcript to S3.")
 
   return result
+
+
+# Transcribes and aligns the audio, adding the time spent to `timings`.
+# Returns the aligned result and the language it was transcribed in.
+def transcribe_aligned(audio: np.ndarray, timings: dict[str, float],
+                       language: Optional[str] = None) -> tuple[dict, str]:
+  device = models.device
+  options = {"language": language} if language else {}
+
+  t = time.perf_counter()
+  result = models.model().transcribe(audio, batch_size=config.WHISPERX_BATCH_SIZE, **options)
+  timings["transcribe"] = timings.get("transcribe", 0.0) + time.perf_counter() - t
+
+  language = result["language"]
+
+  t = time.perf_counter()
+  align_model, metadata = models.align_model(language)
+
+  result = whisperx.align(cast(Iterator, result["segments"]), align_model,
+                          metadata, audio, device, return_char_alignments=False)
+  timings["align"] = timings.get("align", 0.0) + time.perf_counter() - t
+
+  return result, language
+
+
+# Finds the speech regions of the audio, recording them along with the share of audio skipped.
+# Returns None if there's nothing to skip.
+def skip_non_speech(video_id: str, audio: np.ndarray, timings: dict[str, float]) -> Optional[vad.Timeline]:
+  t = time.perf_counter()
+
+  model, onset, offset = models.vad_model()
+  speech = vad.detect_speech(model, audio, SAMPLE_RATE, onset, offset)
+
+  duration = len(audio) / SAMPLE_RATE
+  regions = vad.speech_regions(speech, duration, SAMPLE_RATE, config.SPEECH_VAD_MIN_SILENCE)
+  timeline = vad.Timeline(regions)
+
+  timings["vad"] = time.perf_counter() - t
+  skipped = duration - timeline.duration
+  skipped_ratio = skipped / duration if duration > 0 else 0.0
+
+  write_json(config.VIDEO_DIR + f"/{video_id}/speech_regions.json", {
+    "duration": duration,
+    "processed": timeline.duration,
+    "skipped": skipped,
+    "skipped_ratio": skipped_ratio,
+    "regions": regions
+  })
+
+  print(f"transcribe: Found {len(regions)} speech regions. "
+        f"Skipping {skipped:.1f}s of {duration:.1f}s ({skipped_ratio:.1%}).")
+
+  if not regions or skipped <= 0:
+    return None
+
+  return timeline
+
+
+def chunks_dir(video_id: str) -> str:
+  return config.VIDEO_DIR + f"/{video_id}/transcript_chunks"
+
+
+# Transcribes long audio in windows split at silences. The result of each window is saved
+# as soon as it is done, so that a restarted job resumes after the last completed window.
+def transcribe_chunks(video_id: str, audio: np.ndarray, audio_hash: str, timings: dict[str, float]) -> dict:
+  from .utils import ensure_dir_exists
+
+  dir = chunks_dir(video_id)
+  ensure_dir_exists(dir)
+
+  params = {
+    "audio": audio_hash,
+    "model": config.WHISPERX_MODEL,
+    "batch_size": config.WHISPERX_BATCH_SIZE,
+    "compute_type": config.WHISPERX_COMPUTE_TYPE,
+    "chunk_length": config.SPEECH_CHUNK_LENGTH
+  }
+
+  plan_path = dir + "/plan.json"
+  plan = read_json(plan_path)
+
+  # Chunks of other audio or settings can't be resumed from. Diarization is checked on its own.
+  if plan is None or plan["params"] != params:
+    for name in os.listdir(dir):
+      if name.startswith("chunk_"):
+        os.remove(os.path.join(dir, name))
+
+    windows = vad.split(audio, SAMPLE_RATE, config.SPEECH_CHUNK_LENGTH)
+    plan = {"params": params, "windows": windows}
+
+    write_json(plan_path, plan)
+
+  windows = plan["windows"]
+
+  print(f"transcribe: Transcribing {len(windows)} chunks of up to {config.SPEECH_CHUNK_LENGTH}s.")
+
+  segments = []
+  word_segments = []
+  language = None
+
+  for i, (start, end) in enumerate(windows):
+    chunk_path = dir + f"/chunk_{i:04d}.json"
+    chunk = read_json(chunk_path)
+
+    if chunk is None:
+      samples = audio[round(start * SAMPLE_RATE):round(end * SAMPLE_RATE)]
+      result, chunk_language = transcribe_aligned(samples, timings, language)
+
+      chunk = {
+        "start": start,
+        "end": end,
+        "language": chunk_language,
+        "segments": [shift(s, start) for s in result["segments"]],
+        "word_segments": [shift(w, start) for w in result.get("word_segments", [])]
+      }
+
+      write_json(chunk_path, chunk)
+
+      print(f"transcribe: Transcribed chunk {i+1}/{len(windows)} ({start:.1f}s - {end:.1f}s).")
+    else:
+      print(f"transcribe: Resumed chunk {i+1}/{len(windows)} ({start:.1f}s - {end:.1f}s).")
+
+    # Later chunks are transcribed in the language detected in the first.
+    if language is None:
+      language = chunk["language"]
+
+    segments.extend(chunk["segments"])
+    word_segments.extend(chunk["word_segments"])
+
+  return {"segments": segments, "word_segments": word_segments}
+
+
+# Moves the timestamps of an aligned segment or word, and of its words, by `offset` seconds.
+def shift(item: dict, offset: float) -> dict:
+  return retime(item, lambda t, _: t + offset)
+
+
+# Maps the timestamps of an aligned segment or word, and of its words, with `fn(t, is_end)`.
+def retime(item: dict, fn: Callable[[float, bool], float]) -> dict:
+  item = dict(item)
+
+  for k in ["start", "end"]:
+    if k in item:
+      item[k] = round(fn(item[k], k == "end"), 3)
+
+  for k in ["words", "chars"]:
+    if k in item:
+      item[k] = [retime(w, fn) for w in item[k]]
+
+  return item
+
+
+def read_json(path: str) -> Optional[dict]:
+  try:
+    with open(path, "r") as f:
+      return json.loads(f.read())
+  except (OSError, ValueError):
+    return None
+
+
+# Written to a temporary file first, so that a crash never leaves a partial file behind.
+def write_json(path: str, d: dict):
+  tmp_path = path + ".tmp"
+
+  with open(tmp_path, "w") as f:
+    f.write(json.dumps(d))
+    f.flush()
+    os.fsync(f.fileno())
+
+  os.replace(tmp_path, path)
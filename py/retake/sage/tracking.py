@@ -0,0 +1,134 @@
+from dataclasses import dataclass
+from typing import Optional
+
+Box = tuple[float, float, float, float]
+
+
+@dataclass
+class Track:
+  id: int
+  box: Box
+  face_id: Optional[str] = None
+  confidence: float = 0.0
+  # Number of updates since the identity was last verified with an embedding.
+  since_verified: int = 0
+  # Number of consecutive updates the track went unmatched.
+  missed: int = 0
+  lost: bool = False
+  # An embedding was requested but its result is not known yet.
+  pending: bool = False
+
+  def needs_embedding(self, reverify_interval: int) -> bool:
+    if self.face_id is None and not self.pending:
+      return True
+    return self.lost or self.since_verified >= reverify_interval
+
+  def schedule(self):
+    self.pending = True
+    self.since_verified = 0
+    self.lost = False
+
+  def verified(self, face_id: str, confidence: float):
+    self.face_id = face_id
+    self.confidence = confidence
+    self.pending = False
+
+  # The face could not be embedded, so verify it again on the next update.
+  def failed(self):
+    self.pending = False
+    self.lost = True
+
+
+# Carries face identities across sampled frames by matching boxes on overlap (IoU)
+# or, failing that, on how far their centre moved relative to the box size.
+class BoxTracker:
+  def __init__(self, iou_threshold: float = 0.5, max_shift: float = 0.25, max_missed: int = 1):
+    self.iou_threshold = iou_threshold
+    self.max_shift = max_shift
+    self.max_missed = max_missed
+
+    self.tracks: list[Track] = []
+    self._next_id = 1
+
+  # Returns the track of each box, in the same order.
+  def update(self, boxes: list[Box]) -> list[Track]:
+    candidates = []
+
+    for i, box in enumerate(boxes):
+      for j, t in enumerate(self.tracks):
+        overlap = iou(box, t.box)
+        if overlap >= self.iou_threshold or shift(box, t.box) <= self.max_shift:
+          candidates.append((overlap, i, j))
+
+    # Greedily pair the most overlapping boxes and tracks first.
+    candidates.sort(key=lambda c: c[0], reverse=True)
+
+    matched: list[Optional[Track]] = [None] * len(boxes)
+    matched_tracks = set()
+
+    for _, i, j in candidates:
+      if matched[i] is not None or j in matched_tracks:
+        continue
+
+      t = self.tracks[j]
+      t.box = boxes[i]
+      t.since_verified += 1
+      # Identity can't be carried over a gap in the track.
+      t.lost = t.lost or t.missed > 0
+      t.missed = 0
+
+      matched[i] = t
+      matched_tracks.add(j)
+
+    tracks = []
+
+    for j, t in enumerate(self.tracks):
+      if j in matched_tracks:
+        tracks.append(t)
+        continue
+
+      t.missed += 1
+      if t.missed <= self.max_missed:
+        tracks.append(t)
+
+    for i, box in enumerate(boxes):
+      if matched[i] is None:
+        t = Track(self._next_id, box)
+        self._next_id += 1
+
+        matched[i] = t
+        tracks.append(t)
+
+    self.tracks = tracks
+
+    return [t for t in matched if t is not None]
+
+
+def iou(a: Box, b: Box) -> float:
+  ax, ay, aw, ah = a
+  bx, by, bw, bh = b
+
+  w = min(ax + aw, bx + bw) - max(ax, bx)
+  h = min(ay + ah, by + bh) - max(ay, by)
+  if w <= 0 or h <= 0:
+    return 0.0
+
+  intersection = w * h
+  union = aw * ah + bw * bh - intersection
+
+  return intersection / union if union > 0 else 0.0
+
+
+# Distance between box centres relative to the larger side of the boxes.
+def shift(a: Box, b: Box) -> float:
+  ax, ay, aw, ah = a
+  bx, by, bw, bh = b
+
+  dx = (ax + aw / 2) - (bx + bw / 2)
+  dy = (ay + ah / 2) - (by + bh / 2)
+  size = max(aw, ah, bw, bh)
+
+  if size <= 0:
+    return float("inf")
+
+  return (dx * dx + dy * dy) ** 0.5 / size
@@ -0,0 +1,547 @@
+import json
+import numpy as np
+import struct
+
+from array import array
+from typing import IO, Iterator, Optional
+
+from retake.sage import config
+from retake.sage.types import FaceData, FaceTrack, FaceTracks, FrameData
+
+MAGIC = b"RTRK"
+VERSION = 1
+
+# Magic, version, flags, number of frames, number of faces and length of the id dictionary.
+HEADER = struct.Struct("<4sHHIII")
+# Set when boxes are stored as floats rather than ints.
+FLAG_FLOAT_BOXES = 1
+
+# Sections are aligned so that columns can be read in place.
+ALIGN = 8
+
+
+# Face tracks of a clip as columns: one row per frame (frame number, time and where its faces
+# start) and one row per face (index of its id in the id dictionary, and box).
+#
+# The binary format is the header, the id dictionary as JSON and the columns in the order of
+# `columns`, each aligned to 8 bytes. Loading it only creates the arrays.
+class Tracks:
+  def __init__(self, ids: list[str], frames: np.ndarray, times: np.ndarray, face_offsets: np.ndarray,
+               face_ids: np.ndarray, boxes: np.ndarray):
+    self.ids = ids
+    self.frames = frames
+    self.times = times
+    # Faces of frame `i` are rows `face_offsets[i]` to `face_offsets[i + 1]`.
+    self.face_offsets = face_offsets
+    self.face_ids = face_ids
+    # x, y, w and h of each face.
+    self.boxes = boxes
+
+  def __len__(self) -> int:
+    return len(self.frames)
+
+  def __getitem__(self, i: int) -> "FrameView":
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError(i)
+    return FrameView(self, i)
+
+  def __iter__(self) -> Iterator["FrameView"]:
+    for i in range(len(self)):
+      yield FrameView(self, i)
+
+  @property
+  def face_count(self) -> int:
+    return len(self.face_ids)
+
+  @classmethod
+  def from_frame_data(cls, frame_data: list[FrameData]) -> "Tracks":
+    return cls.from_dicts([{"frame": fd.frame, "time": fd.time, "faces": [
+      {"id": f.id, "x": f.x, "y": f.y, "w": f.w, "h": f.h} for f in fd.faces
+    ]} for fd in frame_data])
+
+  # From frame data as saved to clip_<id>.json.
+  @classmethod
+  def from_dicts(cls, frame_data: list[dict]) -> "Tracks":
+    ids: dict[str, int] = {}
+
+    frames, times, face_offsets = [], [], [0]
+    face_ids, boxes = [], []
+
+    for fd in frame_data:
+      frames.append(fd["frame"])
+      times.append(fd["time"])
+
+      for f in fd["faces"]:
+        face_ids.append(ids.setdefault(str(f["id"]), len(ids)))
+        boxes.append((f["x"], f["y"], f["w"], f["h"]))
+
+      face_offsets.append(len(face_ids))
+
+    integral = all(isinstance(v, int) for b in boxes for v in b)
+
+    return cls(
+      list(ids.keys()),
+      np.array(frames, dtype=np.uint32),
+      np.array(times, dtype=np.float64),
+      np.array(face_offsets, dtype=np.uint32),
+      np.array(face_ids, dtype=np.uint32),
+      np.array(boxes, dtype=np.int32 if integral else np.float32).reshape(-1, 4)
+    )
+
+  def to_frame_data(self) -> list[FrameData]:
+    return [FrameData(fd["frame"], fd["time"], [FaceData(**f) for f in fd["faces"]]) for fd in self.to_dicts()]
+
+  # Frame data as saved to clip_<id>.json.
+  def to_dicts(self) -> list[dict]:
+    return list(self.iter_dicts())
+
+  def iter_dicts(self) -> Iterator[dict]:
+    frames = self.frames.tolist()
+    times = self.times.tolist()
+    offsets = self.face_offsets.tolist()
+
+    for i in range(len(frames)):
+      a, b = offsets[i], offsets[i + 1]
+      boxes = self.boxes[a:b].tolist()
+
+      yield {
+        "frame": frames[i],
+        "time": times[i],
+        "faces": [
+          {"id": self.ids[id], "x": box[0], "y": box[1], "w": box[2], "h": box[3]}
+          for id, box in zip(self.face_ids[a:b].tolist(), boxes)
+        ]
+      }
+
+  def to_json(self) -> str:
+    return json.dumps(self.to_dicts())
+
+  # Writes the same JSON as `to_json`, a frame at a time.
+  def write_json(self, f: IO[str]):
+    f.write("[")
+    for i, d in enumerate(self.iter_dicts()):
+      f.write((", " if i else "") + json.dumps(d))
+    f.write("]")
+
+  @classmethod
+  def from_json(cls, s: str) -> "Tracks":
+    return cls.from_dicts(json.loads(s))
+
+  def to_bytes(self) -> bytes:
+    ids = json.dumps(self.ids).encode()
+    flags = FLAG_FLOAT_BOXES if self.boxes.dtype == np.float32 else 0
+
+    parts = [HEADER.pack(MAGIC, VERSION, flags, len(self.frames), len(self.face_ids), len(ids)), ids]
+
+    for a in self.columns():
+      parts.append(b"\0" * (-sum(len(p) for p in parts) % ALIGN))
+      parts.append(np.ascontiguousarray(a).tobytes())
+
+    return b"".join(parts)
+
+  # Arrays are views on `data`, which is kept alive by them.
+  @classmethod
+  def from_bytes(cls, data) -> "Tracks":
+    buf = memoryview(data)
+
+    if len(buf) < HEADER.size:
+      raise Exception("Track data is truncated.")
+
+    magic, version, flags, n_frames, n_faces, ids_len = HEADER.unpack_from(buf)
+
+    if magic != MAGIC:
+      raise Exception("Not track data.")
+
+    if version != VERSION:
+      raise Exception(f"Unsupported track data version {version}.")
+
+    offset = HEADER.size
+    ids = json.loads(bytes(buf[offset:offset + ids_len]))
+    offset += ids_len
+
+    boxes_dtype = np.float32 if flags & FLAG_FLOAT_BOXES else np.int32
+    shapes = [
+      (np.uint32, n_frames), (np.float64, n_frames), (np.uint32, n_frames + 1),
+      (np.uint32, n_faces), (boxes_dtype, n_faces * 4)
+    ]
+
+    columns = []
+    for dtype, count in shapes:
+      offset += -offset % ALIGN
+
+      size = np.dtype(dtype).itemsize * count
+      if offset + size > len(buf):
+        raise Exception("Track data is truncated.")
+
+      columns.append(np.frombuffer(buf, dtype=dtype, count=count, offset=offset))
+      offset += size
+
+    frames, times, face_offsets, face_ids, boxes = columns
+
+    return cls(ids, frames, times, face_offsets, face_ids, boxes.reshape(-1, 4))
+
+  def columns(self) -> list[np.ndarray]:
+    return [self.frames, self.times, self.face_offsets, self.face_ids, self.boxes]
+
+  def save(self, path: str):
+    with open(path, "wb") as f:
+      f.write(self.to_bytes())
+      f.flush()
+
+
+# With `mmap` set, the file is memory mapped rather than read.
+def load(path: str, mmap: bool = False) -> Tracks:
+  if mmap:
+    return Tracks.from_bytes(np.memmap(path, dtype=np.uint8, mode="r"))
+
+  with open(path, "rb") as f:
+    return Tracks.from_bytes(f.read())
+
+
+def from_json_file(path: str) -> Tracks:
+  with open(path, "r") as f:
+    return Tracks.from_json(f.read())
+
+
+# Returns the tracks in `path`, or in the JSON saved alongside it when missing.
+def load_or_convert(path: str, json_path: Optional[str] = None) -> Tracks:
+  try:
+    return load(path)
+  except FileNotFoundError:
+    if json_path is None:
+      raise
+    return from_json_file(json_path)
+
+
+# Frame `i` of the tracks, read from the columns when accessed.
+class FrameView:
+  __slots__ = ("tracks", "i")
+
+  def __init__(self, tracks: Tracks, i: int):
+    self.tracks = tracks
+    self.i = i
+
+  @property
+  def frame(self) -> int:
+    return int(self.tracks.frames[self.i])
+
+  @property
+  def time(self) -> float:
+    return float(self.tracks.times[self.i])
+
+  @property
+  def faces(self) -> list["FaceView"]:
+    offsets = self.tracks.face_offsets
+    return [FaceView(self.tracks, j) for j in range(int(offsets[self.i]), int(offsets[self.i + 1]))]
+
+
+# Face `j` of the tracks, read from the columns when accessed.
+class FaceView:
+  __slots__ = ("tracks", "j")
+
+  def __init__(self, tracks: Tracks, j: int):
+    self.tracks = tracks
+    self.j = j
+
+  @property
+  def id(self) -> str:
+    return self.tracks.ids[int(self.tracks.face_ids[self.j])]
+
+  @property
+  def x(self):
+    return self.tracks.boxes[self.j, 0].item()
+
+  @property
+  def y(self):
+    return self.tracks.boxes[self.j, 1].item()
+
+  @property
+  def w(self):
+    return self.tracks.boxes[self.j, 2].item()
+
+  @property
+  def h(self):
+    return self.tracks.boxes[self.j, 3].item()
+
+
+# Writes frame data to a JSON Lines file as it's tracked, one frame per line, flushed as it's
+# written so that the file can be read up to the last frame written if tracking is interrupted.
+# Frames are also kept as columns rather than objects, for `tracks` once done.
+class TrackWriter:
+  def __init__(self, path: str):
+    self.path = path
+
+    self._file = open(path, "w")
+    self._ids: dict[str, int] = {}
+    self._frames = array("I")
+    self._times = array("d")
+    self._face_offsets = array("I", [0])
+    self._face_ids = array("I")
+    self._boxes = array("d")
+    self._integral = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def write(self, fd: FrameData):
+    faces = [{"id": f.id, "x": f.x, "y": f.y, "w": f.w, "h": f.h} for f in fd.faces]
+
+    self._file.write(json.dumps({"frame": fd.frame, "time": fd.time, "faces": faces}) + "\n")
+    self._file.flush()
+
+    self._frames.append(fd.frame)
+    self._times.append(fd.time)
+
+    for f in fd.faces:
+      self._face_ids.append(self._ids.setdefault(str(f.id), len(self._ids)))
+      self._boxes.extend((f.x, f.y, f.w, f.h))
+      self._integral = self._integral and all(isinstance(v, int) for v in (f.x, f.y, f.w, f.h))
+
+    self._face_offsets.append(len(self._face_ids))
+
+  def close(self):
+    self._file.close()
+
+  def tracks(self) -> Tracks:
+    return Tracks(
+      list(self._ids.keys()),
+      np.array(self._frames, dtype=np.uint32),
+      np.array(self._times, dtype=np.float64),
+      np.array(self._face_offsets, dtype=np.uint32),
+      np.array(self._face_ids, dtype=np.uint32),
+      np.array(self._boxes, dtype=np.int32 if self._integral else np.float32).reshape(-1, 4)
+    )
+
+
+# Reads frame data written by TrackWriter. A last line cut short by an interruption is skipped.
+def load_jsonl(path: str) -> Tracks:
+  frame_data = []
+
+  with open(path, "r") as f:
+    for line in f:
+      try:
+        frame_data.append(json.loads(line))
+      except ValueError:
+        if line.endswith("\n"):
+          raise
+        print(f"load_jsonl: Skipped incomplete last line of {path}.")
+
+  return Tracks.from_dicts(frame_data)
+
+
+# Boxes at `frames`, linearly interpolated between `b0` at `f0` and `b1` at `f1`.
+# Shared by compression and expansion, so that both compute the same boxes. Halves are rounded
+# up, like Math.round, so that the frontend's expandFaceTracks computes the same boxes too.
+def lerp(frames: np.ndarray, f0: float, f1: float, b0: np.ndarray, b1: np.ndarray, integral: bool) -> np.ndarray:
+  t = (frames - f0) / (f1 - f0) if f1 != f0 else np.zeros(len(frames))
+  b = b0 + (b1 - b0) * t[:, None]
+  return np.floor(b + 0.5) if integral else b
+
+
+# Positions of the keyframes of a run of boxes, such that interpolating between them keeps
+# every box within `tolerance`. Each keyframe is placed as far from the one before as
+# possible, found by doubling the distance and then bisecting.
+def run_keyframes(frames: np.ndarray, boxes: np.ndarray, tolerance: float, integral: bool) -> list[int]:
+  n = len(frames)
+
+  def fits(s: int, e: int) -> bool:
+    b = lerp(frames[s:e + 1], frames[s], frames[e], boxes[s], boxes[e], integral)
+    return float(np.abs(b - boxes[s:e + 1]).max()) <= tolerance
+
+  keys = [0]
+  s = 0
+
+  while s < n - 1:
+    # Neighbours always fit.
+    e = s + 1
+    bad = None
+
+    while e < n - 1:
+      candidate = min(n - 1, s + 2 * (e - s))
+      if not fits(s, candidate):
+        bad = candidate
+        break
+      e = candidate
+
+    if bad is not None:
+      while bad - e > 1:
+        mid = (e + bad) // 2
+        if fits(s, mid):
+          e = mid
+        else:
+          bad = mid
+
+    keys.append(e)
+    s = e
+
+  return keys
+
+
+# Sampled frames as runs of `[first frame, step, count]`.
+def frame_runs(frames: list[int]) -> list[list[int]]:
+  runs: list[list[int]] = []
+
+  for f in frames:
+    if runs:
+      first, step, count = runs[-1]
+      if count == 1 and f > first:
+        runs[-1] = [first, f - first, 2]
+        continue
+      if f == first + step * count:
+        runs[-1][2] += 1
+        continue
+
+    runs.append([f, 1, 1])
+
+  return runs
+
+
+def expand_frame_runs(runs: list[list[int]]) -> list[int]:
+  return [first + step * k for first, step, count in runs for k in range(count)]
+
+
+# Compresses the tracks to keyframes of each face, interpolating the boxes in between
+# within `tolerance` pixels. A tolerance of 0 is lossless for whole pixel boxes.
+def compress(t: Tracks, tolerance: Optional[float] = None) -> FaceTracks:
+  if tolerance is None:
+    tolerance = config.FACE_TRACK_COMPRESSION_TOLERANCE
+
+  frames = t.frames.astype(np.float64)
+  boxes = t.boxes.astype(np.float64)
+  integral = t.boxes.dtype != np.float32
+
+  # Samples and faces of each track. A face whose id is seen twice in a frame
+  # gets a track of its own, keyed by how many times the id was seen before.
+  samples: dict[tuple[int, int], list[int]] = {}
+  faces: dict[tuple[int, int], list[int]] = {}
+
+  offsets = t.face_offsets.tolist()
+  face_ids = t.face_ids.tolist()
+
+  for i in range(len(t)):
+    seen: dict[int, int] = {}
+
+    for j in range(offsets[i], offsets[i + 1]):
+      occurrence = seen.get(face_ids[j], 0)
+      seen[face_ids[j]] = occurrence + 1
+
+      key = (face_ids[j], occurrence)
+      samples.setdefault(key, []).append(i)
+      faces.setdefault(key, []).append(j)
+
+  tracks = []
+
+  for key, track_samples in samples.items():
+    s = np.array(track_samples)
+    b = boxes[faces[key]]
+
+    # Runs break where the face is missing from a sample.
+    breaks = np.flatnonzero(np.diff(s) > 1) + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(s)]))
+
+    keys, runs = [], []
+
+    for a, e in zip(starts.tolist(), ends.tolist()):
+      for k in run_keyframes(frames[s[a:e]], b[a:e], tolerance, integral):
+        keys.append([int(s[a + k])] + t.boxes[faces[key][a + k]].tolist())
+
+      runs.append([int(s[a]), int(s[e - 1])])
+
+    tracks.append(FaceTrack(t.ids[key[0]], keys, runs))
+
+  fps, times = frame_rate(t)
+
+  return FaceTracks(frame_runs(t.frames.tolist()), fps, times, integral, tolerance, tracks)
+
+
+# Returns the frame rate the times were computed with, if they all are frame / fps,
+# or otherwise the times themselves.
+def frame_rate(t: Tracks) -> tuple[Optional[float], Optional[list[float]]]:
+  nonzero = np.flatnonzero(t.times)
+
+  if len(nonzero):
+    fps = float(t.frames[nonzero[-1]] / t.times[nonzero[-1]])
+    # Frame rates are whole numbers, short of rounding errors.
+    if abs(fps - round(fps)) < 1e-6:
+      fps = float(round(fps))
+
+    if np.array_equal(t.frames / fps, t.times):
+      return fps, None
+
+  return None, t.times.tolist()
+
+
+# Reconstructs the box of every face in every sample from the keyframes.
+# Faces of a frame are in the order of their tracks.
+def expand(c: FaceTracks) -> Tracks:
+  frames = np.array(expand_frame_runs(c.frames), dtype=np.uint32)
+  times = np.array(c.times, dtype=np.float64) if c.times is not None else frames / cast_fps(c.fps)
+  f = frames.astype(np.float64)
+
+  ids: dict[str, int] = {}
+  # Faces found in each sample, as (track, id index, box).
+  found: list[list[tuple[int, int, np.ndarray]]] = [[] for _ in range(len(frames))]
+
+  for n, track in enumerate(c.tracks):
+    id = ids.setdefault(track.id, len(ids))
+    keys = np.array(track.keys, dtype=np.float64).reshape(-1, 5)
+    key_samples = keys[:, 0].astype(np.int64)
+
+    for first, last in track.runs:
+      k0 = int(np.searchsorted(key_samples, first))
+      k1 = int(np.searchsorted(key_samples, last))
+
+      for k in range(k0, max(k0, k1 - 1) + 1):
+        s0, s1 = int(key_samples[k]), int(key_samples[min(k + 1, k1)])
+        b = lerp(f[s0:s1 + 1], f[s0], f[s1], keys[k, 1:], keys[min(k + 1, k1), 1:], c.integral)
+
+        # Samples shared by neighbouring keyframes are only added once.
+        for i in range(s0 if k == k0 else s0 + 1, s1 + 1):
+          found[i].append((n, id, b[i - s0]))
+
+  face_offsets = np.zeros(len(frames) + 1, dtype=np.uint32)
+  face_offsets[1:] = np.cumsum([len(x) for x in found])
+
+  rows = [(id, box) for x in found for _, id, box in sorted(x, key=lambda r: r[0])]
+
+  return Tracks(
+    list(ids.keys()),
+    frames,
+    times,
+    face_offsets,
+    np.array([id for id, _ in rows], dtype=np.uint32),
+    np.array([box for _, box in rows], dtype=np.int32 if c.integral else np.float32).reshape(-1, 4)
+  )
+
+
+def cast_fps(fps: Optional[float]) -> float:
+  if not fps:
+    raise Exception("Face tracks have neither times nor a frame rate.")
+  return fps
+
+
+# Largest difference in pixels between the boxes of the same faces in two tracks,
+# or infinity if they don't have the same faces in the same frames.
+def max_error(a: Tracks, b: Tracks) -> float:
+  def faces(t: Tracks) -> dict[tuple[int, str, int], np.ndarray]:
+    d = {}
+    for i, fv in enumerate(t):
+      seen: dict[str, int] = {}
+      for face in fv.faces:
+        occurrence = seen.get(face.id, 0)
+        seen[face.id] = occurrence + 1
+        d[(fv.frame, face.id, occurrence)] = t.boxes[face.j].astype(np.float64)
+    return d
+
+  fa, fb = faces(a), faces(b)
+
+  if fa.keys() != fb.keys() or not np.array_equal(a.frames, b.frames):
+    return float("inf")
+
+  return max((float(np.abs(fa[k] - fb[k]).max()) for k in fa), default=0.0)
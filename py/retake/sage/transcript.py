@@ -0,0 +1,393 @@
+import json
+import numpy as np
+import os
+import shutil
+
+from collections import OrderedDict
+from typing import Optional
+
+# Max number of transcripts kept loaded by `load`.
+CACHE_SIZE = 4
+# Bump when the columns change, so that those saved before are rebuilt.
+COLUMNS_VERSION = 1
+
+
+# Intervals sorted by start, to find those lying within a range with a binary search.
+class IntervalIndex:
+  def __init__(self, starts: np.ndarray, ends: np.ndarray):
+    # Positions of the intervals in order of start, if not given in that order.
+    self.order: Optional[np.ndarray] = None
+
+    if len(starts) > 1 and np.any(starts[1:] < starts[:-1]):
+      self.order = np.argsort(starts, kind="stable")
+      starts = starts[self.order]
+      ends = ends[self.order]
+
+    self.starts = starts
+    self.ends = ends
+
+  # Positions of the intervals lying entirely within `start` to `end`, in order of start.
+  def within(self, start: float, end: float) -> np.ndarray:
+    i = int(np.searchsorted(self.starts, start, side="left"))
+    j = int(np.searchsorted(self.starts, end, side="right"))
+
+    found = i + np.flatnonzero(self.ends[i:j] <= end)
+
+    if self.order is not None:
+      return self.order[found]
+    return found
+
+
+# Segments of a transcript as saved to speech_data.json by `speech.transcribe`.
+#
+# Segments and their words are kept as columns of NumPy arrays, with texts and speaker labels
+# in string tables. The columns are saved as .npy files in a directory next to the JSON
+# and memory mapped when loaded, so the JSON is only parsed when they are missing or older
+# than it. Segments are rebuilt as dicts when needed whole, with the keys WhisperX gives them.
+class Transcript:
+  def __init__(self, path: str):
+    self.path = path
+
+    self._columns: Optional[dict[str, np.ndarray]] = None
+    self._meta: dict = {}
+
+    self._texts: Optional[list[str]] = None
+    self._index: Optional[IntervalIndex] = None
+
+  def _load(self) -> dict[str, np.ndarray]:
+    dir = columns_dir(self.path)
+    meta = read_meta(dir)
+
+    if meta is not None and meta["source"] == source_version(self.path):
+      self._meta = meta
+      # Plain arrays on the mapped memory, as slicing memmaps is much slower.
+      return {name: np.asarray(np.load(dir + f"/{name}.npy", mmap_mode="r")) for name in meta["columns"]}
+
+    with open(self.path, "r") as f:
+      columns, meta = build_columns(json.loads(f.read()))
+
+    meta["source"] = source_version(self.path)
+
+    try:
+      write_columns(dir, columns, meta)
+    except OSError as e:
+      print(f"Transcript: Unable to save columns to {dir}. {e}")
+
+    self._meta = meta
+    return columns
+
+  @property
+  def columns(self) -> dict[str, np.ndarray]:
+    if self._columns is None:
+      self._columns = self._load()
+    return self._columns
+
+  def __len__(self) -> int:
+    return len(self.columns["starts"])
+
+  @property
+  def language(self) -> Optional[str]:
+    return self.meta.get("language")
+
+  @property
+  def meta(self) -> dict:
+    self.columns
+    return self._meta
+
+  @property
+  def starts(self) -> np.ndarray:
+    return self.columns["starts"]
+
+  @property
+  def ends(self) -> np.ndarray:
+    return self.columns["ends"]
+
+  @property
+  def texts(self) -> list[str]:
+    if self._texts is None:
+      c = self.columns
+      self._texts = strings(c["text_data"], c["text_offsets"], 0, len(self))
+    return self._texts
+
+  def text(self, i: int) -> str:
+    if self._texts is not None:
+      return self._texts[i]
+    return strings(self.columns["text_data"], self.columns["text_offsets"], i, i + 1)[0]
+
+  @property
+  def speakers(self) -> list[Optional[str]]:
+    names = self.meta["speakers"]
+    return [names[s] if s >= 0 else None for s in self.columns["speakers"].tolist()]
+
+  @property
+  def index(self) -> IntervalIndex:
+    if self._index is None:
+      self._index = IntervalIndex(self.starts, self.ends)
+    return self._index
+
+  # Words of segment `i` as they appear in speech_data.json.
+  def words(self, i: int) -> list[dict]:
+    c = self.columns
+    first, last = int(c["word_offsets"][i]), int(c["word_offsets"][i + 1])
+
+    return self._words(np.arange(first, last), c["word_starts"][first:last].tolist(),
+                       c["word_ends"][first:last].tolist(), filled=False)
+
+  # Words at positions `at` with the given times. Unless `filled` is set,
+  # only words that had times in speech_data.json are given them.
+  def _words(self, at: np.ndarray, starts: list[float], ends: list[float], filled: bool) -> list[dict]:
+    c = self.columns
+    names = self.meta["speakers"]
+
+    scores = c["word_scores"][at].tolist()
+    speakers = c["word_speakers"][at].tolist()
+    has_start = c["word_has_start"][at].tolist()
+    has_end = c["word_has_end"][at].tolist()
+
+    text_starts = c["word_text_offsets"][at].tolist()
+    text_ends = c["word_text_offsets"][at + 1].tolist()
+
+    words = []
+    for k in range(len(scores)):
+      w: dict = {"word": c["word_data"][text_starts[k]:text_ends[k]].tobytes().decode()}
+
+      if filled or has_start[k]:
+        w["start"] = starts[k]
+      if filled or has_end[k]:
+        w["end"] = ends[k]
+      # Missing scores are NaN.
+      if scores[k] == scores[k]:
+        w["score"] = scores[k]
+      if speakers[k] >= 0:
+        w["speaker"] = names[speakers[k]]
+
+      words.append(w)
+
+    return words
+
+  # Segment `i` as it appears in speech_data.json.
+  def segment(self, i: int) -> dict:
+    c = self.columns
+
+    s = {
+      "start": float(c["starts"][i]),
+      "end": float(c["ends"][i]),
+      "text": self.text(i),
+      "words": self.words(i)
+    }
+
+    speaker = int(c["speakers"][i])
+    if speaker >= 0:
+      s["speaker"] = self.meta["speakers"][speaker]
+
+    return s
+
+  # Speech data of a clip joining `timeranges`: the segments lying within each timerange,
+  # with their times and those of their words relative to the start of the clip, rounded to
+  # the millisecond. Words without times are given those of the word before.
+  def clip(self, timeranges: list[tuple[float, float]]) -> list[dict]:
+    c = self.columns
+    names = self.meta["speakers"]
+
+    segments = []
+    clip_length = 0
+
+    for start, end in timeranges:
+      found = self.index.within(start, end)
+
+      seg_starts = c["starts"][found]
+      new_starts = np.round(clip_length + (seg_starts - start), 3)
+      new_ends = np.round(clip_length + (c["ends"][found] - start), 3)
+
+      # Words of the segments found, and which of them each belongs to.
+      firsts = c["word_offsets"][found]
+      counts = c["word_offsets"][found + 1] - firsts
+      owners = np.repeat(np.arange(len(found)), counts)
+      words = np.repeat(firsts - np.cumsum(counts) + counts, counts) + np.arange(int(counts.sum()))
+
+      word_starts = np.round((c["word_starts"][words] - seg_starts[owners]) + new_starts[owners], 3)
+      word_ends = np.round((c["word_ends"][words] - seg_starts[owners]) + new_starts[owners], 3)
+
+      all_words = self._words(words, word_starts.tolist(), word_ends.tolist(), filled=True)
+
+      k = 0
+      for j, (i, n) in enumerate(zip(found.tolist(), counts.tolist())):
+        s = {
+          "start": float(new_starts[j]),
+          "end": float(new_ends[j]),
+          "text": self.text(i),
+          "words": all_words[k:k + n]
+        }
+
+        speaker = int(c["speakers"][i])
+        if speaker >= 0:
+          s["speaker"] = names[speaker]
+
+        segments.append(s)
+        k += n
+
+      clip_length += end - start
+
+    return segments
+
+  # Segments as `(timerange, text)` lines, with the timerange as "from --> to" like in transcript.srt.
+  # Line breaks within a segment's text are replaced, so that each segment stays on one line.
+  def lines(self) -> list[tuple[str, str]]:
+    return [
+      (f"{start} --> {end}", " ".join(text.split()))
+      for start, end, text in zip(self.starts.tolist(), self.ends.tolist(), self.texts)
+    ]
+
+
+# Columns of the segments and words of a WhisperX result, and the metadata needed to read them.
+def build_columns(result: dict) -> tuple[dict[str, np.ndarray], dict]:
+  speakers: dict[str, int] = {}
+
+  def speaker(d: dict) -> int:
+    name = d.get("speaker")
+    if name is None:
+      return -1
+    return speakers.setdefault(name, len(speakers))
+
+  starts, ends, seg_speakers, texts, word_offsets = [], [], [], [], [0]
+  word_starts, word_ends, has_start, has_end, scores, word_speakers, word_texts = [], [], [], [], [], [], []
+
+  for s in result["segments"]:
+    starts.append(s["start"])
+    ends.append(s["end"])
+    seg_speakers.append(speaker(s))
+    texts.append(s["text"])
+
+    # Words without times are given those of the word before, or the start of the segment.
+    last_start = last_end = s["start"]
+    for w in s.get("words", []):
+      last_start = w.get("start", last_start)
+      last_end = w.get("end", last_end)
+
+      word_starts.append(last_start)
+      word_ends.append(last_end)
+      has_start.append("start" in w)
+      has_end.append("end" in w)
+      scores.append(w.get("score", np.nan))
+      word_speakers.append(speaker(w))
+      word_texts.append(w.get("word", ""))
+
+    word_offsets.append(len(word_starts))
+
+  text_data, text_offsets = string_table(texts)
+  word_data, word_text_offsets = string_table(word_texts)
+
+  columns = {
+    "starts": np.array(starts, dtype=np.float64),
+    "ends": np.array(ends, dtype=np.float64),
+    "speakers": np.array(seg_speakers, dtype=np.int32),
+    "text_data": text_data,
+    "text_offsets": text_offsets,
+    "word_offsets": np.array(word_offsets, dtype=np.int64),
+    "word_starts": np.array(word_starts, dtype=np.float64),
+    "word_ends": np.array(word_ends, dtype=np.float64),
+    "word_has_start": np.array(has_start, dtype=np.bool_),
+    "word_has_end": np.array(has_end, dtype=np.bool_),
+    "word_scores": np.array(scores, dtype=np.float64),
+    "word_speakers": np.array(word_speakers, dtype=np.int32),
+    "word_data": word_data,
+    "word_text_offsets": word_text_offsets
+  }
+
+  meta = {
+    "version": COLUMNS_VERSION,
+    "columns": list(columns.keys()),
+    "language": result.get("language"),
+    "speakers": list(speakers.keys())
+  }
+
+  return columns, meta
+
+
+# UTF-8 bytes of the strings joined together, and where each starts and ends in them.
+def string_table(values: list[str]) -> tuple[np.ndarray, np.ndarray]:
+  encoded = [v.encode() for v in values]
+
+  offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(e) for e in encoded])
+
+  return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+# Strings `first` to `last` of a string table.
+def strings(data: np.ndarray, offsets: np.ndarray, first: int, last: int) -> list[str]:
+  o = offsets[first:last + 1].tolist()
+  if len(o) < 2:
+    return []
+
+  b = data[o[0]:o[-1]].tobytes()
+
+  return [b[o[k] - o[0]:o[k + 1] - o[0]].decode() for k in range(last - first)]
+
+
+def columns_dir(path: str) -> str:
+  return os.path.splitext(path)[0]
+
+
+# Size and modification time of the JSON the columns were built from, to tell when it changed.
+def source_version(path: str) -> list[int]:
+  stat = os.stat(path)
+  return [stat.st_size, stat.st_mtime_ns]
+
+
+def read_meta(dir: str) -> Optional[dict]:
+  try:
+    with open(dir + "/meta.json", "r") as f:
+      meta = json.loads(f.read())
+  except (OSError, ValueError):
+    return None
+
+  if meta.get("version") != COLUMNS_VERSION:
+    return None
+
+  return meta
+
+
+# Written to a temporary directory first, so that readers never see partial columns.
+def write_columns(dir: str, columns: dict[str, np.ndarray], meta: dict):
+  tmp_dir = dir + f".{os.getpid()}.tmp"
+  shutil.rmtree(tmp_dir, ignore_errors=True)
+  os.makedirs(tmp_dir)
+
+  for name, a in columns.items():
+    np.save(tmp_dir + f"/{name}.npy", a)
+
+  with open(tmp_dir + "/meta.json", "w") as f:
+    f.write(json.dumps(meta))
+
+  shutil.rmtree(dir, ignore_errors=True)
+  os.replace(tmp_dir, dir)
+
+
+# Saves the columns of a WhisperX result, once it's been written to `path` as JSON.
+def save(result: dict, path: str):
+  columns, meta = build_columns(result)
+  meta["source"] = source_version(path)
+  write_columns(columns_dir(path), columns, meta)
+
+
+_transcripts: OrderedDict[str, tuple[tuple[int, float], Transcript]] = OrderedDict()
+
+
+# Returns the transcript at `path`, shared with earlier callers unless the file has changed since.
+def load(path: str) -> Transcript:
+  stat = os.stat(path)
+  version = (stat.st_size, stat.st_mtime)
+
+  cached = _transcripts.get(path)
+  if cached is not None and cached[0] == version:
+    _transcripts.move_to_end(path)
+    return cached[1]
+
+  t = Transcript(path)
+  _transcripts[path] = (version, t)
+
+  if len(_transcripts) > CACHE_SIZE:
+    _transcripts.popitem(last=False)
+
+  return t
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from dataclasses_json import DataClassJsonMixin
+from typing import Optional
 
 
 @dataclass
@@ -11,6 +12,19 @@ class Video:
   duration_ms: int
 
   
+@dataclass
+class KeyframeIndex(DataClassJsonMixin):
+  codec: str
+  profile: str
+  pix_fmt: str
+  keyframes: list[float]
+  # Position of each keyframe's packet in decoding order.
+  packets: list[int]
+  # Size and modification time of the indexed file, to tell when it changed.
+  src_size: int
+  src_mtime: float
+
+
 @dataclass
 class Segment(DataClassJsonMixin):
   title: str
@@ -32,3 +46,36 @@ class FrameData(DataClassJsonMixin):
   frame: int
   time: float
   faces: list[FaceData]
+
+
+# Boxes of a face as keyframes, each `[sample, x, y, w, h]` where `sample` is the position of its
+# frame in the sampled frames. Boxes between keyframes are interpolated linearly by frame.
+@dataclass
+class FaceTrack(DataClassJsonMixin):
+  id: str
+  keys: list[list[float]]
+  # First and last sample of each run of consecutive samples the face is in.
+  # Every run starts and ends with a keyframe.
+  runs: list[list[int]]
+
+
+# Face tracks of a clip, compressed to keyframes within `tolerance` pixels.
+@dataclass
+class FaceTracks(DataClassJsonMixin):
+  # Sampled frames, as runs of `[first frame, step, count]`.
+  frames: list[list[int]]
+  # Times of the sampled frames are frame / fps, unless given in `times`.
+  fps: Optional[float]
+  times: Optional[list[float]]
+  # Interpolated boxes are rounded to whole pixels if set.
+  integral: bool
+  tolerance: float
+  tracks: list[FaceTrack]
+
+
+@dataclass
+class TrackingStats:
+  frames: int = 0
+  faces: int = 0
+  embeddings: int = 0
+  embeddings_skipped: int = 0
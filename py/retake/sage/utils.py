@@ -1,6 +1,50 @@
 import os
+import threading
+
+from typing import Iterable, Iterator, TypeVar
+
+T = TypeVar('T')
 
 
 def ensure_dir_exists(path: str):
-  if not os.path.exists(path):
-    os.makedirs(path)
+  # Other processes may create it at the same time.
+  os.makedirs(path, exist_ok=True)
+
+
+def batched(iterable: Iterable[T], n: int) -> Iterator[list[T]]:
+  batch = []
+  for item in iterable:
+    batch.append(item)
+    if len(batch) >= n:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+# Running estimates of the sizes of cache directories, so that they aren't walked on every write.
+# Writes made in this process are added as they happen. Other processes write to the same
+# directories, so they are also walked every `interval` writes to catch up with those.
+class SizeEstimates:
+  def __init__(self, interval: int):
+    self.interval = interval
+    self._sizes: dict[str, list[int]] = {}
+    self._lock = threading.Lock()
+
+  # Adds a write of `size` bytes to `dir`, returning whether it should be walked,
+  # i.e. if it may exceed `max_bytes`, hasn't been walked yet or is due to be.
+  def add(self, dir: str, size: int, max_bytes: int) -> bool:
+    with self._lock:
+      estimate = self._sizes.get(dir)
+      if estimate is None:
+        return True
+
+      estimate[0] += size
+      estimate[1] += 1
+
+      return estimate[0] > max_bytes or estimate[1] >= self.interval
+
+  # Records the size of `dir` found by walking it.
+  def set(self, dir: str, size: int):
+    with self._lock:
+      self._sizes[dir] = [size, 0]
@@ -0,0 +1,154 @@
+import numpy as np
+
+from bisect import bisect_left, bisect_right
+from typing import Optional
+
+FRAME_MS = 30
+# Frames are considered silent when this far above the noise floor, at most.
+MARGIN_DB = 10.0
+# Frames louder than this are never considered silent, even in noisy recordings.
+MAX_THRESHOLD_DB = -30.0
+# Samples processed at once, to bound memory on long recordings.
+BLOCK_FRAMES = 20000
+
+
+# Energy based voice activity detection. Returns the loudness of each frame in dBFS.
+def frame_levels(audio: np.ndarray, sample_rate: int, frame_ms: int = FRAME_MS) -> np.ndarray:
+  frame = max(1, sample_rate * frame_ms // 1000)
+  n = len(audio) // frame
+
+  levels = np.empty(n, dtype=np.float32)
+
+  for i in range(0, n, BLOCK_FRAMES):
+    j = min(n, i + BLOCK_FRAMES)
+    block = audio[i*frame:j*frame].astype(np.float32).reshape(j - i, frame)
+    rms = np.sqrt(np.mean(np.square(block), axis=1))
+    levels[i:j] = 20 * np.log10(np.maximum(rms, 1e-10))
+
+  return levels
+
+
+# Returns `(start, end)` in seconds of stretches of silence lasting at least `min_silence` seconds.
+def silences(audio: np.ndarray, sample_rate: int, min_silence: float = 0.3,
+             threshold_db: Optional[float] = None, frame_ms: int = FRAME_MS) -> list[tuple[float, float]]:
+  levels = frame_levels(audio, sample_rate, frame_ms)
+  if len(levels) == 0:
+    return []
+
+  if threshold_db is None:
+    threshold_db = min(float(np.percentile(levels, 10)) + MARGIN_DB, MAX_THRESHOLD_DB)
+
+  silent = levels <= threshold_db
+
+  # Boundaries of runs of silent frames.
+  edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))
+  starts = np.flatnonzero(edges == 1)
+  ends = np.flatnonzero(edges == -1)
+
+  frame_s = frame_ms / 1000
+  min_frames = max(1, int(round(min_silence / frame_s)))
+
+  return [
+    (s * frame_s, e * frame_s)
+    for s, e in zip(starts, ends) if e - s >= min_frames
+  ]
+
+
+# Splits audio into windows of at most `max_length` seconds, cutting in the middle of silences
+# where possible. Windows are only cut short of half of `max_length` when no silence is found.
+def split(audio: np.ndarray, sample_rate: int, max_length: float,
+          min_silence: float = 0.3) -> list[tuple[float, float]]:
+  duration = len(audio) / sample_rate
+  cuts = [(s + e) / 2 for s, e in silences(audio, sample_rate, min_silence)]
+
+  windows = []
+  start = 0.0
+
+  while duration - start > max_length:
+    limit = start + max_length
+    candidates = [c for c in cuts if start + max_length / 2 <= c <= limit]
+
+    end = candidates[-1] if candidates else limit
+    windows.append((start, end))
+    start = end
+
+  windows.append((start, duration))
+
+  return windows
+
+
+# Finds speech with a pyannote voice activity detection model, such as the one WhisperX gates
+# transcription with. Unlike silences, this also leaves out music, intros and other sounds.
+# Returns `(start, end)` in seconds of each stretch of speech.
+def detect_speech(model, audio: np.ndarray, sample_rate: int, onset: float = 0.5,
+                  offset: Optional[float] = None) -> list[tuple[float, float]]:
+  import torch
+  from whisperx.vad import Binarize
+
+  scores = model({"waveform": torch.from_numpy(audio).unsqueeze(0), "sample_rate": sample_rate})
+  speech = Binarize(onset=onset, offset=offset)(scores)
+
+  return [(s.start, s.end) for s in speech.get_timeline().support()]
+
+
+# Returns `(start, end)` in seconds of the regions of audio lasting `duration` seconds to process,
+# given its stretches of speech. Speech is padded by `padding` seconds so that it isn't clipped,
+# and only gaps of at least `min_silence` seconds between it are removed. Regions fall on sample boundaries.
+def speech_regions(speech: list[tuple[float, float]], duration: float, sample_rate: int,
+                   min_silence: float = 2.0, padding: float = 0.25) -> list[tuple[float, float]]:
+  regions: list[tuple[float, float]] = []
+
+  for s, e in sorted(speech):
+    s = max(0.0, s - padding)
+    e = min(duration, e + padding)
+    if e <= s:
+      continue
+
+    if regions and s - regions[-1][1] < min_silence:
+      regions[-1] = (regions[-1][0], max(regions[-1][1], e))
+    else:
+      regions.append((s, e))
+
+  # Gaps at either end are too short to remove as well.
+  if regions and regions[0][0] < min_silence:
+    regions[0] = (0.0, regions[0][1])
+  if regions and duration - regions[-1][1] < min_silence:
+    regions[-1] = (regions[-1][0], duration)
+
+  return [
+    (round(s * sample_rate) / sample_rate, round(e * sample_rate) / sample_rate)
+    for s, e in regions
+  ]
+
+
+# Joins the regions of the audio together.
+def compact(audio: np.ndarray, sample_rate: int, regions: list[tuple[float, float]]) -> np.ndarray:
+  return np.concatenate([
+    audio[round(s * sample_rate):round(e * sample_rate)] for s, e in regions
+  ])
+
+
+# Maps times in audio compacted to its regions back to the original audio.
+class Timeline:
+  def __init__(self, regions: list[tuple[float, float]]):
+    self.regions = regions
+    # Start of each region in the compacted audio.
+    self.offsets = []
+
+    t = 0.0
+    for s, e in regions:
+      self.offsets.append(t)
+      t += e - s
+
+    self.duration = t
+
+  # Times at the joint of two regions are mapped to the start of the latter,
+  # or to the end of the former if `end` is set.
+  def to_original(self, t: float, end: bool = False) -> float:
+    if not self.regions:
+      return t
+
+    i = (bisect_left if end else bisect_right)(self.offsets, t) - 1
+    i = max(0, i)
+
+    return self.regions[i][0] + (t - self.offsets[i])
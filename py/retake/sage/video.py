@@ -1,32 +1,31 @@
 import cv2
 import ffmpeg
-import pandas as pd
+import json
+import os
 import shutil
 import subprocess
+import tempfile
 
 from dataclasses import dataclass
+from typing import cast, Iterator, Optional
 
 from retake.sage import config
-from .types import FaceData, FrameData, Video
+from .embeddings import EmbeddingIndex, similarity_confidence
+from .detectors import get_detector
+from .inference import crop, FaceEmbedder
+from .sampling import FrameSampler
+from .tracking import BoxTracker
+from .types import FaceData, FrameData, KeyframeIndex, TrackingStats, Video
+from .utils import batched
 
 
 def downscale(video: Video, dst: str, size_px: int):
-   w = None
-   h = None
-
    # Video is already of the desired resoultion.
    if max(video.width, video.height) == size_px:
       shutil.copy(video.src, dst)
       return
    
-   # Scale whilst maintaining aspect ratio.
-   # The larger side will have the specified pixel size.
-   if video.width > video.height:
-      w = size_px
-      h = -2
-   else:
-      w = -2
-      h = size_px
+   w, h = scaled_size(video, size_px)
 
    # if config.CUDA_AVAILABLE:
    #    cmd = [
@@ -64,6 +63,15 @@ def downscale(video: Video, dst: str, size_px: int):
       .run(capture_stdout=True, capture_stderr=True)
 
 
+# Scale whilst maintaining aspect ratio.
+# The larger side will have the specified pixel size.
+def scaled_size(video: Video, size_px: int) -> tuple[int, int]:
+   if video.width > video.height:
+      return size_px, -2
+   else:
+      return -2, size_px
+
+
 def from_source(src: str) -> Video:
    cmd = [
       "ffprobe",
@@ -104,6 +112,69 @@ def from_source(src: str) -> Video:
    )
 
 
+# Returns the keyframe timestamps of the video stream of the source, along with
+# the stream's encoding. The index is cached next to the source as `<name>.keyframes.json`.
+def keyframe_index(src: str) -> KeyframeIndex:
+   cache_path = os.path.splitext(src)[0] + ".keyframes.json"
+   stat = os.stat(src)
+
+   if os.path.exists(cache_path):
+      with open(cache_path, "r") as f:
+         index = KeyframeIndex.from_json(f.read())
+
+      if index.src_size == stat.st_size and index.src_mtime == stat.st_mtime:
+         return index
+
+   # Packet flags tell keyframes apart without decoding any frames.
+   cmd = [
+      "ffprobe",
+      "-v",
+      "error",
+      "-select_streams",
+      "v:0",
+      "-show_entries",
+      "stream=codec_name,profile,pix_fmt:packet=pts_time,flags",
+      "-of",
+      "json",
+      src
+   ]
+
+   result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, universal_newlines=True)
+
+   if result.returncode != 0:
+      raise Exception(result.stderr)
+
+   info = json.loads(result.stdout)
+
+   if not info.get("streams"):
+      raise Exception("No video stream found.")
+
+   stream = info["streams"][0]
+
+   # Packets are listed in decoding order.
+   keyframes = sorted(
+      (float(p["pts_time"]), i) for i, p in enumerate(info.get("packets", []))
+      if "K" in p.get("flags", "") and p.get("pts_time", "N/A") != "N/A"
+   )
+
+   index = KeyframeIndex(
+      codec=stream.get("codec_name", ""),
+      profile=stream.get("profile", ""),
+      pix_fmt=stream.get("pix_fmt", ""),
+      keyframes=[k[0] for k in keyframes],
+      packets=[k[1] for k in keyframes],
+      src_size=stat.st_size,
+      src_mtime=stat.st_mtime
+   )
+
+   with open(cache_path, "w") as f:
+      f.write(index.to_json())
+      f.flush()
+
+   return index
+
+
 def trim(src: str, dst: str, start: float, end: float):
    PTS = "PTS-STARTPTS"
 
@@ -146,171 +217,395 @@ def merge_all(src: list[str], dst: str):
    )
 
 
-def track_faces(v: Video) -> list[FrameData]:
+# Renders the given timeranges of the source into a single clip with one ffmpeg process.
+# Each range is seeked to on input and the ranges are joined with a concat filter,
+# so the clip is encoded once and no intermediate files are written.
+# If `preview` is given, the joined stream is also split off into a downscaled preview,
+# so that the clip is only decoded once.
+# Returns the metadata of the clip, as worked out from the source.
+def render(src: str, dst: str, timeranges: list[tuple[float, float]], preview: Optional[str] = None,
+           preview_size: int = 480, source: Optional[Video] = None) -> Video:
+   if source is None:
+      source = from_source(src)
+
+   av = []
+
+   for start, end in timeranges:
+      i = ffmpeg.input(src, ss=start, t=end - start)
+      av.append(i.video)
+      av.append(i.audio)
+
+   joined = ffmpeg.concat(*av, v=1, a=1).node
+   v, a = joined[0], joined[1]
+
+   # Preview is of the same resolution as the clip.
+   copy_preview = preview is not None and max(source.width, source.height) == preview_size
+
+   if preview is None or copy_preview:
+      out = ffmpeg.output(v, a, dst)
+   else:
+      vs = v.split()
+      as_ = a.asplit()
+
+      out = ffmpeg.merge_outputs(
+         ffmpeg.output(vs[0], as_[0], dst),
+         ffmpeg.output(vs[1].filter("scale", *scaled_size(source, preview_size)), as_[1], preview)
+      )
+
+   (
+      out
+      .overwrite_output()
+      .run(capture_stdout=True, capture_stderr=True)
+   )
+
+   if copy_preview:
+      shutil.copy(dst, cast(str, preview))
+
+   duration = source.duration_ms / 1000
+   length = sum(max(0, min(end, duration) - start) for start, end in timeranges)
+
+   return Video(
+      src=dst,
+      width=source.width,
+      height=source.height,
+      fps=source.fps,
+      duration_ms=int(length * 1000)
+   )
+
+
+# Encoders used to re-encode the edges of smart cuts, by source codec.
+SMART_CUT_ENCODERS = {
+   "h264": "libx264"
+}
+
+# Extra encoder options for the edges of smart cuts. x264 repeats its parameter sets
+# before every keyframe, rather than only the first, as the copied GOPs do.
+SMART_CUT_ENCODER_ARGS = {
+   "libx264": {"x264-params": "repeat-headers=1"}
+}
+
+# Container of the parts joined by smart cuts. The concat demuxer converts the H.264 of each
+# Matroska part to carry its own parameter sets in-band, so parts encoded with different
+# parameters can be joined.
+SMART_CUT_FORMAT = ("matroska", ".mkv")
+
+# Codec tags of smart cut clips in MP4 containers, by source codec. The re-encoded edges
+# and the copied GOPs have different parameter sets, but "avc1" only carries those of the
+# first part in the sample entry, which players may use for all of them. "avc3" has players
+# use the parameter sets in-band, before each keyframe.
+SMART_CUT_TAGS = {
+   "h264": "avc3"
+}
+
+MP4_EXTENSIONS = [".mp4", ".m4v", ".mov"]
+
+# Keeps seeks clear of the rounding in probed timestamps.
+SMART_CUT_EPSILON = 0.001
+
+
+# Splits a timerange into the GOPs fully inside of it, which can be stream copied,
+# and the parts at either edge, which must be re-encoded.
+# Returns a list of `(start, end, frames)`, where `frames` is the number of frames
+# to copy, or None for parts to re-encode.
+def smart_cut(index: KeyframeIndex, start: float, end: float) -> list[tuple[float, float, Optional[int]]]:
+   from bisect import bisect_left, bisect_right
+
+   keyframes = index.keyframes
+
+   i = bisect_left(keyframes, start - SMART_CUT_EPSILON)
+   j = bisect_right(keyframes, end + SMART_CUT_EPSILON) - 1
+
+   # No full GOP inside of the range.
+   if i >= len(keyframes) or j < 0 or keyframes[i] >= keyframes[j]:
+      return [(start, end, None)]
+
+   first, last = keyframes[i], keyframes[j]
+   parts = []
+
+   if first - start > SMART_CUT_EPSILON:
+      parts.append((start, first, None))
+
+   # With closed GOPs, the packets between two keyframes in decoding order are
+   # exactly the frames between them.
+   parts.append((first, last, index.packets[j] - index.packets[i]))
+
+   if end - last > SMART_CUT_EPSILON:
+      parts.append((last, end, None))
+
+   return parts
+
+
+# Renders the given timeranges of the source into a clip, stream copying whole GOPs
+# and only re-encoding the partial GOPs at the edges of each range.
+# Audio of all ranges is re-encoded in one go, which costs little next to the video. Encoding
+# each range on its own would add the encoder's priming samples at every join, so that audio
+# drifts further behind the video with each range.
+def render_fast(src: str, dst: str, timeranges: list[tuple[float, float]], index: KeyframeIndex):
+   encoder = SMART_CUT_ENCODERS.get(index.codec)
+   if not encoder:
+      raise Exception(f"Smart cut is not supported for '{index.codec}'.")
+
+   encode_args = dict(vcodec=encoder, pix_fmt=index.pix_fmt, **SMART_CUT_ENCODER_ARGS.get(encoder, {}))
+   if index.profile.lower() in ["baseline", "main", "high"]:
+      encode_args["profile:v"] = index.profile.lower()
+
+   mux_args = {}
+   if os.path.splitext(dst)[1].lower() in MP4_EXTENSIONS and index.codec in SMART_CUT_TAGS:
+      mux_args["tag:v"] = SMART_CUT_TAGS[index.codec]
+
+   eps = SMART_CUT_EPSILON
+   fmt, ext = SMART_CUT_FORMAT
+
+   with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(dst))) as tmp:
+      video_parts = []
+      audio = []
+
+      for i, (start, end) in enumerate(timeranges):
+         parts = smart_cut(index, start, end)
+
+         for j, (s, e, frames) in enumerate(parts):
+            out = tmp + f"/video_{i}_{j}{ext}"
+
+            if frames is not None:
+               # Seek just past the keyframe, which copying starts from.
+               # Packets are cut by count, as stream copies can't be cut by time precisely.
+               v = ffmpeg.input(src, ss=s + eps).video
+               args = {"vcodec": "copy", "frames:v": frames}
+            else:
+               # Re-encoded parts start exactly at the keyframe of the part before,
+               # and stop short of the keyframe of the part after.
+               ss = s - eps if j > 0 else s
+               t = e - ss - eps if j < len(parts) - 1 else e - ss
+               v = ffmpeg.input(src, ss=ss, t=t).video
+               args = encode_args
+
+            (
+               ffmpeg
+               .output(v, out, f=fmt, **args)
+               .overwrite_output()
+               .run(capture_stdout=True, capture_stderr=True)
+            )
+
+            video_parts.append(out)
+
+         audio.append(ffmpeg.input(src, ss=start, t=end - start).audio)
+
+      v = ffmpeg.input(concat_list(tmp + "/video.txt", video_parts), f="concat", safe=0)
+      a = ffmpeg.concat(*audio, v=0, a=1)
+
+      (
+         ffmpeg
+         .output(v.video, a, dst, vcodec="copy", acodec="aac", **mux_args)
+         .overwrite_output()
+         .run(capture_stdout=True, capture_stderr=True)
+      )
+
+
+def trim_fast(src: str, dst: str, start: float, end: float, index: KeyframeIndex):
+   render_fast(src, dst, [(start, end)], index)
+
+
+def concat_list(path: str, files: list[str]) -> str:
+   with open(path, "w") as f:
+      for file in files:
+         f.write(f"file '{file}'\n")
+      f.flush()
+
+   return path
+
+
+def track_faces(v: Video, stats: Optional[TrackingStats] = None) -> list[FrameData]:
+   return list(iter_faces(v, stats))
+
+
+# Yields the faces of each sampled frame that has any, as soon as the frame is processed.
+def iter_faces(v: Video, stats: Optional[TrackingStats] = None) -> Iterator[FrameData]:
    import tensorflow as tf
    
-   from deepface import DeepFace
    from deepface.commons import distance
    
    print("Num GPUs Available: ", len(tf.config.list_physical_devices('GPU')))
    
-   cap = cv2.VideoCapture(v.src)
+   if stats is None:
+      stats = TrackingStats()
 
-   face_data: list[FrameData] = []
    face_size = (224, 224)
 
    known_faces = []
-   df = pd.DataFrame([], columns=["id", "embedding"])
+   index = EmbeddingIndex()
+   threshold = distance.findThreshold(config.FACE_DETECTION_MODEL, "euclidean_l2")
 
-   lf_faces = []
+   detector = get_detector(config.FACE_DETECTOR)
+   embedder = FaceEmbedder(config.FACE_DETECTION_MODEL, detector.align_backend)
 
-   frame_count = 0
-   while (cap.isOpened()):
-      frame_count += 1
+   lf_faces = []
 
-      ret, frame = cap.read()
-      if not ret:
-         break
+   # Only decode frames sampled every x seconds.
+   frames = FrameSampler(
+      v.src,
+      config.FACE_SAMPLE_INTERVAL,
+      v.fps,
+      config.FACE_SAMPLE_QUEUE_SIZE
+   )
 
-      # Only process every x frames.
-      if frame_count % 30 != 0:
-         continue
+   tracker = BoxTracker(config.FACE_TRACK_IOU_THRESHOLD)
 
-      current_faces = []
+   stopped = False
 
-      try:
-         faces = DeepFace.extract_faces(
-            frame,
-            face_size,
-            config.FACE_DETECTION_METHOD
+   try:
+      for batch in batched(frames, config.FACE_BATCH_SIZE):
+         # Faces are detected on downscaled frames, but cropped from the original
+         # frame and reported in its resolution.
+         detections = detector.detect_batch(
+            [frame for _, frame in batch],
+            config.FACE_DETECTION_SIZE
          )
 
-         for f in faces:
-            a = f["facial_area"]
-            w, h = a['w'], a['h']
-            x, y = a['x'], a['y']
+         # Carry the identities of tracked faces over and only embed faces that
+         # are new, were lost or are due to be verified again.
+         plans = []
+         crops = []
+
+         for (_, frame), faces in zip(batch, detections):
+            confident = [f for f in faces or [] if f["confidence"] >= detector.min_confidence]
+
+            tracks = tracker.update([
+               (f["facial_area"]["x"], f["facial_area"]["y"], f["facial_area"]["w"], f["facial_area"]["h"])
+               for f in confident
+            ])
+
+            plan = []
+            for f, t in zip(confident, tracks):
+               embed = t.needs_embedding(config.FACE_TRACK_REVERIFY_INTERVAL)
+               if embed:
+                  t.schedule()
+                  crops.append(crop(frame, f["facial_area"], face_size))
+               plan.append((f, t, embed))
+
+            plans.append(plan)
 
-            if f["confidence"] < 0.98:
+         # Embed the faces of all frames in the batch at once.
+         embeddings = iter(embedder.embed_batch(crops))
+
+         stats.frames += len(batch)
+         stats.embeddings += len(crops)
+
+         for (frame_count, frame), faces, plan in zip(batch, detections, plans):
+            # No faces detected in frame.
+            if faces is None:
                continue
 
-            lf_region_face_id = None
-            lf_region_face_dst = 1.0
+            stats.faces += len(plan)
 
-            for f in lf_faces:
-               dst = distance.findEuclideanDistance(
-                  distance.l2_normalize([x, y]),
-                  distance.l2_normalize(f[1])
-               )
+            current_faces = []
+            frame_data: Optional[FrameData] = None
 
-               if dst < lf_region_face_dst:
-                  lf_region_face_id = f[0]
-                  lf_region_face_dst = dst
+            for f, track, embed in plan:
+               a = f["facial_area"]
+               w, h = a['w'], a['h']
+               x, y = a['x'], a['y']
 
-            sim_confidence = 0.0
-            
-            try:
-               face = frame[y:y+h, x:x+w]
-               face = cv2.resize(face, face_size)
+               if not embed:
+                  # The embedding for the start of the track failed earlier in the batch.
+                  if track.face_id is None:
+                     continue
 
-               face_id = f"face_{len(known_faces) + 1}"
+                  face_id = track.face_id
+                  sim_confidence = track.confidence
+                  stats.embeddings_skipped += 1
+               else:
+                  embedding = next(embeddings)
 
-               representation = DeepFace.represent(
-                  face,
-                  model_name=config.FACE_DETECTION_MODEL,
-                  detector_backend=config.FACE_DETECTION_METHOD
-               )
-               embedding = representation[0]["embedding"]
+                  lf_region_face_id = None
+                  lf_region_face_dst = 1.0
 
-               distances = []
-               for _, row in df.iterrows():
-                  source = row["embedding"]
+                  for lf in lf_faces:
+                     dst = distance.findEuclideanDistance(
+                        distance.l2_normalize([x, y]),
+                        distance.l2_normalize(lf[1])
+                     )
 
-                  dst = distance.findEuclideanDistance(
-                     distance.l2_normalize(source),
-                     distance.l2_normalize(embedding),
-                  )
+                     if dst < lf_region_face_dst:
+                        lf_region_face_id = lf[0]
+                        lf_region_face_dst = dst
 
-                  distances.append(dst)
+                  # Face could not be embedded.
+                  if embedding is None:
+                     track.failed()
+                     continue
 
-               result_df = df.copy()
-               result_df["distance"] = distances
+                  face_id = f"face_{len(known_faces) + 1}"
 
-               threshold = distance.findThreshold(config.FACE_DETECTION_MODEL, "euclidean_l2")
+                  # Closest known embeddings within the threshold.
+                  match_ids, match_dsts = index.query(embedding, threshold)
 
-               # Only keep rows where distance doesn't exceed threshold.
-               result_df = result_df[result_df["distance"] <= threshold]
-               result_df = result_df.sort_values(by=["distance"], ascending=True).reset_index(drop=True)
+                  # Calculate confidence by how similar the next x distances are.
+                  sim_confidence = similarity_confidence(match_dsts, 5)
 
-               # Calculate confidence by how similar the next x distances are.
-               sim_sd = result_df.head(5)["distance"].std()
-               # For new faces, the deviation will be NaN, resulting in a confidence level of 0.
-               if not pd.isna(sim_sd):
-                  sim_confidence = 1 - sim_sd
+                  save_embedding = True
 
-               save_embedding = True
+                  # Found a similar face.
+                  if match_ids.size > 0:
+                     face_id = match_ids[0]
 
-               # Found a similar face.
-               if result_df.size > 0:
-                  match = result_df.iloc[0]
-                  face_id = match["id"]
+                     if sim_confidence < 0.9:
+                        if lf_region_face_dst < 0.05:
+                           face_id = lf_region_face_id
+                        else:
+                           save_embedding = False
+                  # No match found. But previous frame had a face in the same area.
+                  elif lf_region_face_dst < 0.05:
+                     # Treat both faces as being the same.
+                     face_id = lf_region_face_id
+                  else:
+                     known_faces.append(face_id)
+                     print(f"New face detected: {face_id}")
 
-                  if sim_confidence < 0.9:
-                     if lf_region_face_dst < 0.05:
-                        face_id = lf_region_face_id
-                     else:
-                        save_embedding = False
-               # No match found. But previous frame had a face in the same area.
-               elif lf_region_face_dst < 0.05:
-                  # Treat both faces as being the same.
-                  face_id = lf_region_face_id
-               else:
-                  known_faces.append(face_id)
-                  print(f"New face detected: {face_id}")
-
-               if save_embedding:
-                  df = pd.concat([df, pd.DataFrame.from_records({
-                     "id": face_id,
-                     "embedding": [embedding]
-                  })], ignore_index=True)
-            except ValueError:
-               continue
+                  if save_embedding:
+                     index.add(face_id, embedding)
 
-            current_faces.append([face_id, [x, y]])
+                  track.verified(face_id, sim_confidence)
 
-            fd = FaceData(
-               str(face_id),
-               x, y,
-               w, h
-            )
+               current_faces.append([face_id, [x, y]])
 
-            if face_data and face_data[-1].frame == frame_count:
-               face_data[-1].faces.append(fd)
-            else:
-               face_data.append(FrameData(frame_count, frame_count / v.fps, [fd]))
-
-            if config.IS_DEV:
-               frame = cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 2)
-               frame = cv2.putText(
-                  img = frame,
-                  text = f"{face_id}_{round(sim_confidence, 3)}",
-                  org = (x, y+h),
-                  fontFace = cv2.FONT_HERSHEY_DUPLEX,
-                  fontScale = 1,
-                  color = (125, 246, 55),
-                  thickness = 1
+               fd = FaceData(
+                  str(face_id),
+                  x, y,
+                  w, h
                )
-      except ValueError:
-         continue
 
-      lf_faces = current_faces
+               if frame_data is None:
+                  frame_data = FrameData(frame_count, frame_count / v.fps, [])
+               frame_data.faces.append(fd)
+
+               if config.IS_DEV:
+                  frame = cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 2)
+                  frame = cv2.putText(
+                     img = frame,
+                     text = f"{face_id}_{round(sim_confidence, 3)}",
+                     org = (x, y+h),
+                     fontFace = cv2.FONT_HERSHEY_DUPLEX,
+                     fontScale = 1,
+                     color = (125, 246, 55),
+                     thickness = 1
+                  )
 
-      if config.IS_DEV and config.DEBUG:
-         cv2.imshow('frame', frame)
-         if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
+            lf_faces = current_faces
+
+            if frame_data is not None:
+               yield frame_data
 
+            if config.IS_DEV and config.DEBUG:
+               cv2.imshow('frame', frame)
+               if cv2.waitKey(1) & 0xFF == ord('q'):
+                  stopped = True
+                  break
 
-   cap.release()
-   cv2.destroyAllWindows()
+         if stopped:
+            break
+   finally:
+      frames.close()
+      cv2.destroyAllWindows()
 
-   return face_data
+   print(f"track_faces: Done. Frames: {stats.frames}, Faces: {stats.faces}, "
+         f"Embeddings: {stats.embeddings}, Skipped: {stats.embeddings_skipped}.")